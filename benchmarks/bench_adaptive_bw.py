@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Show an :class:`AdaptiveRateController` converging on the capacity
+of a simulated link, and following it when the capacity halves
+halfway through.  A writer sends as fast as it is allowed with a
+ceiling ten times the capacity; a static limit at that ceiling is
+shown for comparison.
+
+    python3 benchmarks/bench_adaptive_bw.py [capacity] [seconds]
+'''
+
+import asyncio, sys
+from entanglement.bandwidth import BwLimitMonitor, AdaptiveRateController
+
+class SimulatedLink(asyncio.Transport):
+
+    '''Carries *capacity* characters per second; the rest queues as
+    in a socket's write buffer.'''
+
+    tick = 0.005
+
+    def __init__(self, loop, capacity):
+        super().__init__()
+        self.loop = loop
+        self.capacity = capacity
+        self.buffered = 0
+        self.delivered = 0
+        self._stamp = loop.time()
+        self._handle = loop.call_later(self.tick, self._drain)
+
+    def write(self, data):
+        self.buffered += len(data)
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def _drain(self):
+        now = self.loop.time()
+        sent = min(self.buffered, self.capacity*(now-self._stamp))
+        self.buffered -= sent
+        self.delivered += sent
+        self._stamp = now
+        self._handle = self.loop.call_later(self.tick, self._drain)
+
+    def close(self):
+        self._handle.cancel()
+
+class Writer:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiter = None
+
+    def pause_writing(self):
+        self.waiter = self.loop.create_future()
+
+    def resume_writing(self):
+        self.waiter.set_result(None)
+        self.waiter = None
+
+async def run(loop, capacity, seconds, adaptive):
+    link = SimulatedLink(loop, capacity)
+    monitor = BwLimitMonitor(loop = loop, chars_per_sec = 10*capacity)
+    writer = monitor.protocol = Writer(loop)
+    controller = AdaptiveRateController(monitor, link, ceiling = 10*capacity) if adaptive else None
+    async def report():
+        delivered = 0
+        for i in range(int(seconds*2)):
+            await asyncio.sleep(0.5)
+            if i+1 == seconds: link.capacity = capacity/2
+            print("{:4.1f}s capacity {:9.0f} rate {:9.0f} delivered {:9.0f}/s queue {:6.3f}s".format(
+                (i+1)/2, link.capacity, monitor.chars_per_sec,
+                (link.delivered-delivered)*2, link.buffered/link.capacity))
+            delivered = link.delivered
+    reporter = loop.create_task(report())
+    while not reporter.done():
+        if writer.waiter: await writer.waiter
+        chunk = b'x'*1000
+        link.write(chunk)
+        monitor.bw_used(len(chunk))
+        await asyncio.sleep(0)
+    if controller: controller.stop()
+    link.close()
+
+def main(capacity = 1000000, seconds = 5):
+    loop = asyncio.new_event_loop()
+    for adaptive in (False, True):
+        print("adaptive" if adaptive else "static")
+        loop.run_until_complete(run(loop, capacity, seconds, adaptive))
+    loop.close()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
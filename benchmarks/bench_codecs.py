@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure the encoders and decoders in :mod:`entanglement.types`
+against the library calls they replace.
+
+    python3 benchmarks/bench_codecs.py [iterations]
+'''
+
+import base64, datetime, iso8601, sys, time, uuid
+from entanglement import types
+
+def measure(fn, value, iterations):
+    start = time.perf_counter()
+    for i in range(iterations): fn(value)
+    return (time.perf_counter()-start)/iterations*1e9
+
+def main(iterations = 200000):
+    u = uuid.uuid4()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    blob = bytes(range(256))*4
+    cases = [
+        ('datetime decode', now.isoformat(), iso8601.parse_date, types.datetime_decoder, ()),
+        ('uuid decode', str(u), uuid.UUID, types.uuid_decoder, ()),
+        ('uuid decode compact', u.hex, uuid.UUID, types.uuid_decoder, ()),
+        ('uuid encode', u, str, types.uuid_encoder, ()),
+        ('uuid encode compact', u, str, types.uuid_encoder, ('uuid-hex',)),
+        ('binary encode', blob, lambda v: str(base64.b64encode(v), 'utf-8'), types.binary_encoder, ()),
+        ('binary decode', types.binary_encoder(blob), base64.b64decode, types.binary_decoder, ()),
+        ]
+    for name, value, old, new, codecs in cases:
+        old_ns = measure(old, value, iterations)
+        # As a protocol sets it for a peer that offered these codecs
+        token = types.wire_codecs.set(frozenset(codecs))
+        try: new_ns = measure(new, value, iterations)
+        finally: types.wire_codecs.reset(token)
+        print("{}: {:.0f} ns, was {:.0f} ns".format(name, new_ns, old_ns))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Compare encoding and parsing a batch of objects of one class one
+object per message against one columnar message.  The class has a
+UUID, a datetime, an int, a float and a string.  If NumPy is
+installed, also measure encoding the numeric columns through it.
+
+    python3 benchmarks/bench_columnar.py [objects] [repeats]
+'''
+
+import datetime, json, sys, timeit, uuid
+from entanglement import Synchronizable, sync_property
+from entanglement.types import wire_codecs, supported_codecs
+
+class Row(Synchronizable):
+    id: uuid.UUID = sync_property()
+    when: datetime.datetime = sync_property()
+    count = sync_property()
+    ratio = sync_property()
+    name = sync_property()
+
+def make_rows(objects):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rows = []
+    for i in range(objects):
+        r = Row()
+        r.id = uuid.uuid4()
+        r.when = now+datetime.timedelta(seconds = i)
+        r.count = i
+        r.ratio = i/7
+        r.name = 'row {}'.format(i)
+        rows.append(r)
+    return rows
+
+def per_object(rows):
+    return [json.dumps(dict(r.to_sync(), _sync_type = 'Row')) for r in rows]
+
+def columnar(rows):
+    return json.dumps({'_sync_type': 'Row', '_columns': Row._sync_encode_columns(rows)})
+
+def columnar_numpy(rows, numpy):
+    columns = Row._sync_encode_columns(rows, ['id', 'when', 'name'])
+    columns['count'] = numpy.array([r.count for r in rows]).tolist()
+    columns['ratio'] = numpy.array([r.ratio for r in rows]).tolist()
+    return json.dumps({'_sync_type': 'Row', '_columns': columns})
+
+def parse_columns(text):
+    msg = json.loads(text)
+    columns = msg.pop('_columns')
+    keys = tuple(columns)
+    return [dict(zip(keys, row), **msg) for row in zip(*columns.values())]
+
+def measure(label, fn, objects, repeats):
+    elapsed = min(timeit.repeat(fn, number = 1, repeat = repeats))
+    print("{:24} {:8.1f} µs/batch {:8.0f} objects/s".format(label, elapsed*1e6, objects/elapsed))
+
+def main(objects = 64, repeats = 200):
+    token = wire_codecs.set(supported_codecs)
+    rows = make_rows(objects)
+    messages = per_object(rows)
+    batch = columnar(rows)
+    assert parse_columns(batch) == [json.loads(m) for m in messages]
+    print("{} objects: {} characters sent one by one, {} columnar".format(
+        objects, sum(map(len, messages)), len(batch)))
+    measure('encode per object', lambda: per_object(rows), objects, repeats)
+    measure('encode columnar', lambda: columnar(rows), objects, repeats)
+    try: import numpy
+    except ImportError: numpy = None
+    if numpy is not None:
+        assert json.loads(columnar_numpy(rows, numpy)) == json.loads(batch)
+        measure('encode columnar, NumPy', lambda: columnar_numpy(rows, numpy), objects, repeats)
+    measure('parse per object', lambda: [json.loads(m) for m in messages], objects, repeats)
+    measure('parse columnar', lambda: parse_columns(batch), objects, repeats)
+    wire_codecs.reset(token)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Compare the size of messages for classes with 5, 30 and 100
+properties, and the time to encode them to JSON and parse them back,
+when properties are sent by name and by position.
+
+    python3 benchmarks/bench_positional.py [iterations]
+'''
+
+import json, sys, timeit
+from entanglement import Synchronizable, sync_property
+from entanglement.protocol import _to_positional, _from_positional
+
+def make_class(properties):
+    ns = {'__module__': __name__}
+    for i in range(properties):
+        ns['temperature_{}'.format(i)] = sync_property()
+    return type('Properties{}'.format(properties), (Synchronizable,), ns)
+
+def round_trip(obj, names, name_set):
+    sync_rep = obj.to_sync()
+    sync_rep['_sync_type'] = obj.sync_type
+    if names: sync_rep = _to_positional(sync_rep, names, name_set)
+    sync_rep = json.loads(json.dumps(sync_rep))
+    if names: _from_positional(sync_rep, names)
+    return sync_rep
+
+def main(iterations = 20000):
+    for properties in (5, 30, 100):
+        cls = make_class(properties)
+        names = cls._sync_schema()[0]
+        obj = cls()
+        for i, k in enumerate(names):
+            if k != '_sync_owner': setattr(obj, k, i*1.5)
+        name_set = frozenset(names)
+        assert round_trip(obj, names, name_set) == round_trip(obj, None, None)
+        for mode, mode_names in (('named', None), ('positional', names)):
+            sync_rep = obj.to_sync()
+            if mode_names: sync_rep = _to_positional(sync_rep, mode_names, name_set)
+            size = len(json.dumps(sync_rep))
+            elapsed = min(timeit.repeat(lambda: round_trip(obj, mode_names, name_set),
+                                        number = iterations, repeat = 5))
+            print("{:3} properties {:10}: {:5} bytes, {:8.0f} messages/s".format(
+                properties, mode, size, iterations/elapsed))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
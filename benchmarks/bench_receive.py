@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure the per-message cost of :meth:`SyncManager._sync_receive`
+for a small in-memory class, without any network I/O.
+
+    python3 benchmarks/bench_receive.py [messages]
+'''
+
+import sys, time
+from entanglement import SyncManager, SyncRegistry, Synchronizable, sync_property
+
+registry = SyncRegistry()
+
+class Point(Synchronizable):
+
+    sync_registry = registry
+    sync_primary_keys = ('id',)
+    id = sync_property()
+    x = sync_property()
+    y = sync_property()
+
+class FakeDestination:
+
+    dest_hash = None
+
+    def should_listen(self, msg, cls, **info): return True
+
+class FakeProtocol:
+
+    dest = FakeDestination()
+
+def main(count = 200000):
+    manager = SyncManager(None, 0, registries = [registry])
+    protocol = FakeProtocol()
+    receive = manager._sync_receive
+    start = time.perf_counter()
+    for i in range(count):
+        receive({'_sync_type': 'Point', 'id': i, 'x': 1, 'y': 2}, protocol, None)
+    elapsed = time.perf_counter() - start
+    print("{:.2f} us/message ({} messages)".format(elapsed/count*1e6, count))
+    manager.close()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure incoming messages per second received into an
+:class:`SqlSyncRegistry`, committing each message and committing in
+batches.  By default a temporary sqlite file is used; pass
+``--url postgresql://...`` to measure against PostgreSQL.
+
+    python3 benchmarks/bench_sql_receive.py [--url URL] [--messages N] [--batch-size N]
+'''
+
+import argparse, os, tempfile, time, uuid
+from sqlalchemy import Column, Integer, create_engine, func, select
+from entanglement import SyncManager
+from entanglement.util import DestHash
+from entanglement.sql import sql_sync_declarative_base, SyncOwner, SqlSyncDestination
+
+Base = sql_sync_declarative_base()
+
+class Row(Base):
+
+    __tablename__ = 'bench_rows'
+    id = Column(Integer, primary_key = True)
+    value = Column(Integer)
+
+class FakeDestination:
+
+    def __init__(self, dest_hash):
+        self.dest_hash = dest_hash
+
+    def should_listen(self, msg, cls, **info): return True
+
+class FakeProtocol:
+
+    def __init__(self, dest):
+        self.dest = dest
+
+def setup(url):
+    engine = create_engine(url)
+    registry = Base.registry
+    registry.sessionmaker.configure(bind = engine)
+    registry.create_bookkeeping(engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    session = registry.sessionmaker()
+    session.query(SyncOwner).delete()
+    session.query(SqlSyncDestination).delete()
+    dest_hash = DestHash(os.urandom(32))
+    owner_id = uuid.uuid4()
+    owner = SyncOwner(id = owner_id, sync_serial = 0)
+    owner.dest_hash = dest_hash
+    session.add_all([SqlSyncDestination(dest_hash, 'bench'), owner])
+    session.commit()
+    session.close()
+    return engine, FakeDestination(dest_hash), owner_id
+
+def run(url, messages, batch_size):
+    engine, dest, owner_id = setup(url)
+    registry = Base.registry
+    registry.batch_size = batch_size
+    manager = SyncManager(None, 0, registries = [registry])
+    protocol = FakeProtocol(dest)
+    receive = manager._sync_receive
+    start = time.perf_counter()
+    for i in range(messages):
+        receive({'_sync_type': 'Row',
+                 '_sync_operation': 'sync',
+                 '_sync_owner': str(owner_id),
+                 'sync_serial': i+1,
+                 'id': i,
+                 'value': i}, protocol, None)
+    registry.commit_batches()
+    elapsed = time.perf_counter() - start
+    with engine.connect() as connection:
+        received = connection.execute(select(func.count()).select_from(Row.__table__)).scalar()
+    assert received == messages, "received {} of {}".format(received, messages)
+    manager.close()
+    engine.dispose()
+    return messages/elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url')
+    parser.add_argument('--messages', type = int, default = 2000)
+    parser.add_argument('--batch-size', type = int, default = 100)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        for batch_size in (None, args.batch_size):
+            rate = run(url, args.messages, batch_size)
+            print("batch_size={}: {:.0f} messages/s".format(batch_size, rate))
+
+if __name__ == '__main__':
+    main()
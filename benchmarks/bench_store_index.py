@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Compare finding the objects in a :class:`SyncStore` with one
+attribute value, or a range of values, by scanning against hash and
+sorted indexes, and measure what the indexes add to
+:meth:`SyncStore.add`.  Objects are spread over 100 rooms.
+
+    python3 benchmarks/bench_store_index.py [objects] [repeats]
+'''
+
+import sys, timeit
+from entanglement import sync_property
+from entanglement.memory import SyncStore, StoreInSyncStoreMixin
+
+class Device(StoreInSyncStoreMixin):
+    sync_primary_keys = ('id',)
+
+    id = sync_property()
+    room = sync_property()
+    value = sync_property()
+
+def make_devices(objects):
+    devices = []
+    for i in range(objects):
+        d = Device()
+        d.id = i
+        d.room = i%100
+        d.value = (i*7919)%objects
+        devices.append(d)
+    return devices
+
+def fill(devices, *indexes):
+    store = SyncStore()
+    for attribute, sorted in indexes:
+        store.add_index(attribute, sorted = sorted)
+    for d in devices:
+        store.add(d)
+    return store
+
+def measure(label, fn, repeats):
+    elapsed = min(timeit.repeat(fn, number = 1, repeat = repeats))
+    print("{:32} {:10.1f} µs".format(label, elapsed*1e6))
+
+def main(objects = 100000, repeats = 5):
+    devices = make_devices(objects)
+    plain = fill(devices)
+    indexed = fill(devices, ('room', False), ('value', True))
+    assert sorted(d.id for d in plain.lookup('room', 7)) == sorted(d.id for d in indexed.lookup('room', 7))
+    assert plain.lookup_range('value', 100, 200) == indexed.lookup_range('value', 100, 200)
+    print("{} objects".format(objects))
+    measure('lookup by room, scan', lambda: plain.lookup('room', 7), repeats)
+    measure('lookup by room, hash index', lambda: indexed.lookup('room', 7), repeats)
+    measure('range of 100 values, scan', lambda: plain.lookup_range('value', 100, 200), repeats)
+    measure('range of 100 values, sorted index', lambda: indexed.lookup_range('value', 100, 200), repeats)
+    measure('add all, no indexes', lambda: fill(devices), repeats)
+    measure('add all, both indexes', lambda: fill(devices, ('room', False), ('value', True)), repeats)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
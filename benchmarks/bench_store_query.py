@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Compare :meth:`SyncStore.query` with and without indexes on a
+store of a million objects, for equality, range, prefix and
+conjunction queries, both for all results and for the first one.
+Objects are spread over 1000 rooms; the room has a hash index and the
+value and name sorted indexes.
+
+    python3 benchmarks/bench_store_query.py [objects] [repeats]
+'''
+
+import sys, time, timeit
+from entanglement import sync_property
+from entanglement.memory import SyncStore, StoreInSyncStoreMixin, Equal, Range, Prefix
+
+class Device(StoreInSyncStoreMixin):
+    sync_slots = True
+    sync_primary_keys = ('id',)
+
+    id = sync_property()
+    room = sync_property()
+    value = sync_property()
+    name = sync_property()
+
+def make_devices(objects):
+    devices = []
+    for i in range(objects):
+        d = Device()
+        d.id = i
+        d.room = i%1000
+        d.value = (i*7919)%objects
+        d.name = 'device-{:07}'.format((i*104729)%objects)
+        devices.append(d)
+    return devices
+
+def fill(devices, indexed):
+    store = SyncStore()
+    if indexed:
+        store.add_index('room')
+        store.add_index('value', sorted = True)
+        store.add_index('name', sorted = True)
+    for d in devices:
+        store.add(d)
+    return store
+
+def measure(fn, repeats):
+    return min(timeit.repeat(fn, number = 1, repeat = repeats))
+
+def main(objects = 1000000, repeats = 3):
+    devices = make_devices(objects)
+    stores = {}
+    for indexed in (False, True):
+        start = time.perf_counter()
+        stores[indexed] = fill(devices, indexed)
+        print("fill {} objects, {}: {:.2f} s".format(
+            objects, 'indexed' if indexed else 'not indexed', time.perf_counter()-start))
+    queries = {
+        'room = 7': (Equal('room', 7),),
+        'value in [1000, 2000)': (Range('value', 1000, 2000),),
+        "name starts 'device-00012'": (Prefix('name', 'device-00012'),),
+        'room = 7 and value < 100000': (Equal('room', 7), Range('value', high = 100000)),
+        }
+    print("{:34} {:>12} {:>12} {:>12} {:>12}".format('', 'scan all', 'index all', 'scan first', 'index first'))
+    for label, predicates in queries.items():
+        assert sorted(d.id for d in stores[False].query(*predicates)) == \
+            sorted(d.id for d in stores[True].query(*predicates))
+        times = []
+        for fn in (list, next):
+            for indexed in (False, True):
+                store = stores[indexed]
+                times.append(measure(lambda: fn(store.query(*predicates)), repeats))
+        print("{:34} {:>10.1f}ms {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms".format(label, *(t*1e3 for t in times)))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
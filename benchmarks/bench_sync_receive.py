@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure :meth:`Synchronizable.sync_construct` followed by
+:meth:`Synchronizable.sync_receive_constructed` for classes with 5, 30
+and 100 properties, two of them passed to the constructor.  A fifth
+of the properties are UUIDs with a decoder.  Also measure a forwarding
+hop, receiving then encoding again, with and without
+:class:`SyncLazyDecodeMixin`.
+
+    python3 benchmarks/bench_sync_receive.py [iterations]
+'''
+
+import sys, timeit, uuid
+from entanglement import Synchronizable, sync_property
+from entanglement.interface import SyncLazyDecodeMixin
+
+def make_class(properties, base = Synchronizable):
+    def __init__(self, p1 = None, p2 = None):
+        self.p1 = p1
+        self.p2 = p2
+    ns = {'__module__': __name__, '__annotations__': {}, '__init__': __init__}
+    for i in range(properties):
+        if i%5 == 0:
+            ns['__annotations__']['p{}'.format(i)] = uuid.UUID
+        ns['p{}'.format(i)] = sync_property(constructor = {1: 1, 2: True}.get(i, False))
+    return type('Properties{}'.format(properties), (base,), ns)
+
+def make_message(properties):
+    msg = {'_sync_type': 'Properties{}'.format(properties)}
+    for i in range(properties):
+        msg['p{}'.format(i)] = str(uuid.uuid4()) if i%5 == 0 else i
+    return msg
+
+def receive(cls, msg):
+    msg = dict(msg)
+    obj = cls.sync_construct(msg)
+    obj.sync_receive_constructed(msg)
+    return obj
+
+def forward(cls, msg):
+    return receive(cls, msg).to_sync()
+
+def main(iterations = 20000):
+    for properties in (5, 30, 100):
+        cls = make_class(properties)
+        msg = make_message(properties)
+        assert receive(cls, msg).p2 == 2
+        elapsed = timeit.timeit(lambda: receive(cls, msg), number = iterations)
+        print("{:3} properties: {:8.0f} objects/s".format(properties, iterations/elapsed))
+        for base in (Synchronizable, SyncLazyDecodeMixin):
+            cls = make_class(properties, base)
+            elapsed = timeit.timeit(lambda: forward(cls, msg), number = iterations)
+            print("{:3} properties, forwarded by {}: {:8.0f} objects/s".format(
+                properties, base.__name__, iterations/elapsed))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
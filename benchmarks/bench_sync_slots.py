@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure memory per object, with and without *sync_slots*, for
+objects with 3 and 10 properties besides the owner: the objects alone,
+and held in a :class:`SyncStoreRegistry` store, whose index also
+takes memory.
+
+    python3 benchmarks/bench_sync_slots.py [objects]
+'''
+
+import sys, tracemalloc, uuid
+from entanglement import sync_property
+from entanglement.memory import StoreInSyncStoreMixin, SyncStoreRegistry
+
+registry = SyncStoreRegistry()
+
+def make_class(properties, slots):
+    ns = {'__module__': __name__, 'sync_registry': registry,
+          'sync_slots': slots, 'sync_primary_keys': ('p0',)}
+    for i in range(properties):
+        ns['p{}'.format(i)] = sync_property()
+    return type('Properties{}{}'.format(properties, 'Slotted' if slots else ''),
+                (StoreInSyncStoreMixin,), ns)
+
+def measure(cls, properties, objects, store):
+    owner = uuid.uuid4()
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(objects):
+        obj = cls()
+        obj._sync_owner = owner
+        for p in range(properties):
+            setattr(obj, 'p{}'.format(p), i if p == 0 else p)
+        if store: registry.add_to_store(obj)
+        else: kept.append(obj)
+    used = tracemalloc.get_traced_memory()[0]-before
+    tracemalloc.stop()
+    registry.stores_by_class.clear()
+    return used/objects
+
+def main(objects = 100000):
+    for properties in (3, 10):
+        classes = make_class(properties, False), make_class(properties, True)
+        for store in (False, True):
+            plain, slotted = (measure(cls, properties, objects, store) for cls in classes)
+            print("{:2} properties{:9}: {:4.0f} bytes/object, {:4.0f} with sync_slots ({:.0%} saved)".format(
+                properties, ' in store' if store else '', plain, slotted, 1-slotted/plain))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure the cost of :meth:`SyncManager.synchronize` fanning an
+object out to many connected destinations, without any network I/O.
+
+    python3 benchmarks/bench_synchronize.py [destinations] [calls]
+'''
+
+import os, sys, time
+from entanglement import SyncManager, SyncRegistry, Synchronizable, sync_property, SyncDestination, DestHash
+
+registry = SyncRegistry()
+
+class Point(Synchronizable):
+
+    sync_registry = registry
+    sync_primary_keys = ('id',)
+    id = sync_property()
+
+class FakeProtocol:
+
+    def _synchronize_object(self, obj, **kwargs): pass
+
+    def close(self): pass
+
+def main(destinations = 1000, calls = 2000):
+    manager = SyncManager(None, 0, registries = [registry])
+    for i in range(destinations):
+        dest = SyncDestination(DestHash(os.urandom(32)), str(i))
+        manager.add_destination(dest)
+        # Look connected without a connection
+        dest.protocol = FakeProtocol()
+        manager._connections[DestHash(str(dest.dest_hash))] = dest.protocol
+    point = Point()
+    point.id = 1
+    start = time.perf_counter()
+    for i in range(calls):
+        manager.synchronize(point)
+    elapsed = time.perf_counter() - start
+    print("{:.1f} us/destination ({} destinations, {} calls)".format(
+        elapsed/calls/destinations*1e6, destinations, calls))
+    manager.close()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
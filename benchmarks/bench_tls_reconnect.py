@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure how long a client takes to reconnect to a local
+:class:`SyncServer`, with and without resuming the previous TLS session.
+
+    python3 benchmarks/bench_tls_reconnect.py [reconnects] [port]
+'''
+
+import asyncio, os.path, sys, tempfile, time
+from entanglement import SyncManager, SyncServer, SyncDestination, certhash_from_file, pki
+
+def reconnect(client, dest, resume):
+    protocol, = client.connections
+    dest.connect_at = 0
+    start = time.perf_counter()
+    protocol.close()
+    if not resume: client._tls_sessions.clear()
+    client.run_until_complete(asyncio.wait(client._connecting.values()))
+    elapsed = time.perf_counter()-start
+    ssl_object = client.connections[0].transport.get_extra_info('ssl_object')
+    assert ssl_object.session_reused == resume
+    return elapsed
+
+def main(count = 200, port = 9119):
+    with tempfile.TemporaryDirectory() as pki_dir:
+        for name in ('server', 'client'):
+            pki.host_cert(pki_dir, name, "")
+        files = lambda name: dict(cert = os.path.join(pki_dir, name+'.pem'),
+                                  key = os.path.join(pki_dir, name+'.key'),
+                                  cafile = os.path.join(pki_dir, 'ca.pem'))
+        loop = asyncio.new_event_loop()
+        server = SyncServer(port = port, loop = loop, **files('server'))
+        server.listen_ssl(host = '127.0.0.1')
+        server.add_destination(SyncDestination(certhash_from_file(files('client')['cert']), 'client'))
+        client = SyncManager(port = port, loop = loop, **files('client'))
+        dest = SyncDestination(certhash_from_file(files('server')['cert']), 'server',
+                               host = '127.0.0.1', server_hostname = 'server')
+        client.run_until_complete(client.add_destination(dest))
+        try:
+            for resume in (False, True):
+                elapsed = sum(reconnect(client, dest, resume) for i in range(count))
+                print("resume={}: {:.2f} ms/reconnect".format(resume, elapsed/count*1000))
+        finally:
+            client.close()
+            server.close()
+            loop.close()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
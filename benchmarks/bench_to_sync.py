@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure :meth:`Synchronizable.to_sync` with generated encoders
+against the general property loop, for classes with 5, 30 and 100
+properties, encoding all of them and a subset of two.  A fifth of the
+properties are UUIDs with an encoder.
+
+    python3 benchmarks/bench_to_sync.py [iterations]
+'''
+
+import sys, timeit, uuid
+from entanglement import Synchronizable, sync_property
+
+def make_class(properties):
+    ns = {'__module__': __name__, '__annotations__': {}}
+    for i in range(properties):
+        if i%5 == 0:
+            ns['__annotations__']['p{}'.format(i)] = uuid.UUID
+        ns['p{}'.format(i)] = sync_property()
+    return type('Properties{}'.format(properties), (Synchronizable,), ns)
+
+def make_object(cls, properties):
+    obj = cls()
+    for i in range(properties):
+        setattr(obj, 'p{}'.format(i), uuid.uuid4() if i%5 == 0 else i)
+    return obj
+
+def main(iterations = 20000):
+    for properties in (5, 30, 100):
+        obj = make_object(make_class(properties), properties)
+        for attributes in (None, ('p0', 'p1')):
+            assert obj.to_sync(attributes) == obj._sync_encode_properties(attributes)
+            general = timeit.timeit(lambda: obj._sync_encode_properties(attributes), number = iterations)
+            generated = timeit.timeit(lambda: obj.to_sync(attributes), number = iterations)
+            print("{:3} properties, {:6}: general {:8.0f}/s generated {:8.0f}/s ({:.1f}x)".format(
+                properties, 'all' if attributes is None else 'subset',
+                iterations/general, iterations/generated, general/generated))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
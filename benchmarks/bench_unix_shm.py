@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Measure messages per second from a client to a :class:`SyncServer`
+over a unix socket, with and without shared memory rings.
+
+    python3 benchmarks/bench_unix_shm.py [messages]
+'''
+
+import asyncio, os, os.path, sys, tempfile, time
+from entanglement import SyncManager, SyncServer, SyncRegistry, Synchronizable, sync_property
+from entanglement import DestHash, SyncDestination, OutgoingUnixDestination
+
+class Registry(SyncRegistry):
+
+    def sync_receive(self, obj, **info):
+        self.received += 1
+        if self.received == self.expected: self.done.set_result(None)
+
+registry = Registry()
+
+class Sample(Synchronizable):
+
+    sync_registry = registry
+    sync_primary_keys = ('id',)
+    id = sync_property()
+    value = sync_property()
+
+def run(path, messages, shm_ring_size):
+    loop = asyncio.new_event_loop()
+    server_registry = Registry()
+    server_registry.registry = registry.registry
+    server = SyncServer(None, 0, loop = loop, registries = [server_registry])
+    server.listen_unix(path)
+    server.add_destination(SyncDestination(
+        DestHash.from_unix_dest_info(path, os.getpid(), os.getuid(), os.getgid()), 'client'))
+    client = SyncManager(None, 0, loop = loop, registries = [registry])
+    client.shm_ring_size = shm_ring_size
+    client.run_until_complete(client.add_destination(
+        OutgoingUnixDestination(DestHash(os.urandom(32)), 'server', path)))
+    loop.run_until_complete(asyncio.sleep(0.1))
+    server_registry.received = 0
+    server_registry.expected = messages
+    server_registry.done = loop.create_future()
+    start = time.perf_counter()
+    for i in range(messages):
+        sample = Sample()
+        sample.id = i
+        sample.value = i
+        client.synchronize(sample)
+    loop.run_until_complete(server_registry.done)
+    elapsed = time.perf_counter()-start
+    client.close()
+    server.close()
+    loop.close()
+    os.unlink(path)
+    return messages/elapsed
+
+def main(messages = 50000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sock')
+        for shm_ring_size in (None, SyncManager.shm_ring_size):
+            rate = run(path, messages, shm_ring_size)
+            print("shm_ring_size={}: {:.0f} messages/s".format(shm_ring_size, rate))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
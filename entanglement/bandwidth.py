@@ -9,11 +9,488 @@
 
 
 
-import asyncio
+import asyncio, collections, math
+
+class BandwidthBudget:
+
+    '''A node in a tree of token buckets shared by connections, such as
+    a manager's total uplink, a group of destinations within it, and
+    each destination.  What a connection writes is charged to its
+    budget and every ancestor; while any of them is in debt the
+    connection is paused.  A budget without *chars_per_sec* only
+    counts.
+
+    When a budget is repaid, the connections waiting on it resume one
+    at a time in order of how much their part of the tree has recently sent
+    relative to its *weight*, compared first among this budget's
+    children and then further down.  Those that have had least go
+    first, so siblings converge on shares in proportion to their
+    weights.
+    '''
+
+    #: Seconds over which recent use is averaged for fair sharing and :attr:`rate`
+    usage_time = 1.0
+
+    def __init__(self, name, chars_per_sec = None, *, loop,
+                 burst = None, weight = 1, parent = None):
+        self.name = name
+        self.loop = loop
+        self._burst = burst
+        self.chars_per_sec = chars_per_sec
+        self.weight = weight
+        self.parent = parent
+        self.children = []
+        if parent is not None: parent.children.append(self)
+        self.tokens = self.burst
+        self._stamp = loop.time()
+        self.usage = 0.0
+        self._usage_stamp = self._stamp
+        #: Characters charged to this budget
+        self.chars = 0
+        #: Times a connection has paused waiting on this budget
+        self.pauses = 0
+        self.waiting = set()
+        self.timer_handle = None
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.name)
+
+    @property
+    def chars_per_sec(self):
+        return self._chars_per_sec
+
+    @chars_per_sec.setter
+    def chars_per_sec(self, value):
+        # Tokens earned so far were earned at the old rate
+        limited = getattr(self, '_chars_per_sec', None) is not None
+        if limited: self._refill()
+        self._chars_per_sec = value
+        if not limited and value is not None:
+            self.tokens = self.burst
+            self._stamp = self.loop.time()
+        if getattr(self, 'timer_handle', None) is not None:
+            # Those waiting are repaid at the new rate, or at once without a limit
+            self.timer_handle.cancel()
+            self.timer_handle = self.loop.call_soon(self._repaid)
+
+    @property
+    def burst(self):
+        if self._burst is not None: return self._burst
+        if self.chars_per_sec is None: return 0
+        return self.chars_per_sec*BwLimitMonitor.burst_time
+
+    @burst.setter
+    def burst(self, value):
+        self._burst = value
+
+    @property
+    def rate(self):
+        "Characters per second recently charged"
+        self._decay()
+        return self.usage/self.usage_time
+
+    def child(self, name, chars_per_sec = None, **kwargs):
+        return self.__class__(name, chars_per_sec, loop = self.loop, parent = self, **kwargs)
+
+    def remove(self):
+        "Remove from the tree once nothing uses this budget"
+        if self.parent is not None:
+            self.parent.children.remove(self)
+            self.parent = None
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst, self.tokens+(now-self._stamp)*self.chars_per_sec)
+        self._stamp = now
+
+    def _decay(self):
+        now = self.loop.time()
+        self.usage *= math.exp((self._usage_stamp-now)/self.usage_time)
+        self._usage_stamp = now
+
+    def charge(self, chars):
+        """Charge *chars* here and to each ancestor.  Returns the
+        budget nearest the root that is now in debt, or None.
+        """
+        blocked = self.parent.charge(chars) if self.parent else None
+        self._decay()
+        self.usage += chars
+        self.chars += chars
+        if self.chars_per_sec is None: return blocked
+        self._refill()
+        self.tokens -= chars
+        if blocked is None and self.tokens < 0: return self
+        return blocked
+
+    def blocking(self):
+        "The budget nearest the root among this and its ancestors that is in debt, or None"
+        blocked = self.parent.blocking() if self.parent else None
+        if blocked is None and self.chars_per_sec is not None:
+            self._refill()
+            if self.tokens < 0: return self
+        return blocked
+
+    def wait(self, monitor):
+        "Pause *monitor* until this budget is repaid"
+        self.waiting.add(monitor)
+        self.pauses += 1
+        if self.timer_handle is None:
+            self.timer_handle = self.loop.call_later(
+                max(-self.tokens/self.chars_per_sec, 0), self._repaid)
+
+    def forget(self, monitor):
+        self.waiting.discard(monitor)
+
+    def _repaid(self):
+        # Release one connection at a time so that whichever has had
+        # least gets to write before the others.  The next is
+        # considered once it has had a chance to.
+        self.timer_handle = None
+        if not self.waiting: return
+        if self.chars_per_sec is not None:
+            self._refill()
+            if self.tokens < 0:
+                self.timer_handle = self.loop.call_later(-self.tokens/self.chars_per_sec, self._repaid)
+                return
+        now = self.loop.time()
+        monitor = min(self.waiting, key = lambda m: m.budget._share_key(self, now))
+        self.waiting.remove(monitor)
+        monitor._budget_released()
+        if self.waiting and self.timer_handle is None:
+            self.timer_handle = self.loop.call_soon(self._repaid)
+
+    def _share_key(self, top, now):
+        # Recent use relative to weight at each level below *top*, as
+        # of *now* so that siblings are compared at the same moment
+        key = []
+        budget = self
+        while budget is not None and budget is not top:
+            usage = budget.usage*math.exp((budget._usage_stamp-now)/budget.usage_time)
+            key.append(usage/budget.weight)
+            budget = budget.parent
+        key.reverse()
+        return key
+
+    def counters(self):
+        "Counters for this budget and, under *children*, each budget below it"
+        if self.chars_per_sec is not None: self._refill()
+        return dict(
+            name = self.name,
+            chars_per_sec = self.chars_per_sec,
+            weight = self.weight,
+            tokens = self.tokens,
+            chars = self.chars,
+            rate = self.rate,
+            pauses = self.pauses,
+            waiting = len(self.waiting),
+            children = [c.counters() for c in self.children])
+
 
 class BwLimitMonitor:
 
-    '''A monitor that calls pause_writing when more than the allocated bandwidth is used.'''
+    '''A token bucket that calls pause_writing on *protocol* when more
+    than the allocated bandwidth is used.  Tokens (characters) accrue
+    at *chars_per_sec* up to *burst*.  Writes spend them; when they run
+    out writing pauses, and it resumes at the moment enough have
+    accrued rather than at a fixed interval.  *burst* defaults to
+    :attr:`burst_time` seconds of traffic.  If *budget* is set to a
+    :class:`BandwidthBudget`, writes are also charged to it and
+    writing pauses while it or an ancestor is in debt.
+    '''
+
+    #: The default burst in seconds at the configured rate
+    burst_time = 0.1
+
+    #: The :class:`BandwidthBudget` shared with other connections, if any
+    budget = None
+    #: The :class:`AdaptiveRateController` setting *chars_per_sec*, if any
+    controller = None
+
+    def __init__(self, *, loop, chars_per_sec, burst = None, bw_quantum = 0.1):
+        self.loop = loop
+        self._burst = burst
+        self.chars_per_sec = chars_per_sec
+        #: Only used to interpret :attr:`bw_per_quantum`
+        self.bw_quantum = bw_quantum
+        self.tokens = self.burst
+        self._stamp = loop.time()
+        self.timer_handle = None
+        self._paused = False
+        self._transport_paused = False
+        self._budget_wait = None
+        #: Characters written
+        self.chars = 0
+
+    @property
+    def burst(self):
+        if self._burst is not None: return self._burst
+        return self.chars_per_sec*self.burst_time
+
+    @burst.setter
+    def burst(self, value):
+        self._burst = value
+
+    @property
+    def bw_per_quantum(self):
+        "For compatibility with :class:`QuantumBwLimitMonitor`: characters per *bw_quantum*"
+        return self.chars_per_sec*self.bw_quantum
+
+    @bw_per_quantum.setter
+    def bw_per_quantum(self, value):
+        self.chars_per_sec = value/self.bw_quantum
+
+    def pause_writing(self):
+        self._transport_paused = True
+        return self._maybe_pause()
+
+    def resume_writing(self):
+        self._transport_paused = False
+        return self._maybe_resume()
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst, self.tokens+(now-self._stamp)*self.chars_per_sec)
+        self._stamp = now
+
+    def _schedule_resume(self):
+        # Exactly when the bucket will no longer be in debt
+        if self.timer_handle is None and self.tokens < 0:
+            self.timer_handle = self.loop.call_later(
+                -self.tokens/self.chars_per_sec, self._refilled)
+
+    def _maybe_pause(self):
+        if self._paused: return
+        self._paused = True
+        self._schedule_resume()
+        return self.protocol.pause_writing()
+
+    def _maybe_resume(self):
+        if self._transport_paused or self._budget_wait or not self._paused: return
+        self._refill()
+        if self.tokens >= 0:
+            if self.timer_handle:
+                self.timer_handle.cancel()
+                self.timer_handle = None
+            self._paused = False
+            self.protocol.resume_writing()
+        else: self._schedule_resume()
+
+    def _refilled(self):
+        self.timer_handle = None
+        self._maybe_resume()
+
+    def _wait_budget(self, budget):
+        if self._budget_wait is not None: return
+        self._budget_wait = budget
+        budget.wait(self)
+        self._maybe_pause()
+
+    def _budget_released(self):
+        self._budget_wait = None
+        blocked = self.budget.blocking()
+        if blocked is not None: return self._wait_budget(blocked)
+        self._maybe_resume()
+
+    def _forget_budget(self):
+        if self._budget_wait is not None:
+            self._budget_wait.forget(self)
+            self._budget_wait = None
+
+    def close(self):
+        "Stop timers and leave the budget once the connection is gone"
+        if self.timer_handle:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        self._forget_budget()
+        if self.controller: self.controller.stop()
+
+    def bw_used(self, chars):
+        self._refill()
+        self.tokens -= chars
+        self.chars += chars
+        if self.budget is not None:
+            blocked = self.budget.charge(chars)
+            if blocked is not None: self._wait_budget(blocked)
+        if self.tokens < 0:
+            self._maybe_pause()
+
+
+class AdaptiveRateController:
+
+    '''Adjusts the rate of *monitor* to what the path to the peer can
+    carry, in the manner of delay-based congestion control.  Every
+    *interval* it measures how fast *transport*'s write buffer drained
+    and so how long what is queued there will take to send.  While that
+    queueing delay stays under *target_delay* and the connection is
+    using its rate, the rate grows by a factor of *increase*, or of
+    *startup_increase* until the first time the queue builds.  When the
+    queue takes longer than *target_delay* to drain, or the round trip
+    time measured by keepalives rises that far above the lowest seen,
+    the rate drops to *decrease* times the drain rate, emptying the
+    queue.  The rate stays between *min_rate* and *ceiling*.
+    '''
+
+    interval = 0.1
+    target_delay = 0.05
+    increase = 1.1
+    startup_increase = 1.5
+    decrease = 0.9
+    min_rate = 1000
+    #: The rate to start from, if below *ceiling*
+    initial_rate = 64*1024
+    #: Intervals over which the highest drain rate estimates the path's capacity
+    capacity_window = 10
+
+    def __init__(self, monitor, transport, *, ceiling):
+        self.monitor = monitor
+        self.transport = transport
+        self.loop = monitor.loop
+        self.ceiling = ceiling
+        monitor.controller = self
+        monitor.chars_per_sec = self.rate = min(ceiling, self.initial_rate)
+        #: Recent drain rates in characters per second
+        self.drain_rates = collections.deque(maxlen = self.capacity_window)
+        self.queue_delay = 0
+        self.min_rtt = None
+        self.starting = True
+        self._chars = monitor.chars
+        self._buffered = transport.get_write_buffer_size()
+        self._stamp = self.loop.time()
+        self.timer_handle = self.loop.call_later(self.interval, self._sample)
+
+    def stop(self):
+        if self.timer_handle:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+
+    @property
+    def capacity(self):
+        "The highest recent drain rate"
+        return max(self.drain_rates, default = 0)
+
+    def _sample(self):
+        now = self.loop.time()
+        elapsed = max(now-self._stamp, 1e-6)
+        written = self.monitor.chars-self._chars
+        buffered = self.transport.get_write_buffer_size()
+        # An idle interval says nothing about the path, so capacity
+        #stays what was last measured while sending.
+        if written or self._buffered or buffered:
+            self.drain_rates.append((written+self._buffered-buffered)/elapsed)
+        self.queue_delay = buffered/max(self.capacity, self.min_rate)
+        rtt = getattr(self.monitor.protocol, 'srtt', None)
+        if rtt is not None:
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if self.queue_delay > self.target_delay \
+           or (rtt is not None and rtt > self.min_rtt+self.target_delay):
+            self.rate = min(self.rate, self.capacity or self.rate)*self.decrease
+            self.starting = False
+        elif written >= self.rate*elapsed/2:
+            self.rate *= self.startup_increase if self.starting else self.increase
+        self.rate = max(self.min_rate, min(self.ceiling, self.rate))
+        self.monitor.chars_per_sec = self.rate
+        self._chars = self.monitor.chars
+        self._buffered = buffered
+        self._stamp = now
+        self.timer_handle = self.loop.call_later(self.interval, self._sample)
+
+    def counters(self):
+        return dict(
+            rate = self.rate,
+            ceiling = self.ceiling,
+            capacity = self.capacity,
+            queue_delay = self.queue_delay,
+            min_rtt = self.min_rtt)
+
+
+class BwLimitTransport(asyncio.Transport):
+
+    '''Wraps *transport*, charging what is written to *monitor*.'''
+
+    def __init__(self, transport, monitor):
+        super().__init__()
+        self._transport = transport
+        self._monitor = monitor
+
+    def write(self, data):
+        self._transport.write(data)
+        self._monitor.bw_used(len(data))
+
+    def writelines(self, list_of_data):
+        self.write(b''.join(list_of_data))
+
+    def get_extra_info(self, name, default = None):
+        return self._transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self._transport.is_closing()
+
+    def close(self):
+        return self._transport.close()
+
+    def abort(self):
+        return self._transport.abort()
+
+    def is_reading(self):
+        return self._transport.is_reading()
+
+    def pause_reading(self):
+        return self._transport.pause_reading()
+
+    def resume_reading(self):
+        return self._transport.resume_reading()
+
+    def set_write_buffer_limits(self, high = None, low = None):
+        return self._transport.set_write_buffer_limits(high = high, low = low)
+
+    def get_write_buffer_size(self):
+        return self._transport.get_write_buffer_size()
+
+    def get_write_buffer_limits(self):
+        return self._transport.get_write_buffer_limits()
+
+    def can_write_eof(self):
+        return self._transport.can_write_eof()
+
+    def write_eof(self):
+        return self._transport.write_eof()
+
+
+class BwLimitProtocol(BwLimitMonitor, asyncio.Protocol):
+
+    '''Sits between an asyncio transport and *upper_protocol*, which
+    sees a :class:`BwLimitTransport` and is paused both when the
+    transport's buffer fills and when the bandwidth is used up.'''
+
+    def __init__(self, *, upper_protocol, **kwargs):
+        BwLimitMonitor.__init__(self, **kwargs)
+        self.protocol = upper_protocol
+
+    def data_received(self, data):
+        return self.protocol.data_received(data)
+
+    def connection_made(self, transport):
+        self.transport = BwLimitTransport(transport, self)
+        try: res =  self.protocol.connection_made(self.transport, bwprotocol = self)
+        except TypeError: res = self.protocol.connection_made(self.transport)
+        return res
+
+    def connection_lost(self, exc):
+        self.close()
+        if hasattr(self.protocol, 'connection_lost'):
+            return self.protocol.connection_lost(exc)
+
+    def eof_received(self):
+        return self.protocol.eof_received()
+
+
+
+class QuantumBwLimitMonitor:
+
+    '''A monitor that calls pause_writing when more than the allocated
+    bandwidth is used in a *bw_quantum*.  This was the limiter before
+    :class:`BwLimitMonitor`; usage is counted in fixed windows so
+    sending stops and starts at window boundaries.'''
 
     def __init__(self, *, loop, chars_per_sec, bw_quantum):
         self.loop = loop
@@ -25,6 +502,14 @@ class BwLimitMonitor:
         self._paused = False
         self._transport_paused = False
 
+    @property
+    def chars_per_sec(self):
+        return self.bw_per_quantum/self.bw_quantum
+
+    @chars_per_sec.setter
+    def chars_per_sec(self, value):
+        self.bw_per_quantum = value*self.bw_quantum
+
     def pause_writing(self):
         self._transport_paused = True
         return self._maybe_pause()
@@ -71,10 +556,10 @@ class BwLimitMonitor:
 
 
 
-class BwLimitProtocol(BwLimitMonitor, asyncio.Protocol):
+class QuantumBwLimitProtocol(QuantumBwLimitMonitor, asyncio.Protocol):
 
     def __init__(self, *, upper_protocol, **kwargs):
-        BwLimitMonitor.__init__(self, **kwargs)
+        QuantumBwLimitMonitor.__init__(self, **kwargs)
         self.protocol = upper_protocol
 
     def data_received(self, data):
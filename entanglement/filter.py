@@ -9,7 +9,7 @@ import dataclasses
 import collections.abc
 from .network import SyncDestinationBase, SyncDestination
 from .interface import Synchronizable
-from .memory import key_for
+from .memory import key_for, And, Equal
 
 class AllSentItemsSet(collections.abc.MutableSet):
 
@@ -185,18 +185,32 @@ class FilterBase:
 
 class Filter(FilterBase):
 
+    '''Calls *filter* for each object.  If *where* is a
+    :class:`~entanglement.memory.Predicate` or a dict of attribute
+    values, the filter is neutral on objects not matching it; with a
+    *store*, :meth:`all_objects` then finds the objects with
+    :meth:`~entanglement.memory.AbstractSyncStore.query` rather than
+    scanning the store.
+    '''
+
     def __init__(self, filter, *,
                  store=None, type=None,
                  registry=None,
+                 where=None,
                  **kwargs):
         super().__init__(**kwargs)
         self.filter = filter
         self.store = store
         self.type = type
         self.registry = registry
+        if isinstance(where, dict):
+            where = And(*(Equal(k, v) for k, v in where.items()))
+        self.where = where
 
     def all_objects(self):
-        if self.store: yield from self.store.values()
+        if self.store and self.where:
+            yield from self.store.query(self.where)
+        elif self.store: yield from self.store.values()
         elif self.registry and hasattr(self.registry, 'stores_by_class'):
             for store in self.registry.stores_by_class.values():
                 yield from store.values()
@@ -207,6 +221,8 @@ class Filter(FilterBase):
             return None
         if self.registry  and o.sync_type not in self.registry.registry:
             return None
+        if self.where and not self.where.matches(o):
+            return None
         return self.filter(o)
 
 class SyncOwnerFilter(FilterBase):
@@ -229,9 +245,15 @@ class FilteredSyncDestination(SyncDestination, FilteredDestinationMixin):
 
     async def connected(self, manager, *args, **kwargs):
         res = await super().connected(manager, *args, **kwargs)
-        manager.loop.create_task(self.send_initial_objects(manager))
+        manager.loop.create_task(self._send_initial_unless_resumed(manager, self.protocol))
         return res
 
+    async def _send_initial_unless_resumed(self, manager, protocol):
+        # A resumed session has replayed everything the peer missed
+        resumed = getattr(protocol, 'resumed', None)
+        if resumed is not None and await resumed: return
+        await self.send_initial_objects(manager)
+
 def synthesize_withdrawl(o, manager, destination):
     manager.synchronize(o, attributes_to_sync=o.sync_primary_keys, destinations=[destination], operation='delete')
     
@@ -7,9 +7,9 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
 
-import asyncio, contextlib, sys, types
+import asyncio, contextlib, hashlib, inspect, json, sys, types
 from typing import get_type_hints
-from .types import type_map
+from .types import type_map, wire_codecs, encode_column
 
 
 
@@ -75,7 +75,14 @@ class SynchronizableMeta(type):
                     ns[k] = v.wraps
                 else: del ns[k]
         ns['_sync_meta'] = sync_meta
-        return type.__new__(cls, name, bases, ns, **kwargs)
+        slot_defaults = {}
+        if '__slots__' not in ns and ns.get(
+                'sync_slots', any(getattr(b, 'sync_slots', False) for b in bases)):
+            ns['__slots__'], slot_defaults = _sync_slots(bases, ns, sync_meta)
+        new_cls = type.__new__(cls, name, bases, ns, **kwargs)
+        for k, default in slot_defaults.items():
+            setattr(new_cls, k, _SlotDefault(new_cls.__dict__[k], default))
+        return new_cls
 
     sync_registry = property(doc = "A registry of classes that this Syncable belongs to.  Registries can be associated with a connection; only classes in registries associated with a connection are permitted to be synchronized over that connection")
 
@@ -103,6 +110,189 @@ class SynchronizableMeta(type):
         cls._sync_properties_cache = types.MappingProxyType(d)
         return cls._sync_properties_cache
 
+    #: The most attribute subsets for which each class keeps a generated encoder
+    sync_encoder_cache_size = 128
+
+    def _sync_encoder(cls, attributes = None):
+        '''Return a function encoding instances of *cls* as
+        :meth:`Synchronizable.to_sync` does for *attributes*.  Encoders
+        are generated when first needed and kept until
+        :attr:`_sync_properties` changes; call :meth:`_sync_invalidate`
+        after changing a property's encoder.
+        '''
+        class_dict = cls.__dict__
+        properties = class_dict.get('_sync_properties_cache') or cls._sync_properties
+        encoders = class_dict.get('_sync_encoders')
+        if encoders is None or encoders[0] is not properties:
+            encoders = (properties, {})
+            cls._sync_encoders = encoders
+        if not attributes:
+            try: return encoders[1][None]
+            except KeyError: pass
+        if attributes:
+            key = frozenset(attributes).intersection(properties)
+            if '_sync_owner' in properties: key |= {'_sync_owner'}
+        else: key = None
+        try: return encoders[1][key]
+        except KeyError: pass
+        if len(encoders[1]) >= cls.sync_encoder_cache_size: encoders[1].clear()
+        encoder = _generate_encoder(cls, properties, key)
+        encoders[1][key] = encoder
+        return encoder
+
+    def _sync_encode_columns(cls, objs, attributes = None):
+        '''Return a dict mapping each property to a list of its encoding
+        for each of *objs*, as :meth:`Synchronizable.to_sync` would
+        encode them one at a time, or None if some of *objs* have a
+        property that others lack.  Values are read and encoded a
+        column at a time, with the column encoders registered with
+        :func:`entanglement.types.register_column_encoder`.
+        '''
+        columns = {}
+        for k, prop in cls._sync_properties.items():
+            if attributes and k not in attributes and k != '_sync_owner': continue
+            values = [getattr(o, k, NotPresent) for o in objs]
+            present = [v is not NotPresent for v in values]
+            if not any(present): continue
+            if not all(present): return None
+            if prop.encoderfn: values = encode_column(prop.encoderfn, values)
+            else:
+                values = [val.sync_encode_value() if val is not None and val.__class__ not in _plain_types
+                          and hasattr(val, 'sync_encode_value') else val
+                          for val in values]
+            columns[k] = values
+        return columns
+
+    def _sync_decoders(cls):
+        '''Return a mapping from each sync property of *cls* to its
+        decoder, and the constructor plan used by
+        :meth:`Synchronizable.sync_construct`: the number of positional
+        arguments and a tuple of (key, decoder, index) for each
+        constructor property, index being None for keywords.  Kept
+        like the encoders from :meth:`_sync_encoder`.
+        '''
+        class_dict = cls.__dict__
+        properties = class_dict.get('_sync_properties_cache') or cls._sync_properties
+        decoders = class_dict.get('_sync_decoders_cache')
+        if decoders is not None and decoders[0] is properties:
+            return decoders[1], decoders[2]
+        table = {}
+        constructed = []
+        positional = 0
+        for k, prop in properties.items():
+            decoder = table[k] = prop.decoderfn or _no_decoder
+            if not prop.constructor: continue
+            # sadly isinstance(True, int) is True
+            if prop.constructor is True:
+                constructed.append((k, decoder, None))
+            else:
+                positional = max(positional, prop.constructor)
+                constructed.append((k, decoder, prop.constructor-1))
+        plan = (positional, tuple(constructed))
+        cls._sync_decoders_cache = (properties, table, plan)
+        return table, plan
+
+    def _sync_schema(cls):
+        '''Return the names of the sync properties of *cls* in sorted
+        order, the order of positional encodings, and a fingerprint of
+        them that peers compare before using that order.
+        '''
+        properties = cls._sync_properties
+        schema = cls.__dict__.get('_sync_schema_cache')
+        if schema is None or schema[0] is not properties:
+            names = tuple(sorted(properties))
+            fingerprint = hashlib.blake2b('\0'.join((cls.sync_type,)+names).encode('utf-8'),
+                                          digest_size = 8).hexdigest()
+            schema = (properties, names, fingerprint)
+            cls._sync_schema_cache = schema
+        return schema[1], schema[2]
+
+    def _sync_invalidate(cls):
+        "Discard generated encoders and decoder tables for *cls* and its subclasses"
+        if '_sync_encoders' in cls.__dict__: del cls._sync_encoders
+        if '_sync_decoders_cache' in cls.__dict__: del cls._sync_decoders_cache
+        for c in cls.__subclasses__(): c._sync_invalidate()
+
+def _no_decoder(val): return val
+
+# Values that cannot have sync_encode_value, so need not be checked for it
+_plain_types = frozenset((str, int, float, bool, list, dict, tuple))
+
+def _generate_encoder(cls, properties, names):
+    # Unrolls the loop in Synchronizable._sync_encode_properties for
+    #the properties in *names* (all if None), binding encoders and
+    #error messages as globals of the generated function.
+    namespace = dict(NotPresent = NotPresent, plain_types = _plain_types)
+    lines = ['def encode(self):', '    d = {}']
+    for i, (k, prop) in enumerate(properties.items()):
+        if names is not None and k not in names: continue
+        namespace['failed_{}'.format(i)] = "Failed encoding {} using encoder from class {}".format(
+            k, prop.declaring_class)
+        lines.append('    try:')
+        lines.append('        val = getattr(self, {!r}, NotPresent)'.format(k))
+        if prop.encoderfn:
+            namespace['encoder_{}'.format(i)] = prop.encoderfn
+            lines.append('        if val is not None and val is not NotPresent: val = encoder_{}(val)'.format(i))
+        else:
+            lines.append('        if val is not None and val.__class__ not in plain_types '
+                         'and val is not NotPresent and hasattr(val, "sync_encode_value"):')
+            lines.append('            val = val.sync_encode_value()')
+        lines.append('    except BaseException as e:')
+        lines.append('        raise ValueError(failed_{}) from e'.format(i))
+        lines.append('    if val is not NotPresent: d[{!r}] = val'.format(k))
+    lines.append('    return d')
+    code = compile('\n'.join(lines), '<{}.to_sync>'.format(cls.__qualname__), 'exec')
+    exec(code, namespace)
+    return namespace['encode']
+
+def _sync_slots(bases, ns, sync_meta):
+    '''Return the __slots__ for a class with *sync_slots*: its sync
+    properties and those it inherits, plus the
+    *sync_instance_attributes* of it and its bases, less any that a
+    base already provides.  Also return the base class attributes
+    that slots replace, as defaults for them.
+    '''
+    names = [k for k in sync_meta if k not in ns] # Wrapped properties keep their wrapper
+    for base in bases:
+        names.extend(getattr(base, '_sync_properties', ()))
+        for c in base.__mro__:
+            names.extend(c.__dict__.get('sync_instance_attributes', ()))
+    names.extend(ns.get('sync_instance_attributes', ()))
+    slots = []
+    defaults = {}
+    for k in names:
+        if k in slots or k in ns: continue
+        for c in (c for base in bases for c in base.__mro__):
+            if k in c.__dict__:
+                existing = c.__dict__[k]
+                break
+        else: existing = NoWraps
+        if hasattr(type(existing), '__get__'): continue
+        slots.append(k)
+        if existing is not NoWraps: defaults[k] = existing
+    return tuple(slots), defaults
+
+class _SlotDefault:
+
+    # A slot that reads as the class attribute it replaced until it is set
+
+    __slots__ = ('slot', 'default')
+
+    def __init__(self, slot, default):
+        self.slot = slot
+        self.default = default
+
+    def __get__(self, obj, owner = None):
+        if obj is None: return self.default
+        try: return self.slot.__get__(obj, owner)
+        except AttributeError: return self.default
+
+    def __set__(self, obj, value):
+        self.slot.__set__(obj, value)
+
+    def __delete__(self, obj):
+        self.slot.__delete__(obj)
+
 class NoWraps: pass
 
 class sync_property:
@@ -228,10 +418,28 @@ class Synchronizable( metaclass = SynchronizableMeta):
     latest synchronized version will be sent.
 
     '''
+
+    __slots__ = ()
+
+    #: If True, instances keep sync properties in ``__slots__``
+    #rather than a ``__dict__``, saving memory when there are many
+    #objects.  Inherited by subclasses.  Attributes other than sync
+    #properties that instances set must be listed in
+    #*sync_instance_attributes* of the class or a base, and every base
+    #must also have ``__slots__``.
+    sync_slots = False
+
+    #: Attributes other than sync properties stored on instances of
+    #classes with *sync_slots*
+    sync_instance_attributes = ()
     
     def to_sync(self, attributes = None):
 
         '''Return a dictionary containing the attributes of self that should be synchronized.  Attributes can be passed in; if so, then the list of attributes will be limited to those passed in.'''
+        return self.__class__._sync_encoder(attributes)(self)
+
+    def _sync_encode_properties(self, attributes = None):
+        "The general form of :meth:`to_sync` that generated encoders unroll"
         d = {}
         for k,v in self.__class__._sync_properties.items():
             if attributes and k not in attributes and k != '_sync_owner': continue
@@ -270,20 +478,16 @@ class Synchronizable( metaclass = SynchronizableMeta):
         the incoming message.
 
         '''
-        cprops = dict(filter( lambda x: bool(x[1].constructor), cls._sync_properties.items()))
-        maxord = 0
-        for p in cprops.values():
-            # sadly isinstance(True, int) is True
-            #We assume any constructor value that is not True is an int
-            if p.constructor is not True:maxord = max(maxord,p.constructor)
-        args = [None] * maxord
+        positional, constructed = cls._sync_decoders()[1]
+        args = [None] * positional
         kwargs = {}
-        for k,v in cprops.items():
+        for k, decoder, index in constructed:
             if k in msg:
                 try:
-                    if v.constructor is not True: #it's an int
-                        args[v.constructor-1] = v._decode_value(msg[k])
-                    else: kwargs[k] = v._decode_value(msg[k])
+                    val = msg[k]
+                    if val is not None and val is not NotPresent: val = decoder(val)
+                    if index is None: kwargs[k] = val
+                    else: args[index] = val
                     del msg[k]
                 except Exception as e:
                     raise SyncBadEncodingError("Error decoding {}".format(k), msg = msg) from e
@@ -300,13 +504,15 @@ class Synchronizable( metaclass = SynchronizableMeta):
 
     def sync_receive_constructed(self, msg, **kwargs):
         '''Given a constructed object, fill in the remaining fields from a javascript message'''
-        cls = self.__class__
+        decoders = self.__class__._sync_decoders()[0]
         for k, v in msg.items():
-            if k not in cls._sync_properties:
+            try: decoder = decoders[k]
+            except KeyError:
                 if k.startswith('_'): continue
-                raise SyncBadEncodingError('{} unknown property in sync encoding'.format(k), msg = msg)
+                raise SyncBadEncodingError('{} unknown property in sync encoding'.format(k), msg = msg) from None
             try:
-                setattr(self, k, cls._sync_properties[k]._decode_value(v))
+                if v is not None and v is not NotPresent: v = decoder(v)
+                setattr(self, k, v)
             except Exception as e:
                 raise SyncBadEncodingError("Failed to decode {}".format(k),
                                            msg = msg) from e
@@ -368,6 +574,194 @@ class Synchronizable( metaclass = SynchronizableMeta):
     sync_priority = 100 # Lower numbers are sent first
     
 
+class SyncEncodeCacheMixin(Synchronizable):
+
+    '''Keeps what :meth:`to_sync` returns for each set of attributes
+    until the object changes, for objects synchronized repeatedly
+    without changing, such as in I-have resynchronizations and floods
+    to newly connected destinations.
+
+    Every attribute assignment, synchronized or not, bumps
+    :attr:`sync_version`, as do loads, refreshes, including server
+    generated values fetched by a flush, and expiry of
+    :class:`~entanglement.SqlSynchronizable` objects.  A change made
+    without an assignment, such as appending to a list held in a
+    property, must be followed by :meth:`sync_changed`.  Sync
+    properties that wrap a ``property``, and those named in
+    :attr:`sync_encode_volatile`, may change without any assignment, so
+    they are encoded afresh each time.
+    '''
+
+    __slots__ = ()
+    sync_instance_attributes = ('sync_version', '_sync_encoded')
+
+    #: Names of further sync properties to encode afresh every time
+    sync_encode_volatile = ()
+
+    #: The most attribute sets for which an object keeps encodings
+    sync_encode_cache_size = 8
+
+    #: Bumped by each change to the object
+    sync_version = 0
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        object.__setattr__(self, 'sync_version', self.sync_version+1)
+
+    def sync_changed(self):
+        "Note a change not made by assigning an attribute"
+        object.__setattr__(self, 'sync_version', self.sync_version+1)
+
+    @classmethod
+    def _sync_volatile(cls):
+        properties = cls._sync_properties
+        volatile = cls.__dict__.get('_sync_volatile_cache')
+        if volatile is None or volatile[0] is not properties:
+            volatile = (properties, frozenset(
+                k for k in properties if k in cls.sync_encode_volatile
+                or isinstance(inspect.getattr_static(cls, k, None), property)))
+            cls._sync_volatile_cache = volatile
+        return volatile[1]
+
+    def _sync_encode_cache(self):
+        try: return self._sync_encoded
+        except AttributeError:
+            cache = {}
+            object.__setattr__(self, '_sync_encoded', cache)
+            return cache
+
+    def to_sync(self, attributes = None):
+        # Encodings differ with the compact forms agreed with the peer
+        key = (frozenset(attributes) if attributes else None, wire_codecs.get())
+        # Read before encoding; if encoding loads anything the entry is stale
+        version = self.sync_version
+        cache = self._sync_encode_cache()
+        volatile = self._sync_volatile()
+        if key[0] is not None: volatile = volatile & key[0]
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            d = dict(entry[1])
+            if volatile:
+                d.update(self.__class__._sync_encoder(volatile)(self))
+            return d
+        d = super().to_sync(attributes)
+        if len(cache) >= self.sync_encode_cache_size: cache.clear()
+        cache[key] = (version, {k: v for k, v in d.items() if k not in volatile})
+        return d
+
+    def to_sync_json(self, attributes = None):
+        "The JSON text of :meth:`to_sync`, kept like it"
+        key = ('json', frozenset(attributes) if attributes else None, wire_codecs.get())
+        version = self.sync_version
+        cache = self._sync_encode_cache()
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version: return entry[1]
+        js = json.dumps(self.to_sync(attributes))
+        volatile = self._sync_volatile()
+        if key[1] is not None: volatile = volatile & key[1]
+        if not volatile:
+            if len(cache) >= self.sync_encode_cache_size: cache.clear()
+            cache[key] = (version, js)
+        return js
+
+class SyncLazyDecodeMixin(Synchronizable):
+
+    '''Keeps received values as they arrived and decodes each when it
+    is first accessed, for objects whose receivers look at only a few
+    properties, or that are mostly forwarded.  Until a property is
+    accessed or assigned, :meth:`to_sync` sends the value as received
+    to destinations that agreed to at least the compact encodings the
+    sender used (see :data:`entanglement.types.wire_codecs`).
+
+    Constructor properties, those whose names start with an
+    underscore and those with a class attribute of the same name, such
+    as a wrapped ``property``, are decoded on receipt.  A value that
+    fails to decode raises :exc:`SyncBadEncodingError` when it is
+    accessed rather than when it is received.
+    '''
+
+    __slots__ = ()
+    sync_instance_attributes = ('_sync_raw', '_sync_raw_codecs')
+
+    #: Received values not yet decoded, by property
+    _sync_raw = None
+    #: The compact encodings the values in :attr:`_sync_raw` may use
+    _sync_raw_codecs = frozenset()
+
+    @classmethod
+    def _sync_lazy(cls):
+        "Return the properties decoded lazily, and those of them kept in slots"
+        properties = cls._sync_properties
+        lazy = cls.__dict__.get('_sync_lazy_cache')
+        if lazy is None or lazy[0] is not properties:
+            in_dict, in_slots = set(), set()
+            for k, prop in properties.items():
+                if prop.constructor or k.startswith('_'): continue
+                attr = inspect.getattr_static(cls, k, NotPresent)
+                if attr is NotPresent: in_dict.add(k)
+                elif type(attr) is types.MemberDescriptorType: in_slots.add(k)
+            lazy = (properties, frozenset(in_dict | in_slots), frozenset(in_slots))
+            cls._sync_lazy_cache = lazy
+        return lazy[1], lazy[2]
+
+    def sync_receive_constructed(self, msg, **kwargs):
+        lazy, in_slots = self._sync_lazy()
+        codecs = getattr(kwargs.get('protocol'), 'codecs', frozenset())
+        raw = self._sync_raw
+        if raw and codecs != self._sync_raw_codecs:
+            # Values from different senders may not share encodings
+            for k in list(raw): getattr(self, k)
+        raw = dict(raw or ())
+        rest = {}
+        for k, v in msg.items():
+            if k in lazy: raw[k] = v
+            else: rest[k] = v
+        # An earlier value would hide the new one from __getattr__
+        instance_dict = getattr(self, '__dict__', None)
+        for k in raw:
+            if k in in_slots:
+                try: object.__delattr__(self, k)
+                except AttributeError: pass
+            elif instance_dict: instance_dict.pop(k, None)
+        self._sync_raw = raw
+        self._sync_raw_codecs = codecs
+        return super().sync_receive_constructed(rest, **kwargs)
+
+    def __getattr__(self, name):
+        raw = self._sync_raw
+        if not raw or name not in raw:
+            raise AttributeError("{!r} object has no attribute {!r}".format(
+                self.__class__.__name__, name))
+        val = raw[name]
+        if val is not None and val is not NotPresent:
+            try: val = self.__class__._sync_decoders()[0][name](val)
+            except Exception as e:
+                raise SyncBadEncodingError("Failed to decode {}".format(name),
+                                           msg = {name: val}) from e
+        setattr(self, name, val)
+        return val
+
+    def __setattr__(self, name, value):
+        raw = self._sync_raw
+        if raw and name in raw: del raw[name]
+        super().__setattr__(name, value)
+
+    def to_sync(self, attributes = None):
+        raw = self._sync_raw
+        if not raw or not self._sync_raw_codecs <= wire_codecs.get():
+            return super().to_sync(attributes)
+        if attributes:
+            attributes = frozenset(attributes)
+            reused = attributes.intersection(raw)
+            if not reused: return super().to_sync(attributes)
+        else:
+            attributes = self.__class__._sync_properties.keys()
+            reused = raw.keys()
+        # Encoders always include _sync_owner, which is never raw
+        d = super().to_sync((attributes - reused) or ('_sync_owner',))
+        for k in reused: d[k] = raw[k]
+        return d
+
 Unique = "Unique" #: Constant indicating that a synchronizable is not combinable with any other instance
 
 class NotPresent:
@@ -476,6 +870,18 @@ class SyncRegistry:
         The class's sync_receive would need to duplicate any
         registry-global logic before deciding to draw.
 
+        The incoming methods (and this method) may be coroutine
+        functions, for example to write to a database without
+        blocking the connection.  The operation's flood happens once
+        the coroutine completes, and the sync_context stays open until
+        then.  Handlers for the same object run in the order the object
+        was received, so while a coroutine handler for it is running
+        later ones, even synchronous ones, wait; other handlers on the
+        connection run concurrently, up to the manager's
+        *max_incoming_tasks*, after which the connection stops reading.
+        Coroutine handlers still running when the connection is lost
+        are canceled.
+
 '''
 
         return operation.incoming(object, operation = operation, **kwargs)
@@ -520,6 +926,8 @@ class SyncError(RuntimeError, Synchronizable):
     
     sync_registry = error_registry
     sync_primary_keys = Unique
+    # Errors are small and often answer a request someone is waiting on
+    sync_priority = 1
 
     def __init__(self, *args, network_msg = None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -582,7 +990,7 @@ class SyncNotConnected(SyncError):
     def __init__(self, msg = None, dest = None):
         if dest and not msg:
             msg = "Not currently connected to {}".format(dest)
-            super().__init__( msg, dest)
+        super().__init__( msg, dest)
 
 from . import operations
 error_registry.register_operation('error', operations.error_operation)
@@ -8,7 +8,7 @@
 
 from __future__ import annotations
 
-import asyncio, dataclasses, typing, uuid
+import asyncio, bisect, dataclasses, itertools, typing, uuid
 import collections.abc
 from abc import abstractmethod
 from .interface import *
@@ -30,6 +30,270 @@ def key_for(s):
     return tuple(res)
 
 
+_absent = object()
+
+class HashIndex:
+
+    '''An index of the objects in a store by the value of one
+    attribute.  Objects lacking the attribute are not indexed.
+    Objects whose value the index cannot hold, such as a list, are
+    kept in :attr:`unindexed` and checked by every query.
+    '''
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+        #: Map from each value to a dict of the objects with it by key
+        self.objects = {}
+        #: The value each key was indexed under
+        self.values = {}
+        #: Objects by key whose value cannot be indexed
+        self.unindexed = {}
+
+    #: Whether objects whose value is None are indexed
+    index_none = True
+
+    def update(self, key, obj):
+        value = getattr(obj, self.attribute, _absent)
+        if value is None and not self.index_none: value = _absent
+        values = self.values
+        old = values.get(key, _absent)
+        if old is not _absent:
+            if old is value or old == value:
+                self.objects[old][key] = obj
+                return
+        self.discard(key)
+        if value is _absent: return
+        if not self._indexable(value):
+            self.unindexed[key] = obj
+            return
+        values[key] = value
+        objects = self.objects.get(value)
+        if objects is None: self._insert(value, {key: obj})
+        else: objects[key] = obj
+
+    def discard(self, key):
+        if self.unindexed.pop(key, _absent) is not _absent: return
+        value = self.values.get(key, _absent)
+        if value is _absent: return
+        objects = self.objects[value]
+        # _remove may look the value up, so nothing changes before it
+        if len(objects) == 1: self._remove(value)
+        else: del objects[key]
+        del self.values[key]
+
+    def _indexable(self, value):
+        try: hash(value)
+        except TypeError: return False
+        return True
+
+    def _insert(self, value, objects):
+        self.objects[value] = objects
+
+    def _remove(self, value):
+        del self.objects[value]
+
+    def with_unindexed(self, candidates, predicate):
+        "*candidates* followed by the objects not indexed that match *predicate*"
+        if not self.unindexed: return candidates
+        return itertools.chain(candidates, filter(predicate.matches, self.unindexed.values()))
+
+    def lookup(self, value):
+        return list(self.objects.get(value, {}).values())
+
+    def count(self, value):
+        return len(self.objects.get(value, ()))
+
+    def iter_equal(self, value):
+        return iter(self.objects.get(value, {}).values())
+
+class SortedIndex(HashIndex):
+
+    '''A :class:`HashIndex` that also keeps its values in order for
+    range lookups.  Objects whose value is None are not indexed, and
+    values that cannot be ordered with those already indexed, such as
+    a string among numbers, are left unindexed.
+    '''
+
+    def __init__(self, attribute):
+        super().__init__(attribute)
+        self.sorted = []
+        # New values are merged into sorted on the next range lookup,
+        #so filling a store does not shift the list for each object.
+        self.pending = set()
+
+    index_none = False
+
+    def _indexable(self, value):
+        if not super()._indexable(value): return False
+        if self.sorted: other = self.sorted[0]
+        elif self.pending: other = next(iter(self.pending))
+        else: return True
+        try: value < other
+        except TypeError: return False
+        return True
+
+    def _insert(self, value, objects):
+        self.objects[value] = objects
+        self.pending.add(value)
+
+    def _remove(self, value):
+        if value in self.pending: self.pending.remove(value)
+        else: del self.sorted[bisect.bisect_left(self.sorted, value)]
+        super()._remove(value)
+
+    def _merge(self):
+        if self.pending:
+            # Sorting two sorted runs is a merge
+            self.sorted.extend(sorted(self.pending))
+            self.sorted.sort()
+            self.pending = set()
+
+    def positions(self, low = None, high = None):
+        "The slice of :attr:`sorted` holding values from *low* up to but not including *high*"
+        self._merge()
+        start = 0 if low is None else bisect.bisect_left(self.sorted, low)
+        stop = len(self.sorted) if high is None else bisect.bisect_left(self.sorted, high)
+        return start, max(start, stop)
+
+    def iter_range(self, low = None, high = None):
+        "Objects with values from *low* up to but not including *high*, in order"
+        start, stop = self.positions(low, high)
+        objects = self.objects
+        for value in itertools.islice(self.sorted, start, stop):
+            yield from objects[value].values()
+
+    def iter_prefix(self, prefix):
+        "Objects with string values starting with *prefix*, in order"
+        objects = self.objects
+        for value in itertools.islice(self.sorted, self.positions(prefix)[0], None):
+            if not (isinstance(value, str) and value.startswith(prefix)): break
+            yield from objects[value].values()
+
+    def lookup_range(self, low = None, high = None):
+        return list(self.iter_range(low, high))
+
+class Predicate:
+
+    '''A condition on an object's sync properties, for
+    :meth:`AbstractSyncStore.query`.  Predicates are combined with
+    ``&``.
+    '''
+
+    def matches(self, obj):
+        raise NotImplementedError
+
+    def plan(self, indexes):
+        '''Return how to find the objects matching this predicate
+        through *indexes*, a mapping from attribute to index, or None
+        if they cannot help.  A plan is the estimated number of
+        candidates, a function returning an iterator over them, and a
+        predicate the candidates must still be checked against or None.
+        '''
+        return None
+
+    def __and__(self, other):
+        return And(self, other)
+
+@dataclasses.dataclass
+class Equal(Predicate):
+
+    attribute: str
+    value: typing.Any
+
+    def matches(self, obj):
+        value = getattr(obj, self.attribute, _absent)
+        return value is not _absent and value == self.value
+
+    def plan(self, indexes):
+        index = indexes.get(self.attribute)
+        # Sorted indexes leave out None
+        if index is None or (self.value is None and isinstance(index, SortedIndex)): return None
+        try: hash(self.value)
+        except TypeError: return None # Only objects scanned can match
+        return index.count(self.value)+len(index.unindexed), \
+            lambda: index.with_unindexed(index.iter_equal(self.value), self), None
+
+@dataclasses.dataclass
+class Range(Predicate):
+
+    '''Values at least *low* and less than *high*; either may be None.
+    Objects whose value is None never match.
+    '''
+
+    attribute: str
+    low: typing.Any = None
+    high: typing.Any = None
+
+    def matches(self, obj):
+        value = getattr(obj, self.attribute, None)
+        if value is None: return False
+        try: return (self.low is None or value >= self.low) and (self.high is None or value < self.high)
+        except TypeError: return False
+
+    def plan(self, indexes):
+        index = indexes.get(self.attribute)
+        if not isinstance(index, SortedIndex): return None
+        try: start, stop = index.positions(self.low, self.high)
+        except TypeError: return None # The bounds cannot be ordered with some values
+        return stop-start+len(index.unindexed), \
+            lambda: index.with_unindexed(index.iter_range(self.low, self.high), self), None
+
+@dataclasses.dataclass
+class Prefix(Predicate):
+
+    "String values starting with *prefix*"
+
+    attribute: str
+    prefix: str
+
+    def matches(self, obj):
+        value = getattr(obj, self.attribute, None)
+        return isinstance(value, str) and value.startswith(self.prefix)
+
+    def plan(self, indexes):
+        index = indexes.get(self.attribute)
+        if not isinstance(index, SortedIndex): return None
+        # Every string with the prefix sorts below this but ones
+        #continuing with the last code point, so it is an estimate.
+        try: start, stop = index.positions(self.prefix, self.prefix+'\U0010ffff')
+        except TypeError: return None # Some values are not strings
+        return stop-start+len(index.unindexed), \
+            lambda: index.with_unindexed(index.iter_prefix(self.prefix), self), None
+
+class And(Predicate):
+
+    "All of *predicates*; with none, everything"
+
+    def __init__(self, *predicates):
+        flattened = []
+        for p in predicates:
+            flattened.extend(p.predicates if isinstance(p, And) else (p,))
+        self.predicates = tuple(flattened)
+
+    def __repr__(self):
+        return 'And{!r}'.format(self.predicates)
+
+    def __eq__(self, other):
+        return isinstance(other, And) and other.predicates == self.predicates
+
+    def matches(self, obj):
+        for p in self.predicates:
+            if not p.matches(obj): return False
+        return True
+
+    def plan(self, indexes):
+        # Use the index expected to give the fewest candidates
+        best = None
+        for i, p in enumerate(self.predicates):
+            plan = p.plan(indexes)
+            if plan is not None and (best is None or plan[0] < best[0][0]):
+                best = plan, i
+        if best is None: return None
+        (count, candidates, residual), i = best
+        rest = self.predicates[:i]+self.predicates[i+1:]
+        if residual is not None: rest += (residual,)
+        return count, candidates, And(*rest) if rest else None
+
 class AbstractSyncStore(collections.abc.Mapping):
 
 
@@ -47,7 +311,10 @@ class AbstractSyncStore(collections.abc.Mapping):
         return tuple(res)
 
     def add(self, s):
-        self.store[key_for(s)] = s
+        key = key_for(s)
+        for index in self.indexes.values():
+            index.update(key, s)
+        self.store[key] = s
 
     def __getitem__(self, k):
         try:
@@ -60,9 +327,12 @@ class AbstractSyncStore(collections.abc.Mapping):
         raise KeyError
 
     def __delitem__(self, k):
-        if k in self.store: del self.store[k]
-        elif  isinstance(k, Synchronizable):
-            del self.store[key_for(k)]
+        if k not in self.store and isinstance(k, Synchronizable):
+            k = key_for(k)
+        elif k not in self.store: return
+        del self.store[k]
+        for index in self.indexes.values():
+            index.discard(k)
 
     def __len__(self):
         return len(self.store)
@@ -71,7 +341,10 @@ class AbstractSyncStore(collections.abc.Mapping):
         return iter(self.store)
     
     def remove(self, s:Synchronizable):
-        del self.store[key_for(s)]
+        key = key_for(s)
+        del self.store[key]
+        for index in self.indexes.values():
+            index.discard(key)
 
     def __contains__(self, o):
         if isinstance(o, Synchronizable):
@@ -85,8 +358,69 @@ class AbstractSyncStore(collections.abc.Mapping):
         '''
         raise NotImplementedError
 
+    def add_index(self, attribute, sorted = False):
+        '''Index the objects in this store by *attribute*, a hash index
+        unless *sorted* is true.  The index is kept up to date as
+        objects are added and removed; code that changes an indexed
+        attribute should add the object again, as
+        :meth:`SyncStoreRegistry.store_synchronize` does.
+        '''
+        index = self.indexes.get(attribute)
+        if index is not None and isinstance(index, SortedIndex) == bool(sorted): return index
+        index = self.indexes[attribute] = (SortedIndex if sorted else HashIndex)(attribute)
+        for key, obj in self.store.items():
+            index.update(key, obj)
+        return index
+
+    def query(self, *predicates, **values):
+        '''Iterate over the objects matching all of *predicates* and
+        having the attribute values given as keywords::
+
+            store.query(Range('updated', since) & Prefix('name', 'lab-'), room = room)
+
+        Candidates come from the index expected to give the fewest,
+        or from scanning the store if no index helps, and are checked
+        against the other predicates as they are produced.  As with a
+        dict, the store must not be changed while iterating.
+        '''
+        predicate = And(*predicates, *(Equal(k, v) for k, v in values.items()))
+        plan = predicate.plan(self.indexes)
+        if plan is None:
+            candidates, residual = iter(self.store.values()), predicate
+        else:
+            count, candidates, residual = plan
+            candidates = candidates()
+        if residual is None: return candidates
+        return filter(residual.matches, candidates)
+
+    def lookup(self, attribute, value):
+        '''Return a list of the objects whose *attribute* equals *value*,
+        using an index if there is one.
+        '''
+        return list(self.query(Equal(attribute, value)))
+
+    def lookup_range(self, attribute, low = None, high = None):
+        '''Return a list of the objects whose *attribute* is at least
+        *low* and less than *high*, ordered by *attribute*.  Either bound
+        may be None.  Uses a sorted index if there is one.
+        '''
+        index = self.indexes.get(attribute)
+        if isinstance(index, SortedIndex) and not index.unindexed:
+            return index.lookup_range(low, high)
+        result = []
+        for o in self.store.values():
+            value = getattr(o, attribute, None)
+            if value is None: continue
+            if low is not None and value < low: continue
+            if high is not None and not value < high: continue
+            result.append(o)
+        result.sort(key = lambda o: getattr(o, attribute))
+        return result
+
     def __init__(self):
         self.store = self.store_factory()
+        #: Map from attribute to its :class:`HashIndex` or :class:`SortedIndex`
+        self.indexes = {}
 
 class SyncStore(AbstractSyncStore):
 
@@ -96,9 +430,18 @@ class SyncStore(AbstractSyncStore):
 
 class StoreInSyncStoreMixin(Synchronizable):
 
+    __slots__ = ()
+    sync_instance_attributes = ('sync_owner',)
+
     #: The class to store this object with.  If None, this object gets its own store.  Objects should be stored together when they are subclasses that have overlapping primary keys and using code does not want to know the exact type to do a lookup.
     sync_store_with = None
 
+    #: Attributes to keep a hash index on in this class's store; see :meth:`AbstractSyncStore.lookup`.  Indexes are declared on the class named by *sync_store_with* when it is set.
+    sync_indexes = ()
+
+    #: Attributes to keep a sorted index on in this class's store; see :meth:`AbstractSyncStore.lookup_range`.
+    sync_sorted_indexes = ()
+
     _sync_owner: uuid.UUID = sync_property()
 
     @classmethod
@@ -142,6 +485,10 @@ class SyncStoreRegistry(SyncRegistry):
         try: store = self.stores_by_class[store_cls]
         except KeyError:
             store = self.sync_store_factory()
+            for attribute in getattr(store_cls, 'sync_indexes', ()):
+                store.add_index(attribute)
+            for attribute in getattr(store_cls, 'sync_sorted_indexes', ()):
+                store.add_index(attribute, sorted = True)
             self.stores_by_class[store_cls] = store
         return store
 
@@ -9,18 +9,35 @@
 
 
 
-import asyncio, logging, ssl, time, weakref
+import asyncio, contextlib, contextvars, hashlib, heapq, inspect, itertools, logging, random, ssl, time, weakref
 import functools
 from . import protocol
 from .util import DestHash, certhash_from_file
-from .bandwidth import BwLimitProtocol
+from .bandwidth import BwLimitProtocol, BandwidthBudget, AdaptiveRateController
 from .interface import WrongSyncDestination, UnregisteredSyncClass, SyncNotConnected
 from . import interface
 from .operations import SyncOperation
 logger = protocol.logger
+_sync_magic_attributes = frozenset(protocol.sync_magic_attributes)
 
 no_traceback_connection_failures = (OSError, EOFError)
 
+#: The TLS session offered when asyncio wraps the connection being
+#made by the current task
+_resume_session = contextvars.ContextVar('_resume_session', default = None)
+
+class _ResumingSSLContext(ssl.SSLContext):
+
+    "An SSLContext that offers the session in :data:`_resume_session` on outgoing connections, since asyncio provides no way to pass a session."
+
+    def wrap_bio(self, incoming, outgoing, server_side = False,
+                 server_hostname = None, session = None):
+        if session is None and not server_side:
+            session = _resume_session.get()
+        return super().wrap_bio(incoming, outgoing, server_side = server_side,
+                                server_hostname = server_hostname,
+                                session = session)
+
 
 class SyncManager:
 
@@ -32,9 +49,116 @@ class SyncManager:
     connections.
     '''
 
+    #: The maximum number of coroutine incoming handlers that may be
+    #running at once for a single connection.  When this many are
+    #running, the connection stops reading until one completes.
+    max_incoming_tasks = 16
+
+    #: The maximum number of outgoing connections (TCP connect and TLS
+    #handshake) that may be in progress at once.  Further attempts
+    #wait, with recently connected destinations going first.
+    max_concurrent_connects = 32
+
+    #: The longest delay in seconds between attempts to connect to a
+    #destination that cannot be reached.
+    max_connect_backoff = 10*60
+
+    #: Seconds between keepalive pings on each connection, which also
+    #measure round trip time; None disables keepalives.
+    keepalive_interval = 30
+
+    #: A connection whose peer has answered pings before but from
+    #which nothing has been received for this many seconds is closed
+    #so that it can be reestablished.
+    keepalive_timeout = 90
+
+    #: Objects synchronized with a priority at or below this are
+    #urgent: they may be written while a connection is paused for bulk
+    #data, up to *urgent_budget* messages per pause.
+    urgent_priority = 10
+    urgent_budget = 16
+
+    #: Bytes buffered in a connection's transport before it stops
+    #accepting bulk data
+    write_buffer_high = 64*1024
+
+    #: On TCP connections, the most unsent data the kernel may hold
+    #(TCP_NOTSENT_LOWAT where supported).  Limiting it keeps bulk data
+    #queued where priorities still apply.  None leaves the system default.
+    tcp_notsent_lowat = 128*1024
+
+    #: Bytes in each direction of the shared memory rings used with
+    #unix socket peers running as the same user; None uses only the socket.
+    shm_ring_size = 1024*1024
+
+    #: The number of recently sent messages kept for each destination
+    #so they can be replayed if a connection is lost before the peer
+    #received them; also the most objects queued for a disconnected
+    #destination.  None disables session resumption.
+    replay_buffer_size = 1024
+
+    #: Seconds a disconnected destination's session is kept.  Objects
+    #synchronized to the destination meanwhile are sent when it
+    #reconnects; after this the peer must resynchronize.
+    resume_window = 60
+
+    #: Seconds to wait for the peer's hello before giving up on
+    #resuming a session
+    resume_timeout = 5
+
+    #: Compact encodings offered to peers; those a peer also offers are
+    #used for objects sent to it.  See
+    #:data:`entanglement.types.supported_codecs`.  ``uuid-hex`` changes
+    #the strings that overrides such as *should_listen* and
+    #*sync_receive_constructed* see in raw messages, so it is only
+    #offered if added here.
+    wire_codecs = frozenset({'columnar'})
+
+    #: Whether to send properties by position rather than by name to
+    #peers whose schema for a class, exchanged on connecting, matches
+    #ours.  This makes messages for classes with many properties
+    #smaller but not faster to encode and parse, so it is for links
+    #where bandwidth is scarcer than CPU time.
+    positional_encoding = False
+
+    #: While resynchronizing a destination, the most queued objects of
+    #one class sent together with a column per property, to peers that
+    #accept the ``columnar`` codec.  None sends each object alone.
+    columnar_batch_size = 64
+
+    #: The number of TLS 1.3 session tickets a server issues on each
+    #connection so that clients can resume the session when they
+    #reconnect.
+    tls_session_tickets = 2
+
+    @property
+    def bw_per_sec(self):
+        '''Characters per second all connections together may send; None
+        for no limit.  Destinations may be placed in groups with their
+        own limits and shares using :meth:`add_bandwidth_group`.  The
+        tree of budgets and its counters are under :attr:`bandwidth`.
+        '''
+        return self.bandwidth.chars_per_sec
+
+    @bw_per_sec.setter
+    def bw_per_sec(self, value):
+        self.bandwidth.chars_per_sec = value
+
+    @property
+    def bw_burst(self):
+        '''Characters all connections together may send at once before
+        *bw_per_sec* applies; None for a tenth of a second at that rate
+        '''
+        return self.bandwidth._burst
+
+    @bw_burst.setter
+    def bw_burst(self, value):
+        self.bandwidth.burst = value
+
     def __init__(self, cert, port, *, key = None, loop = None,
                  capath = None, cafile = None,
-                 registries = []):
+                 registries = [],
+                 bw_per_sec = None, bw_burst = None):
         if loop:
             self.loop = loop
             self.loop_allocated = False
@@ -45,6 +169,17 @@ class SyncManager:
         self._destinations = {}
         self._connections = {}
         self._connecting = {}
+        self._receive_plans = {}
+        self.connection_scheduler = ConnectionScheduler(self.max_concurrent_connects)
+        self._tls_sessions = {} # dest_hash: SSLSession to resume
+        self._sessions = {} # dest_hash: ResumableSession
+        self._resumable = {} # dest_hash: session of a disconnected destination
+        self._closing = False
+        #: The root of the :class:`BandwidthBudget` tree shared by all connections
+        self.bandwidth = BandwidthBudget('manager', bw_per_sec,
+                                         burst = bw_burst, loop = self.loop)
+        self._bandwidth_groups = {}
+        self._bandwidth_destinations = {} # dest_hash: BandwidthBudget
         if cert is not None:
             self._ssl = self._new_ssl(cert, key = key,
                                  capath = capath, cafile = cafile)
@@ -61,9 +196,17 @@ class SyncManager:
         for r in self.registries: r.associate_with_manager(self)
 
     def _new_ssl(self, cert, key, capath, cafile, server=False):
-        sslctx = ssl.create_default_context(cafile = cafile, capath = capath, purpose=( ssl.Purpose.CLIENT_AUTH if server else ssl.Purpose.SERVER_AUTH))
+        # As ssl.create_default_context, but with a context that can
+        # resume sessions
+        sslctx = _ResumingSSLContext(ssl.PROTOCOL_TLS_SERVER if server else ssl.PROTOCOL_TLS_CLIENT)
+        if cafile or capath:
+            sslctx.load_verify_locations(cafile = cafile, capath = capath)
+        elif not server:
+            sslctx.load_default_certs(ssl.Purpose.SERVER_AUTH)
         if server:
             sslctx.verify_mode = ssl.VerifyMode.CERT_OPTIONAL
+            sslctx.options &= ~ssl.OP_NO_TICKET
+            sslctx.num_tickets = self.tls_session_tickets
         sslctx.load_cert_chain(cert, key)
         self.cert_hash = certhash_from_file(cert)
         return sslctx
@@ -97,6 +240,8 @@ class SyncManager:
 
         '''
         future = None
+        if self._closing:
+            raise SyncNotConnected("{} is shutting down".format(self))
         if response and response_for:
             raise ValueError('Response and response_for cannot both be true')
         if response:
@@ -109,9 +254,10 @@ class SyncManager:
             raise SyntaxError('Must not override sync_receive in {}'.format(obj.__class__.__name__))
         if priority is None: priority = obj.sync_priority
         if destinations is None:
-            destinations = filter(lambda  x: x.dest_hash in self._connections,
+            resumable = self._resumable
+            destinations = filter(lambda  x: x.dest_hash in self._connections or x.dest_hash in resumable,
                                   self.destinations)
-        valid_dest_hashes = set(self._connections.keys()).union( set(self._connecting.keys()))
+        valid_dest_hashes = set(self._connections.keys()).union( set(self._connecting.keys()), self._resumable.keys())
         should_send_destinations = set()
         info = {}
         info['manager'] = self
@@ -134,7 +280,9 @@ class SyncManager:
                     raise SyncNotConnected(dest = d)
                 should_send_destinations.add(d)
         for d in should_send_destinations:
-            con = d.protocol
+            # Until it reconnects, a disconnected destination's session
+            # holds objects for it
+            con = self._resumable.get(d.dest_hash) or d.protocol
             con._synchronize_object(obj,
             attributes = attributes_to_sync,
                                     operation = operation,
@@ -149,6 +297,7 @@ class SyncManager:
         delta = 1
         task = self._connecting[dest.dest_hash] #our task
         close_transport = None #Close this transport if we fail to connect
+        scheduler = self.connection_scheduler
 
         # There are two levels of try; the outer catches exceptions
         #that end all connection attempts and cleans up the cache of
@@ -160,26 +309,41 @@ class SyncManager:
                     time = time.ctime(dest.connect_at),
                     dest = dest))
                     delta = dest.connect_at-time.time()
-                    await asyncio.sleep(delta)
-                delta = min(2*delta, 10*60)
+                    scheduler.backing_off += 1
+                    try: await asyncio.sleep(delta)
+                    finally: scheduler.backing_off -= 1
+                # Decorrelated jitter so that clients that lost a
+                # server at the same moment do not retry in lock step
+                delta = min(random.uniform(1, 3*max(delta, 1)), self.max_connect_backoff)
                 try:
-                    logger.debug("Connecting to {hash} at {host}".format(
-                        hash = dest.dest_hash,
-                        host = dest.endpoint_desc))
-                    transport, bwprotocol = \
-                        await dest.create_connection(
-                            self.port, loop,
-                            self._protocol_factory_client,
-                            self._ssl)
+                    async with scheduler.slot(dest):
+                        logger.debug("Connecting to {hash} at {host}".format(
+                            hash = dest.dest_hash,
+                            host = dest.endpoint_desc))
+                        session = _resume_session.set(self._tls_sessions.get(dest.dest_hash))
+                        try:
+                            transport, bwprotocol = \
+                                await dest.create_connection(
+                                    self.port, loop,
+                                    self._protocol_factory_client,
+                                    self._ssl)
+                        finally: _resume_session.reset(session)
                     logger.debug("Transport connection to {dest} made".format(dest = dest))
                     close_transport = transport
                     protocol = bwprotocol.protocol
+                    # Checked for resumed sessions too; the peer
+                    # certificate is carried in the session.
                     if protocol.dest_hash != dest.dest_hash and protocol.confirm_outgoing_dest_hash:
+                        self._tls_sessions.pop(dest.dest_hash, None)
                         raise WrongSyncDestination(dest = dest, got_hash = protocol.dest_hash)
+                    self._save_tls_session(protocol, dest)
                     protocol._enable_reading()
-
+                    # Set first so that destinations persisting it
+                    #can save it in connected
+                    dest.last_connected = time.time()
                     await dest.connected(self, protocol, bwprotocol = bwprotocol)
                     self._connections[dest.dest_hash] = protocol
+                    self._resumable.pop(dest.dest_hash, None)
                     close_transport = None
                     logger.info("Connected to {hash} at {host}".format(
                         hash = dest.dest_hash,
@@ -208,17 +372,34 @@ class SyncManager:
 
 
 
+    def _save_tls_session(self, protocol, dest):
+        "Remember the TLS session of an outgoing connection to *dest* so the next connection can resume it"
+        transport = getattr(protocol, 'transport', None)
+        if transport is None: return
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is None or ssl_object.server_side: return
+        # With TLS 1.3 the resumable session arrives after the
+        # handshake, so this is called again when the connection is lost.
+        session = ssl_object.session
+        if session is not None and dest.dest_hash in self._destinations:
+            self._tls_sessions[dest.dest_hash] = session
+
     def _connection_lost(self, protocol, exc):
+        # Commit objects received in batches while the sender is
+        # still known, rather than when the batch timer fires
+        for r in self.registries:
+            if protocol in (getattr(r, '_batches', None) or ()): r.commit_batch(protocol)
         if self._connections.get(protocol.dest.dest_hash,None)  == protocol:
             del self._connections[protocol.dest.dest_hash]
+            self._save_tls_session(protocol, protocol.dest)
             msg = "Connection to {} lost:".format(protocol.dest)
 
             protocol.dest.connection_lost(self)
 
-            if exc is None:
+            if exc is None or protocol.peer_goodbye:
                 logger.info(msg)
             else: logger.exception(msg, exc_info = exc)
-            if protocol.dest.can_connect: 
+            if protocol.dest.can_connect and not self._closing:
                 self._connecting[protocol.dest.dest_hash] = self.loop.create_task(self._create_connection(protocol.dest))
         protocol.dest = None
 
@@ -233,6 +414,8 @@ class SyncManager:
             raise ValueError("dest_hash and name are required in SyncDestination before adding")
         if dest.dest_hash in self._destinations:
             raise KeyError("{} is already a destination".format(repr(dest)))
+        if self._closing:
+            raise SyncNotConnected("{} is shutting down".format(self))
         self._destinations[dest.dest_hash] = dest
         assert dest.protocol is None
         assert dest.dest_hash not in self._connecting
@@ -252,6 +435,40 @@ class SyncManager:
             self._connecting[dest.dest_hash].cancel()
             del self._connecting[dest.dest_hash]
         del self._destinations[dest.dest_hash]
+        self._tls_sessions.pop(dest.dest_hash, None)
+        self._resumable.pop(dest.dest_hash, None)
+        session = self._sessions.pop(dest.dest_hash, None)
+        if session: session.cancel_expire()
+        budget = self._bandwidth_destinations.pop(dest.dest_hash, None)
+        if budget: budget.remove()
+
+    def add_bandwidth_group(self, name, bw_per_sec = None, *,
+                            weight = 1, burst = None, parent = None):
+        '''Add a group of destinations sharing *bw_per_sec* characters
+        per second.  Destinations join by setting their *bw_group* to
+        *name*.  When the group's parent is fully used, each group
+        gets a share in proportion to its *weight*, as does each
+        destination within a group.  *parent* names an enclosing
+        group; by default the group is within the manager's
+        *bw_per_sec*.  Returns the group's :class:`BandwidthBudget`.
+        '''
+        if name in self._bandwidth_groups:
+            raise ValueError("Bandwidth group {} already exists".format(name))
+        parent = self.bandwidth if parent is None else self._bandwidth_groups[parent]
+        group = parent.child(name, bw_per_sec, weight = weight, burst = burst)
+        self._bandwidth_groups[name] = group
+        return group
+
+    def _destination_budget(self, dest):
+        "The budget a destination's connections share"
+        budget = self._bandwidth_destinations.get(dest.dest_hash)
+        if budget is None:
+            parent = self.bandwidth
+            if dest.bw_group is not None:
+                parent = self._bandwidth_groups[dest.bw_group]
+            budget = parent.child(dest.name or str(dest.dest_hash), weight = dest.bw_weight)
+            self._bandwidth_destinations[dest.dest_hash] = budget
+        return budget
 
     def run_until_complete(self, *args):
         return self.loop.run_until_complete(*args)
@@ -263,56 +480,131 @@ class SyncManager:
         if protocol.dest: info['sender'] = protocol.dest
         try:
             cls = None
-            self._validate_message(msg)
-            cls, registry = self._find_registered_class(msg['_sync_type'])
-            info['operation'] = registry.get_operation(msg['_sync_operation'])
+            attributes = self._validate_message(msg)
+            plan = self._receive_plan(msg['_sync_type'], msg['_sync_operation'])
+            cls = plan.cls
+            registry = plan.registry
+            info['operation'] = plan.operation
             info['registry'] = registry
-            info['attributes'] = frozenset(filter(lambda a: not a.startswith('_'), msg.keys()))
-            if self.should_listen(msg, cls, **info) is not True:
-                # Failure should raise because ignoring an exception takes
-                # active work, leading to a small probability of errors.
-                # However, active authorization should be an explicit true
-                # not falling off the end of a function.
-                raise SyntaxError("should_listen must either return True or raise")
-            if msg['_sync_authorized'] != self:
-                raise SyntaxError("When SyncManager.should_listen is overwridden, you must call super().should_listen")
-            del msg['_sync_authorized']
-            with registry.sync_context(sync_type = cls, **info) as ctx:
-                info['context'] = ctx
-                obj = cls.sync_construct(msg, **info)
-                if self.should_listen_constructed(obj, msg, **info) is not True:
-                    raise SyntaxError("should_listen_constructed must either return True or raise")
-                obj.sync_receive_constructed(msg, **info)
-                registry.sync_receive(obj, **info)
+            info['attributes'] = attributes
+            if self._hook_overridden('should_listen'):
+                if self.should_listen(msg, cls, **info) is not True:
+                    # Failure should raise because ignoring an exception takes
+                    # active work, leading to a small probability of errors.
+                    # However, active authorization should be an explicit true
+                    # not falling off the end of a function.
+                    raise SyntaxError("should_listen must either return True or raise")
+                if msg['_sync_authorized'] != self:
+                    raise SyntaxError("When SyncManager.should_listen is overwridden, you must call super().should_listen")
+                del msg['_sync_authorized']
+            else: plan.should_listen(msg, info)
+            if plan.uses_context:
+                with contextlib.ExitStack() as stack:
+                    info['context'] = stack.enter_context(
+                        registry.sync_context(sync_type = cls, **info))
+                    obj, res = self._receive_constructed(plan, msg, info)
+                    if inspect.isawaitable(res):
+                        # The context stays open until the handler completes
+                        protocol._schedule_incoming(obj, functools.partial(
+                            self._receive_async, res, obj, stack.pop_all(),
+                            msg, cls, protocol, response_for))
+                        return
+            else:
+                info['context'] = None
+                obj, res = self._receive_constructed(plan, msg, info)
+                if inspect.isawaitable(res):
+                    protocol._schedule_incoming(obj, functools.partial(
+                        self._receive_async, res, obj, contextlib.ExitStack(),
+                        msg, cls, protocol, response_for))
+                    return
             if response_for:
                 response_for(obj)
         except Exception as e:
-            if isinstance(e, interface.SyncError):
-                exc_str = f': {str(e)}'
-            else: exc_str = None
-            logger.error("Error receiving a {}{}".format(
-                cls.__name__ if cls is not None else msg['_sync_type'],
-                exc_str),
-                         exc_info = e  if not exc_str else None)
-            if isinstance(e,interface.SyncError) and not '_sync_is_error' in msg:
-                if not e.network_msg: e.network_msg = msg
-                try:
-                    self.synchronize(e,
-                                          destinations = [protocol.dest],
-                                          response_for = response_for,
-                                          operation = 'error')
-                except: pass
-
+            self._receive_error(e, msg, cls, protocol, response_for)
         finally:
             if 'context' in info: del info['context']
 
+    async def _receive_async(self, res, obj, stack, msg, cls, protocol, response_for, previous):
+        """Complete the receipt of *obj* once the coroutine incoming
+        handler *res* finishes, first waiting for *previous*, the task
+        for an earlier message about *obj*, if not None.
+        """
+        try:
+            with stack:
+                if previous is not None: await asyncio.wait([previous])
+                await res
+            if response_for:
+                response_for(obj)
+        except asyncio.CancelledError:
+            # Canceled with the connection, perhaps before res started
+            if inspect.iscoroutine(res): res.close()
+            raise
+        except Exception as e:
+            self._receive_error(e, msg, cls, protocol, response_for)
+
+    def _receive_error(self, e, msg, cls, protocol, response_for):
+        if isinstance(e, interface.SyncError):
+            exc_str = f': {str(e)}'
+        else: exc_str = None
+        logger.error("Error receiving a {}{}".format(
+            cls.__name__ if cls is not None else msg['_sync_type'],
+            exc_str),
+                     exc_info = e  if not exc_str else None)
+        if isinstance(e,interface.SyncError) and not '_sync_is_error' in msg:
+            if not e.network_msg: e.network_msg = msg
+            try:
+                self.synchronize(e,
+                                      destinations = [protocol.dest],
+                                      response_for = response_for,
+                                      operation = 'error')
+            except: pass
+
+    def _receive_constructed(self, plan, msg, info):
+        obj = plan.cls.sync_construct(msg, **info)
+        if self._hook_overridden('should_listen_constructed'):
+            if self.should_listen_constructed(obj, msg, **info) is not True:
+                raise SyntaxError("should_listen_constructed must either return True or raise")
+        else: plan.should_listen_constructed(obj, msg, info)
+        obj.sync_receive_constructed(msg, **info)
+        pending = getattr(info['protocol'], '_incoming_pending', None)
+        if pending is not None and pending(obj):
+            # Wait for the coroutine handler still receiving an
+            #earlier message about obj
+            return obj, self._receive_later(plan.registry, obj, dict(info))
+        return obj, plan.registry.sync_receive(obj, **info)
+
+    @staticmethod
+    async def _receive_later(registry, obj, info):
+        res = registry.sync_receive(obj, **info)
+        if inspect.isawaitable(res): res = await res
+        return res
+
+    def _hook_overridden(self, name):
+        "Return True if the receive hook *name* is overridden on this manager, in which case it must be called rather than the equivalent in the receive plan."
+        return name in self.__dict__ or \
+            getattr(type(self), name) is not getattr(SyncManager, name)
+
+    def _receive_plan(self, sync_type, operation):
+        "Return the cached :class:`_ReceivePlan` for an incoming *sync_type* and *operation*, building it on first use."
+        plan = self._receive_plans.get((sync_type, operation))
+        if plan is None or not plan.valid(sync_type, operation):
+            cls, registry = self._find_registered_class(sync_type)
+            plan = _ReceivePlan(cls, registry, registry.get_operation(operation))
+            self._receive_plans[(sync_type, operation)] = plan
+        return plan
+
     def _validate_message(self, msg):
+        "Confirm *msg* is a well formed sync message and return the frozenset of its non-magic attributes"
         if not isinstance(msg, dict):
             raise interface.SyncBadEncodingError('Message is a {} not a dict'.format(msg.__class__.__name__))
         msg.setdefault('_sync_operation', 'sync')
+        attributes = []
         for k in msg:
-            if k.startswith('_') and k not in protocol.sync_magic_attributes:
-                raise interface.SyncBadEncodingError('{} is not a valid attribute in a sync message'.format(k), msg = msg)
+            if k.startswith('_'):
+                if k not in _sync_magic_attributes:
+                    raise interface.SyncBadEncodingError('{} is not a valid attribute in a sync message'.format(k), msg = msg)
+            else: attributes.append(k)
+        return frozenset(attributes)
 
     def should_send(self, obj, destination, registry, sync_type, **info):
         info['registry'] = registry
@@ -347,13 +639,64 @@ class SyncManager:
 
     
 
+    def _sync_schemas(self):
+        """Return the names and fingerprint from _sync_schema for each
+        class in our registries, and one fingerprint covering them all.
+        """
+        schemas = {}
+        for reg in self.registries:
+            for sync_type, cls in reg.registry.items():
+                if sync_type not in schemas: schemas[sync_type] = cls._sync_schema()
+        fingerprint = hashlib.blake2b(' '.join(sorted(
+            fingerprint for names, fingerprint in schemas.values())).encode('ascii'),
+                                      digest_size = 8).hexdigest()
+        return schemas, fingerprint
+
     def _find_registered_class(self, name):
         for reg in self.registries:
             if name in reg.registry: return reg.registry[name], reg
         raise UnregisteredSyncClass('{} is not registered for this manager'.format(name))
 
-    def close(self):
-        if not hasattr(self,'_transports'): return
+    async def aclose(self, timeout = 10):
+        '''Shut down gracefully.  Stop accepting :meth:`synchronize`
+        calls and connections, then send what each connection has
+        queued, in priority order, for up to *timeout* seconds.  Each
+        peer is then sent a goodbye and the connection is closed.
+
+        Returns a dict mapping each destination that was connected to
+        a dict giving the number of queued entries *flushed* and
+        *abandoned*.  A manager that allocated its own event loop still
+        needs :meth:`close` to release it.
+        '''
+        self._closing = True
+        connecting = list(self._connecting.values())
+        self._connecting = {}
+        for c in connecting: c.cancel()
+        protocols = list(self._connections.values())
+        dests = {}
+        queued = {}
+        for p in protocols:
+            dests[p] = p.dest
+            queued[p] = p._queued()
+            # Messages received now could only produce responses we will not send
+            transport = getattr(p, 'transport', None)
+            if transport is not None: transport.pause_reading()
+        drains = [p.sync_drain() for p in protocols]
+        if drains: await asyncio.wait(drains, timeout = timeout)
+        results = {}
+        for p in protocols:
+            abandoned = p._queued()
+            if not p.is_closed(): p._send_goodbye()
+            results[dests[p]] = dict(flushed = queued[p]-abandoned, abandoned = abandoned)
+            logger.info("Closing connection to {}: {} flushed, {} abandoned".format(
+                dests[p], queued[p]-abandoned, abandoned))
+        self._close_connections()
+        # Let transports finish writing and close
+        await asyncio.sleep(0)
+        if not self.loop_allocated: self.close()
+        return results
+
+    def _close_connections(self):
         connections = list(self._connections.values())
         self._connections = {}
         for c in connections:
@@ -361,8 +704,14 @@ class SyncManager:
         connecting = list(self._connecting.values())
         self._connecting = {}
         for c in connecting: c.cancel()
+        for s in self._sessions.values(): s.cancel_expire()
+        self._resumable = {}
         for t in self._transports:
             if t(): t().close()
+
+    def close(self):
+        if not hasattr(self,'_transports'): return
+        self._close_connections()
         if self.loop_allocated:
             self.loop.call_soon(self.loop.stop)
             self.loop.run_forever()
@@ -390,6 +739,67 @@ class SyncManager:
         "A set of destinations for this manager"
         return set(self._destinations.values())
 
+class _ReceivePlan:
+
+    """The lookups needed to receive a given sync_type and operation,
+    resolved once per manager rather than once per message.  A plan is
+    rechecked against the registry on each use so that re-registering a
+    class or operation replaces it.  Hooks that are not overridden on
+    the registry or class are skipped; their default implementations
+    always return True.
+    """
+
+    __slots__ = ('cls', 'registry', 'operation', 'uses_context',
+                 'registry_listens', 'class_listens',
+                 'registry_listens_constructed', 'class_listens_constructed')
+
+    def __init__(self, cls, registry, operation):
+        self.cls = cls
+        self.registry = registry
+        self.operation = operation
+        SyncRegistry = interface.SyncRegistry
+        Synchronizable = interface.Synchronizable
+        def overridden(name):
+            return name in registry.__dict__ or \
+                getattr(type(registry), name) is not getattr(SyncRegistry, name)
+        # The default sync_context yields None; entering it for
+        # every message is pure overhead.
+        self.uses_context = overridden('sync_context')
+        self.registry_listens = overridden('should_listen')
+        self.registry_listens_constructed = overridden('should_listen_constructed')
+        self.class_listens = cls.sync_should_listen.__func__ is not \
+            Synchronizable.sync_should_listen.__func__
+        self.class_listens_constructed = cls.sync_should_listen_constructed is not \
+            Synchronizable.sync_should_listen_constructed
+
+    def valid(self, sync_type, operation):
+        registry = self.registry
+        return registry.registry.get(sync_type) is self.cls and \
+            registry.operations.get(operation) is self.operation
+
+    def should_listen(self, msg, info):
+        "Equivalent to :meth:`SyncManager.should_listen` skipping default hooks"
+        cls = self.cls
+        if info['sender'].should_listen(msg, cls, **info) is not True:
+            raise SyntaxError('should_listen must return True or raise')
+        if self.registry_listens and \
+           self.registry.should_listen(msg, cls, **info) is not True:
+            raise SyntaxError('should_listen must return True or raise')
+        if self.class_listens and cls.sync_should_listen(msg, **info) is not True:
+            raise SyntaxError('sync_should_listen must return True or raise')
+
+    def should_listen_constructed(self, obj, msg, info):
+        "Equivalent to :meth:`SyncManager.should_listen_constructed` skipping default hooks"
+        if self.registry_listens_constructed:
+            if self.registry.should_listen_constructed(obj, msg, **info) is not True:
+                raise SyntaxError("should_listen_constructed must return true or raise")
+        else:
+            assert self.operation.should_listen_constructed(obj, msg, **info) is True
+        if (self.class_listens_constructed or type(obj) is not self.cls) and \
+           obj.sync_should_listen_constructed(msg, **info) is not True:
+            raise SyntaxError('sync_should_listen_constructed must return True or raise')
+
+
 class SyncServer(SyncManager):
 
     "A SyncManager that accepts incoming connections"
@@ -452,6 +862,12 @@ Listen on the given unix path.
         self._servers.clear()
         super().close()
 
+    async def aclose(self, timeout = 10):
+        for s in self._servers:
+            s.close()
+        self._servers.clear()
+        return await super().aclose(timeout)
+
     async def _incoming_connection(self, protocol):
         old = None
         task = None
@@ -491,6 +907,7 @@ Listen on the given unix path.
             logger.info("Replacing existing connection in progress to {}".format(dest))
             old = self._connecting[dest.dest_hash]
         try:
+            dest.last_connected = time.time()
             task = self.loop.create_task(dest.connected(self, protocol,
                                                         bwprotocol = protocol.bwprotocol))
             self._connecting[dest.dest_hash] = task
@@ -498,15 +915,113 @@ Listen on the given unix path.
             protocol._enable_reading()
             await self._connecting[dest.dest_hash]
             self._connections[dest.dest_hash] = protocol
+            self._resumable.pop(dest.dest_hash, None)
             logger.info("New incoming connection from {}".format(dest))
         finally:
             if dest.dest_hash in self._connecting and self._connecting[dest.dest_hash] == task:
                 del self._connecting[dest.dest_hash]
 
+class ConnectionScheduler:
+
+    '''Limits how many outgoing connections a :class:`SyncManager` establishes at once so that adding many destinations does not start a handshake with each of them simultaneously.  Attempts beyond *max_concurrent* wait for a slot; destinations that connected most recently are given slots first since they are the most likely to be reachable.
+    '''
+
+    def __init__(self, max_concurrent):
+        self.max_concurrent = max_concurrent
+        #: Connection attempts currently holding a slot
+        self.in_progress = 0
+        #: Destinations waiting out a delay after a failed attempt
+        self.backing_off = 0
+        #: Total attempts given a slot
+        self.attempts = 0
+        #: Attempts that raised while holding a slot
+        self.failures = 0
+        #: Attempts waiting for a slot
+        self.waiting = 0
+        # heap of (-last_connected, sequence, future); canceled
+        #futures stay until _release pops them
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def metrics(self):
+        "Return a dictionary describing pending and completed connection attempts"
+        waiting = self.waiting
+        return dict(in_progress = self.in_progress,
+                    waiting = waiting,
+                    backing_off = self.backing_off,
+                    pending = waiting+self.backing_off,
+                    attempts = self.attempts,
+                    failures = self.failures)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, dest):
+        "Hold a slot while connecting to *dest*"
+        await self._acquire(dest)
+        self.attempts += 1
+        try: yield
+        except Exception:
+            self.failures += 1
+            raise
+        finally: self._release()
+
+    async def _acquire(self, dest):
+        if self.in_progress < self.max_concurrent and not self.waiting:
+            self.in_progress += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-dest.last_connected, next(self._sequence), future))
+        self.waiting += 1
+        try: await future
+        except asyncio.CancelledError:
+            # If the slot was handed to us before we were canceled, pass it on
+            if future.done() and not future.cancelled(): self._release()
+            else: self.waiting -= 1
+            raise
+
+    def _release(self):
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None) # the slot passes directly to the waiter
+                self.waiting -= 1
+                return
+        self.in_progress -= 1
+
 class SyncDestinationBase:
 
     '''A SyncDestination represents a SyncManager other than ourselves that can receive (and generate) synchronizations.  The Synchronizable and subclasses of SyncDestination must cooperate to make sure that receiving and object does not create a loop by trying to Synchronize that object back to the sender.  One solution is for should_send on SyncDestination to return False (or raise) if the outgoing object is received from this destination.'''
 
+    #: Time of the last successful connection, used to order connection
+    #attempts.  Kept across restarts only by destinations that store
+    #it, such as :class:`~entanglement.sql.SqlSyncDestination`.
+    last_connected = 0
+
+    #: Smoothed round trip time in seconds measured by keepalive
+    #pings on the current or most recent connection, or None
+    srtt = None
+    #: Variation in round trip time in seconds
+    rttvar = None
+
+    #: Characters that may be sent at once before *bw_per_sec*
+    #applies; None for a tenth of a second at that rate
+    bw_burst = None
+
+    #: If True, the rate is adapted to what the path carries, with
+    #*bw_per_sec* as a ceiling; see :class:`AdaptiveRateController`.
+    bw_adaptive = False
+
+    #: The name of the group added with
+    #:meth:`SyncManager.add_bandwidth_group` whose bandwidth this
+    #destination shares, or None to share only the manager's
+    bw_group = None
+    #: This destination's share of its group's bandwidth relative to other destinations in it
+    bw_weight = 1
+
+    #: True if the current connection resumed the previous session,
+    #so that messages the peer missed were replayed rather than
+    #needing a full resynchronization
+    session_resumed = False
+
     def __init__(self, dest_hash, name, bw_per_sec = 10000000000):
         self.dest_hash = DestHash(dest_hash)
         self.name = name
@@ -551,7 +1066,11 @@ class SyncDestinationBase:
         '''
         self.protocol = protocol
         self.bwprotocol = bwprotocol
-        bwprotocol.bw_per_quantum = self.bw_per_sec*bwprotocol.bw_quantum
+        bwprotocol.chars_per_sec = self.bw_per_sec
+        if self.bw_burst is not None: bwprotocol.burst = self.bw_burst
+        bwprotocol.budget = manager._destination_budget(self)
+        if self.bw_adaptive and getattr(bwprotocol, 'transport', None) is not None:
+            AdaptiveRateController(bwprotocol, bwprotocol.transport, ceiling = self.bw_per_sec)
         for cb in self._on_connected_cbs:
             manager.loop.call_soon(cb)
             
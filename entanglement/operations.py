@@ -8,6 +8,7 @@
 # LICENSE for details.
 
 
+import inspect
 from . import interface
 
 # We assume objects have a method sync_owner that will return their owner or None if locally owned.  We assume that sync_owners have a method dest_hash that returns a hash of their destination and that the context has both a sender and owner 
@@ -23,10 +24,26 @@ class SyncOperation:
         res = None
         if callable(meth):
             res =  meth(obj, registry = registry, **info)
-        self.flood(obj, registry = registry, **info)
-        if callable(meth_post_flood): meth_post_flood(obj, registry = registry, **info)
+            if inspect.isawaitable(res):
+                # A coroutine handler; flood once it completes
+                return self._incoming_async(res, obj, registry, meth_post_flood, info)
+        self._flood_received(obj, registry, meth_post_flood, info)
         return res
 
+    async def _incoming_async(self, res, obj, registry, meth_post_flood, info):
+        res = await res
+        self._flood_received(obj, registry, meth_post_flood, info)
+        return res
+
+    def _flood_received(self, obj, registry, meth_post_flood, info):
+        def flood():
+            self.flood(obj, registry = registry, **info)
+            if callable(meth_post_flood): meth_post_flood(obj, registry = registry, **info)
+        # A context with hold_flood may run the flood later, such as
+        # once the transaction holding obj commits.
+        hold_flood = getattr(info.get('context'), 'hold_flood', None)
+        if hold_flood is None or not hold_flood(flood): flood()
+
     def __str__(self):
         return  self.name #should be set by subclasses
 
@@ -6,10 +6,13 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
 
-import asyncio, json, logging, struct, socket, weakref
+import asyncio, collections, json, logging, os, struct, socket, weakref
 from ..util import CertHash, DestHash
-from ..interface import SyncError, SyncBadEncodingError, UnregisteredSyncClass
+from ..interface import Synchronizable, SyncError, SyncBadEncodingError, UnregisteredSyncClass
+from ..types import wire_codecs
 from .dirty import DirtyMember, DirtyQueue
+from .session import ResumableSession
+from .shm import ShmSegment
 
 
 logger = logging.getLogger("entanglement")
@@ -23,6 +26,8 @@ assert _msg_header_size == 8
 _MSG_FLAG_RESPONSE_NEEDED = 1
 _MSG_FLAGS_CRITICAL = 0xffff
 _MSG_FLAGS_UNDERSTOOD = _MSG_FLAG_RESPONSE_NEEDED
+# An empty message telling a peer using shared memory to check its rings
+_MSG_FLAG_WAKEUP = 0x10000
 # If a message is received where flags&(_MSG_FLAGS_CRITICAL & (~_MSG_FLAGS_UNDERSTOOD)) != 0, then we throw away the connection because we don't understand critical extensions
 
 class ResponseReceiver:
@@ -137,6 +142,49 @@ class SyncProtocolBase:
         self.task = None
         self.dest = dest
         self._incoming = incoming
+        # Coroutine incoming handlers: all running tasks, the latest
+        # task for each object key, and a future the reader waits on
+        # when too many are running.
+        self._incoming_tasks = set()
+        self._incoming_by_key = {}
+        self._incoming_waiter = None
+        # Urgent messages sent during the current pause
+        self._urgent_sent = 0
+        # Keepalive: the outstanding ping and when it was sent, a
+        # pong owed to the peer, and when anything was last received.
+        self._ping_id = 0
+        self._ping_sent = None
+        self._ping_pending = False
+        self._pong_due = None
+        self._peer_pongs = False
+        self._last_received = self.loop.time()
+        #: Smoothed round trip time in seconds, or None before the first measurement
+        self.srtt = None
+        #: Round trip time variation in seconds
+        self.rttvar = None
+        #: The :class:`ResumableSession` with our destination, if any
+        self.session = None
+        #: A future set to whether the session was resumed once the
+        #peer's hello is handled
+        self.resumed = None
+        self._hello_pending = None
+        self._resume_timer = None
+        self._goodbye_pending = False
+        #: True once the peer has said it is shutting down
+        self.peer_goodbye = False
+        #: The compact encodings both we and the peer offered; see
+        #:data:`entanglement.types.supported_codecs`
+        self.codecs = frozenset()
+        self._codecs_pending = None
+        #: The property names in positional order, and a set of them, for
+        #each sync_type whose schema fingerprint matches the peer's
+        self.positional = {}
+        #: While nonzero, such as during a resynchronization, runs of
+        #queued objects of one class are sent in columnar batches
+        self._batching = 0
+        self._schemas = None
+        self._schemas_fingerprint = None
+        self._schemas_pending = None
 
     def is_closed(self):
         return self.loop is None
@@ -151,6 +199,26 @@ class SyncProtocolBase:
             self.dirty.add_or_replace(elt)
         if self.task is None:
             self.task = self.loop.create_task(self._run_sync())
+        elif self.waiter and priority is not None and priority <= self._manager.urgent_priority:
+            self._send_urgent()
+
+    def _send_urgent(self):
+        """While writing is paused, send queued messages with priority at
+        or below the manager's urgent_priority ahead of bulk data, up to
+        urgent_budget messages per pause.  This bounds how long an urgent
+        message waits behind a bulk transfer to the data already handed
+        to the transport.
+        """
+        if self.is_closed() or not self.waiter or self._resuming(): return
+        manager = self._manager
+        queue = self.current_dirty
+        while queue.heap and queue.heap[0].priority <= manager.urgent_priority \
+              and self._urgent_sent < manager.urgent_budget:
+            elt = queue.pop()
+            self._urgent_sent += 1
+            try: self._send_sync_message(elt)
+            except:
+                logger.exception("Error sending {}".format(repr(elt.obj)))
 
     def sync_drain(self):
         "Returns a future; when this future is done, all objects synchronized before sync_drain is called have been sent.  Note that some objects synchronized after sync_drain is called may have been sent."
@@ -169,6 +237,17 @@ class SyncProtocolBase:
                 fut.set_result(True)
                 return fut
 
+    def _queued(self):
+        "The number of entries waiting to be sent"
+        queued = len(self.current_dirty)
+        if self.dirty is not self.current_dirty: queued += len(self.dirty)
+        return queued
+
+    def _send_goodbye(self):
+        "Tell the peer we are shutting down and will close the connection"
+        self._goodbye_pending = True
+        self._send_sync_message(None)
+
     def _no_response(self, msgnums):
         self._no_resp_for.extend(msgnums)
         self._schedule_meta()
@@ -179,13 +258,17 @@ class SyncProtocolBase:
         self.task = self.loop.create_task(self._run_sync())
 
     async def _run_sync(self):
+        if self._resuming(): await self.resumed
         if self.waiter: await self.waiter
         try:
             while True:
                 elt = self.current_dirty.pop()
-                try:self._send_sync_message(elt)
-                except:
-                    logger.exception("Error sending {}".format(repr(elt.obj)))
+                batch = self._collect_batch(elt)
+                if batch: self._send_batch(batch)
+                else:
+                    try:self._send_sync_message(elt)
+                    except:
+                        logger.exception("Error sending {}".format(repr(elt.obj)))
                 if self.waiter: await self.waiter
         except StopIteration: #empty set
             self.task = None
@@ -198,35 +281,177 @@ class SyncProtocolBase:
                     self.task = self.loop.create_task(self._run_sync())
 
     def _send_sync_message(self, elt):
-        flags = 0
-        responses_to = None
-        if elt and elt.response_for:
-            if elt.response_for.no_response_yet:
-                flags |= _MSG_FLAG_RESPONSE_NEEDED
-                self._expected[self._out_counter] = elt.response_for
-            responses_to = elt.response_for.responses_to(self)
+        response_for = None
         if elt:
             obj = elt.obj
-            sync_rep = obj.to_sync(attributes = elt.attrs)
-            if responses_to:
-                sync_rep['_resp_for'] = responses_to
+            response_for = elt.response_for
+            if self.codecs:
+                token = wire_codecs.set(self.codecs)
+                try: sync_rep = obj.to_sync(attributes = elt.attrs)
+                finally: wire_codecs.reset(token)
+            else: sync_rep = obj.to_sync(attributes = elt.attrs)
             sync_rep['_sync_type'] = obj.sync_type
+            if self.positional:
+                schema = self.positional.get(obj.sync_type)
+                if schema: sync_rep = _to_positional(sync_rep, *schema)
             if elt.operation != 'sync':
                 sync_rep['_sync_operation'] = elt.operation.sync_value()
         else:
             sync_rep = {}
+        self._send_frame(sync_rep, response_for)
+
+    def _collect_batch(self, elt):
+        """While batching, return *elt* and the entries queued after it
+        for objects of the same class, to be sent as one columnar
+        message; otherwise None to send *elt* alone.  Order is kept.
+        """
+        size = self._manager.columnar_batch_size
+        if not (self._batching and size and 'columnar' in self.codecs and _batchable(elt)):
+            return None
+        queue = self.current_dirty
+        heap = queue.heap
+        cls = elt.obj.__class__
+        batch = [elt]
+        while heap and len(batch) < size:
+            next_elt = heap[0]
+            if next_elt.obj.__class__ is not cls or next_elt.priority != elt.priority \
+               or next_elt.attrs != elt.attrs or not _batchable(next_elt):
+                break
+            batch.append(queue.pop())
+        return batch if len(batch) > 1 else None
+
+    def _send_batch(self, batch):
+        "Send *batch* as one columnar message, or its entries one by one if they differ"
+        obj = batch[0].obj
+        try:
+            columns = self._encode_columns(obj.__class__, [elt.obj for elt in batch], batch[0].attrs)
+            # Encoding before anything is sent means a value JSON
+            #cannot carry sends the batch one by one below.
+            if columns is not None: size = len(json.dumps(columns))
+        except Exception: columns = None # Each is sent alone, reporting the failure
+        if columns is None:
+            for elt in batch:
+                try: self._send_sync_message(elt)
+                except:
+                    logger.exception("Error sending {}".format(repr(elt.obj)))
+            return
+        try: self._send_columns(obj.sync_type, columns, len(batch), size)
+        except:
+            logger.exception("Error sending a batch of {} {}".format(len(batch), obj.sync_type))
+
+    def _encode_columns(self, cls, objs, attributes):
+        token = wire_codecs.set(self.codecs)
+        try:
+            if cls.to_sync is Synchronizable.to_sync:
+                return cls._sync_encode_columns(objs, attributes)
+            reps = [obj.to_sync(attributes = attributes) for obj in objs]
+        finally: wire_codecs.reset(token)
+        keys = reps[0].keys()
+        if any(rep.keys() != keys for rep in reps): return None
+        return {k: [rep[k] for rep in reps] for k in keys}
+
+    def _send_columns(self, sync_type, columns, count, size, exact = True):
+        # Halve batches that may not fit in a frame, leaving room for
+        #metadata.  *size* is the encoded size of *columns*, or if not
+        #*exact* a bound on it, which is measured only when too large.
+        if count > 1 and size > _max_frame//2:
+            if not exact: size = len(json.dumps(columns))
+            if size > _max_frame//2:
+                half = count//2
+                self._send_columns(sync_type, {k: c[:half] for k, c in columns.items()}, half, size, False)
+                self._send_columns(sync_type, {k: c[half:] for k, c in columns.items()}, count-half, size, False)
+                return
+        self._send_frame({'_sync_type': sync_type, '_columns': columns}, None)
+
+    def _send_frame(self, sync_rep, response_for, replay = False):
+        flags = 0
+        if response_for:
+            if response_for.no_response_yet:
+                flags |= _MSG_FLAG_RESPONSE_NEEDED
+                self._expected[self._out_counter] = response_for
+            # Responses to the peer's requests on an earlier
+            # connection cannot be matched up, so are not replayed.
+            responses_to = None if replay else response_for.responses_to(self)
+            if responses_to:
+                sync_rep['_resp_for'] = responses_to
+        if sync_rep and self.session:
+            self.session.record(sync_rep, response_for)
         new_flags = self._handle_meta_out(flags, sync_rep)
         if len(sync_rep) == 0: return
         self._send_json(sync_rep, new_flags)
         self._out_counter += 1
 
+    def _start_session(self):
+        """Start or continue the :class:`ResumableSession` with our
+        destination.  Our hello is the first message on the connection.
+        If the peer may resume, data is held back until its hello
+        arrives so that missed messages are replayed first.
+        """
+        manager = self._manager
+        dest = self.dest
+        self.resumed = self.loop.create_future()
+        # Our offer of compact encodings rides on the first message
+        if manager.wire_codecs:
+            self._codecs_pending = sorted(manager.wire_codecs)
+        if manager.positional_encoding:
+            self._schemas, self._schemas_pending = manager._sync_schemas()
+            self._schemas_fingerprint = self._schemas_pending
+        if not manager.replay_buffer_size or dest.dest_hash == manager.cert_hash:
+            self.resumed.set_result(False)
+            return
+        session = manager._sessions.get(dest.dest_hash)
+        if session is None:
+            session = manager._sessions[dest.dest_hash] = ResumableSession(manager, dest)
+        self.session = session
+        session.attach(self)
+        self._hello_pending = session.hello()
+        self._send_sync_message(None)
+        if len(self.dirty): self._schedule_meta()
+        if session.peer_resumes:
+            self._resume_timer = self.loop.call_later(
+                manager.resume_timeout, self._session_started, False)
+        else: self._session_started(False)
+
+    def _resuming(self):
+        return self.resumed is not None and not self.resumed.done()
+
+    def _handle_hello(self, hello):
+        if self.session is None: return
+        frames = self.session.peer_hello(hello)
+        if not self._resuming(): return
+        if frames is not None:
+            protocol_logger.debug("Replaying {} messages to {}".format(len(frames), self.dest))
+            for sync_rep, response_for in frames:
+                sync_rep = {k: v for k, v in sync_rep.items() if k not in _frame_meta}
+                if '_pos' in sync_rep:
+                    # Sent by name until this connection's schemas are compared
+                    cls, registry = self._manager._find_registered_class(sync_rep['_sync_type'])
+                    _from_positional(sync_rep, cls._sync_schema()[0])
+                self._send_frame(sync_rep, response_for, replay = True)
+        self._session_started(frames is not None)
+
+    def _session_started(self, resumed):
+        if self._resume_timer:
+            self._resume_timer.cancel()
+            self._resume_timer = None
+        if self.dest is not None: self.dest.session_resumed = resumed
+        if not self.resumed.done(): self.resumed.set_result(resumed)
+        if resumed: logger.info("Resumed session with {}".format(self.dest))
+
 
 
     def _handle_receive(self, sync_repr, flags):
+        self._last_received = self.loop.time()
+        data = '_sync_type' in sync_repr
+        response_for = None
         try:
             self._handle_meta(sync_repr, flags)
             if '_sync_type' not in sync_repr: # metadata only
                 return
+            if '_columns' in sync_repr:
+                self._receive_columns(sync_repr)
+                return
+            if '_pos' in sync_repr: self._from_positional(sync_repr)
             response_for = None
             if flags&_MSG_FLAG_RESPONSE_NEEDED:
                 response_for = ResponseReceiver()
@@ -246,19 +471,59 @@ class SyncProtocolBase:
                 del sync_repr['_resp_for']
             self._manager._sync_receive(sync_repr, self, response_for = response_for)
         except Exception as e:
-            if isinstance(e,(SyncError,UnregisteredSyncClass)):
-                logger.error(str(e))
-            else:
-                logger.exception("Error receiving {}".format(sync_repr))
-            if isinstance(e,SyncError) and not '_sync_is_error' in sync_repr:
-                self._manager.synchronize(e,
-                                          destinations = [self.dest],
-                                          response_for = response_for,
-                                          operation = 'error')
+            self._receive_failed(e, sync_repr, response_for)
         finally:
             self._in_counter += 1
+            if data and self.session: self.session.received += 1
             response_for = None
 
+    def _schedule_incoming(self, obj, start):
+        """Run the coroutine returned by *start*, the remainder of
+        receiving *obj* from a coroutine incoming handler.  *start* is
+        passed the task for the previous message about *obj* that is
+        still being handled, or None; the coroutine finishes that
+        first.  While such a task is pending, synchronous handlers for
+        *obj* are deferred too (see :meth:`_incoming_pending`), so all
+        handlers for the same object run in the order received;
+        handlers for different objects run concurrently.  Handlers
+        still running when the connection is lost are canceled.
+        """
+        key = self._incoming_key(obj)
+        task = self.loop.create_task(start(self._incoming_by_key.get(key)))
+        self._incoming_by_key[key] = task
+        self._incoming_tasks.add(task)
+        task.add_done_callback(lambda t: self._incoming_done(key, t))
+
+    @staticmethod
+    def _incoming_key(obj):
+        try: return (obj.sync_type, obj.sync_hash())
+        except Exception: return id(obj)
+
+    def _incoming_pending(self, obj):
+        "Whether a coroutine handler for an earlier message about *obj* has yet to finish"
+        return bool(self._incoming_by_key) and self._incoming_key(obj) in self._incoming_by_key
+
+    def _incoming_done(self, key, task):
+        self._incoming_tasks.discard(task)
+        if self._incoming_by_key.get(key) is task:
+            del self._incoming_by_key[key]
+        if self._incoming_waiter and not self._incoming_full():
+            if not self._incoming_waiter.done():
+                self._incoming_waiter.set_result(None)
+            self._incoming_waiter = None
+
+    def _incoming_full(self):
+        manager = getattr(self, '_manager', None)
+        if manager is None: return False
+        return len(self._incoming_tasks) >= manager.max_incoming_tasks
+
+    async def _wait_incoming_capacity(self):
+        "Wait until fewer than the manager's max_incoming_tasks coroutine handlers are running"
+        while self._incoming_full():
+            if self._incoming_waiter is None:
+                self._incoming_waiter = self.loop.create_future()
+            await self._incoming_waiter
+
     def _handle_meta(self, sync_repr, flags):
         if '_no_resp_for' in sync_repr:
             for msgnum in sync_repr['_no_resp_for']:
@@ -268,13 +533,141 @@ class SyncProtocolBase:
                     r.no_response()
                 except KeyError: pass
             del sync_repr['_no_resp_for']
+        if '_pong' in sync_repr:
+            self._handle_pong(sync_repr.pop('_pong'))
+        if '_ping' in sync_repr:
+            # Answer at once rather than behind queued objects so the
+            # peer measures the network rather than our queue.
+            self._pong_due = sync_repr.pop('_ping')
+            if not self.is_closed(): self._send_sync_message(None)
+        if '_hello' in sync_repr:
+            self._handle_hello(sync_repr.pop('_hello'))
+        if '_codecs' in sync_repr:
+            self.codecs = self._manager.wire_codecs & frozenset(sync_repr.pop('_codecs'))
+        if '_schemas' in sync_repr:
+            self._handle_schemas(sync_repr.pop('_schemas'))
+        if sync_repr.pop('_goodbye', False):
+            logger.info("{} is shutting down".format(self.dest))
+            self.peer_goodbye = True
 
     def _handle_meta_out(self, flags, sync_repr):
+        if self._hello_pending is not None:
+            sync_repr['_hello'] = self._hello_pending
+            self._hello_pending = None
+        if self._codecs_pending is not None:
+            sync_repr['_codecs'] = self._codecs_pending
+            self._codecs_pending = None
+        if self._schemas_pending is not None:
+            sync_repr['_schemas'] = self._schemas_pending
+            self._schemas_pending = None
         if self._no_resp_for:
             sync_repr['_no_resp_for'] = list(self._no_resp_for)
             self._no_resp_for.clear()
+        if self._pong_due is not None:
+            sync_repr['_pong'] = self._pong_due
+            self._pong_due = None
+        if self._ping_pending:
+            sync_repr['_ping'] = self._ping_id
+            self._ping_pending = False
+        if self._goodbye_pending:
+            sync_repr['_goodbye'] = True
+            self._goodbye_pending = False
         return flags
 
+    def _receive_columns(self, sync_repr):
+        "Receive each object in a columnar batch as if it were sent alone"
+        columns = sync_repr.pop('_columns')
+        if not isinstance(columns, dict) or len(set(map(len, columns.values()))) > 1:
+            raise SyncBadEncodingError('Columns of a batch must be lists of equal length', msg = sync_repr)
+        keys = tuple(columns)
+        for row in zip(*columns.values()):
+            msg = dict(zip(keys, row))
+            msg.update(sync_repr)
+            # One bad object must not lose the rest of the batch
+            try: self._manager._sync_receive(msg, self, response_for = None)
+            except Exception as e:
+                self._receive_failed(e, msg, None)
+
+    def _receive_failed(self, e, sync_repr, response_for):
+        "Log an error receiving *sync_repr* and report it to the peer"
+        if isinstance(e,(SyncError,UnregisteredSyncClass)):
+            logger.error(str(e))
+        else:
+            logger.exception("Error receiving {}".format(sync_repr))
+        if isinstance(e,SyncError) and not '_sync_is_error' in sync_repr:
+            self._manager.synchronize(e,
+                                      destinations = [self.dest],
+                                      response_for = response_for,
+                                      operation = 'error')
+
+    def _handle_schemas(self, fingerprints):
+        """Allow positional encoding of the classes whose schemas match
+        the peer's.  Each side first sends one fingerprint covering all
+        its classes; if those differ, both send the fingerprint of each
+        class.
+        """
+        schemas = self._schemas
+        if schemas is None: return # We did not offer ours
+        if isinstance(fingerprints, str):
+            if fingerprints == self._schemas_fingerprint:
+                self.positional = {t: (names, frozenset(names)) for t, (names, fingerprint) in schemas.items()}
+            else:
+                self._schemas_pending = {t: fingerprint for t, (names, fingerprint) in schemas.items()}
+                self._send_sync_message(None)
+            return
+        self.positional = {t: (names, frozenset(names)) for t, (names, fingerprint) in schemas.items()
+                           if fingerprints.get(t) == fingerprint}
+
+    def _from_positional(self, sync_repr):
+        schema = self.positional.get(sync_repr['_sync_type'])
+        if schema is None:
+            raise SyncBadEncodingError('Positional encoding of {} without matching schemas'.format(
+                sync_repr['_sync_type']), msg = sync_repr)
+        try: _from_positional(sync_repr, schema[0])
+        except (StopIteration, TypeError, ValueError):
+            raise SyncBadEncodingError('Positional encoding does not match the schema of {}'.format(
+                sync_repr['_sync_type']), msg = sync_repr) from None
+
+    def _send_ping(self):
+        "Send a ping; the peer's pong updates :attr:`srtt`."
+        self._ping_id += 1
+        self._ping_sent = self.loop.time()
+        self._ping_pending = True
+        self._send_sync_message(None)
+
+    def _handle_pong(self, ping_id):
+        if ping_id != self._ping_id or self._ping_sent is None: return
+        sample = self.loop.time()-self._ping_sent
+        self._ping_sent = None
+        self._peer_pongs = True
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample/2
+        else:
+            self.rttvar = 3/4*self.rttvar + 1/4*abs(self.srtt-sample)
+            self.srtt = 7/8*self.srtt + 1/8*sample
+        if self.dest is not None:
+            self.dest.srtt = self.srtt
+            self.dest.rttvar = self.rttvar
+
+    def _keepalive_check(self):
+        """Called every keepalive_interval.  Returns False and closes the
+        connection if the peer has stopped responding; otherwise sends a
+        ping.  Peers that have never answered a ping (older versions)
+        are never considered dead.
+        """
+        idle = self.loop.time()-self._last_received
+        if self._peer_pongs and idle > self._manager.keepalive_timeout:
+            logger.error("Nothing received from {} in {:.1f} seconds; closing connection".format(self.dest, idle))
+            self._abort(TimeoutError("keepalive timeout"))
+            return False
+        self._send_ping()
+        return True
+
+    def _abort(self, exc):
+        "Close without waiting for buffered data to be written, as for a dead peer."
+        self.connection_lost(exc)
+
     def data_received(self, data):
         self.reader.feed_data(data)
 
@@ -286,6 +679,12 @@ class SyncProtocolBase:
         if self.loop.is_closed(): return
         if self.task: self.task.cancel()
         if self.waiter: self.waiter.cancel()
+        if self._incoming_waiter: self._incoming_waiter.cancel()
+        # Handlers must not go on with a dead protocol as the sender
+        for task in self._incoming_tasks: task.cancel()
+        if self._resume_timer: self._resume_timer.cancel()
+        if self._resuming(): self.resumed.cancel()
+        if self.session: self.session.detach(self)
         if self.dest:
             self._manager._connection_lost(self, exc)
         self.loop = None
@@ -298,11 +697,16 @@ class SyncProtocolBase:
     def pause_writing(self):
         if self.waiter: return
         self.waiter = self.loop.create_future()
+        # Urgent messages already queued may go out during the pause;
+        # not from here since we are inside a write.
+        self.loop.call_soon(self._send_urgent)
 
     def resume_writing(self):
         assert self.waiter is not None
-        self.waiter.set_result(None)
+        # Cancelled if the connection was closed while paused
+        if not self.waiter.done(): self.waiter.set_result(None)
         self.waiter = None
+        self._urgent_sent = 0
 
     @property
     def confirm_outgoing_dest_hash(self):
@@ -311,6 +715,52 @@ class SyncProtocolBase:
 
 
 
+# Keys added to a data message for a particular connection, removed
+# when it is replayed
+_frame_meta = frozenset(('_resp_for', '_no_resp_for', '_ping', '_pong',
+                         '_hello', '_codecs', '_schemas', '_flags'))
+
+# The largest frame a peer accepts
+_max_frame = 65536
+
+def _batchable(elt):
+    # Entries that need no response and no per-message operation
+    return elt.response_for is None and elt.operation == 'sync'
+
+def _to_positional(sync_rep, names, name_set):
+    # Returns sync_rep with the properties in *names* in a _pos list
+    # in that order, with a _mask of those present unless all are.
+    try:
+        positional = {'_pos': [sync_rep[k] for k in names]}
+    except KeyError:
+        values = []
+        mask = 0
+        bit = 1
+        for k in names:
+            if k in sync_rep:
+                values.append(sync_rep[k])
+                mask |= bit
+            bit <<= 1
+        positional = {'_pos': values, '_mask': mask}
+    for k in sync_rep.keys() - name_set: positional[k] = sync_rep[k]
+    return positional
+
+def _from_positional(sync_rep, names):
+    # The reverse of _to_positional
+    values = sync_rep.pop('_pos')
+    mask = sync_rep.pop('_mask', None)
+    if mask is None:
+        if len(values) != len(names): raise ValueError
+        sync_rep.update(zip(names, values))
+        return
+    values = iter(values)
+    for k in names:
+        if mask&1: sync_rep[k] = next(values)
+        mask >>= 1
+    if mask or next(values, _no_value) is not _no_value: raise ValueError
+
+_no_value = object()
+
 sync_magic_attributes = ('_sync_type', '_sync_is_error',
                          '_resp_for', '_no_resp',
                          '_sync_operation',
@@ -325,38 +775,54 @@ class SyncProtocol(SyncProtocolBase, asyncio.Protocol):
         self.transport = None
         self.reader = asyncio.StreamReader(loop = self.loop)
         self.reader_task = None
+        self.keepalive_task = None
+        #: The :class:`ShmSegment` carrying messages to a peer on this host, if any
+        self.shm = None
 
     def _send_json(self, sync_rep, flags):
         js = bytes(json.dumps(sync_rep), 'utf-8')
         protocol_logger.debug("#{c}: Sending `{js}' to {d} (flags {f})".format(
             js = js, d = self.dest,
             c = self._out_counter, f = flags))
-        assert len(js) <= 65536
+        assert len(js) <= _max_frame
         header = struct.pack(_msg_header, len(js), flags)
-        self.transport.write(header + js)
+        self._write_frame(header + js)
+
+    def _write_frame(self, frame):
+        self.transport.write(frame)
 
     async def _read_task(self):
         while True:
             header = await self.reader.readexactly(_msg_header_size)
             jslen, flags = struct.unpack(_msg_header, header)
-            assert jslen <= 65536
+            assert jslen <= _max_frame
             if flags&(_MSG_FLAGS_CRITICAL&(~_MSG_FLAGS_UNDERSTOOD)) != 0:
                 self.close()
                 raise ValueError("Flags contained unknown critical option")
 
-            js = await self.reader.readexactly(jslen)
-            protocol_logger.debug("#{c}: Receiving {js} from {d} (flags {f})".format(
-                f = flags, c = self._in_counter,
-                js = js, d = self.dest))
-            sync_repr = json.loads(str(js, 'utf-8'))
-            self._handle_receive(sync_repr, flags)
+            if not flags&_MSG_FLAG_WAKEUP:
+                js = await self.reader.readexactly(jslen)
+                await self._receive_frame(js, flags)
+            if self.shm is not None:
+                await self._shm_wakeup()
+
+    async def _receive_frame(self, js, flags):
+        protocol_logger.debug("#{c}: Receiving {js} from {d} (flags {f})".format(
+            f = flags, c = self._in_counter,
+            js = js, d = self.dest))
+        sync_repr = json.loads(str(js, 'utf-8'))
+        self._handle_receive(sync_repr, flags)
+        if self._incoming_tasks and self._incoming_full():
+            await self._wait_incoming_capacity()
 
     def connection_lost(self, exc):
         if getattr(self, 'loop', None) is None: return
         if not self.loop.is_closed():
             self.reader.feed_eof()
             if self.reader_task: self.reader_task.cancel()
+            if self.keepalive_task: self.keepalive_task.cancel()
             super().connection_lost(exc)
+        if self.shm is not None: self._shm_close()
         del self.transport
         del self._manager
         del self._expected
@@ -370,20 +836,52 @@ class SyncProtocol(SyncProtocolBase, asyncio.Protocol):
     def connection_made(self, transport, bwprotocol):
         self.transport = transport
         self.bwprotocol = bwprotocol
+        self._limit_buffering(transport)
         self.reader.set_transport(transport)
         self._manager._transports.append(weakref.ref(self.transport))
         if self._incoming:
             self.loop.create_task(self._manager._incoming_connection(self))
 
+    def _limit_buffering(self, transport):
+        """Bound the data that can be queued ahead of an urgent message:
+        the transport pauses at the manager's write_buffer_high, and on
+        TCP the kernel keeps at most tcp_notsent_lowat unsent bytes.
+        """
+        manager = self._manager
+        transport.set_write_buffer_limits(high = manager.write_buffer_high)
+        sock = transport.get_extra_info('socket')
+        lowat = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+        if manager.tcp_notsent_lowat and lowat and sock is not None \
+           and sock.family in (socket.AF_INET, socket.AF_INET6):
+            try: sock.setsockopt(socket.IPPROTO_TCP, lowat, manager.tcp_notsent_lowat)
+            except OSError: pass
+
     def _enable_reading(self):
         "Callback from manager to enable reading after any authentication"
+        if self.resumed is None: self._start_session()
         self.reader_task = self.loop.create_task(self._read_task())
         self.reader_task._log_destroy_pending = False
+        if self._manager.keepalive_interval and self.keepalive_task is None:
+            self.keepalive_task = self.loop.create_task(self._keepalive())
+
+    async def _keepalive(self):
+        while not self.is_closed():
+            await asyncio.sleep(self._manager.keepalive_interval)
+            if self.is_closed() or not self._keepalive_check(): return
+
+    def _abort(self, exc):
+        transport = self.transport
+        super()._abort(exc)
+        if transport: transport.abort()
 
     @property
     def dest_hash(self):
         if  not self.transport: return None
-        return CertHash.from_der_cert(self.transport.get_extra_info('ssl_object').getpeercert(True))
+        # The peer certificate cannot change during a connection
+        try: return self._dest_hash
+        except AttributeError: pass
+        self._dest_hash = CertHash.from_der_cert(self.transport.get_extra_info('ssl_object').getpeercert(True))
+        return self._dest_hash
 
     @property
     def der_cert(self):
@@ -392,6 +890,146 @@ class SyncProtocol(SyncProtocolBase, asyncio.Protocol):
 
 class UnixProtocol(SyncProtocol):
 
+    '''A connection over a unix socket.  When the peer runs as the same
+    user, messages move to a pair of shared memory rings negotiated
+    over the socket, avoiding a system call and kernel copy for each
+    message; the socket then only carries wakeups.  The side that
+    connected offers a :class:`ShmSegment` in a ``_shm`` meta message;
+    each side's ``_shm_on`` is the last message it sends on the socket.
+    Shared memory is not subject to bandwidth limits.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shm_meta = {}
+        self._shm_in = None
+        self._shm_out = None
+        self._shm_switch = None # Write to this ring after the next message
+        self._shm_backlog = collections.deque()
+        self._shm_paused = False
+
+    def _enable_reading(self):
+        super()._enable_reading()
+        if not self._incoming: self._offer_shm()
+
+    def _same_user(self):
+        credentials = self.credentials
+        return credentials is not None and credentials[2] == os.getuid()
+
+    def _offer_shm(self):
+        size = self._manager.shm_ring_size
+        if not size or self.shm is not None or not self._same_user(): return
+        try: self.shm = ShmSegment(max(size, _msg_header_size+65536))
+        except OSError as e:
+            logger.error("Unable to create shared memory for {}: {}".format(self.dest, e))
+            return
+        self._shm_meta['_shm'] = {'path': self.shm.path, 'size': self.shm.size}
+        self._send_sync_message(None)
+
+    def _shm_offered(self, offer):
+        if self._manager.shm_ring_size and self.shm is None and self._same_user():
+            try:
+                self.shm = ShmSegment(int(offer['size']), path = offer['path'], uid = os.getuid())
+            except (OSError, ValueError, LookupError, TypeError) as e:
+                logger.error("Not using shared memory with {}: {}".format(self.dest, e))
+        self._shm_meta['_shm_on'] = self.shm is not None
+        if self.shm is not None: self._shm_switch = self.shm.rings[1]
+        self._send_sync_message(None)
+
+    def _shm_on(self, on):
+        if self.shm is None: return
+        if not on:
+            self._shm_close()
+            return
+        creator = self.shm.path is not None
+        if creator:
+            # The peer has mapped the segment and switched; now we do
+            self.shm.unlink()
+            self._shm_meta['_shm_on'] = True
+            self._shm_switch = self.shm.rings[0]
+            self._send_sync_message(None)
+        self._shm_in = self.shm.rings[1 if creator else 0]
+
+    def _handle_meta(self, sync_repr, flags):
+        if '_shm' in sync_repr:
+            self._shm_offered(sync_repr.pop('_shm'))
+        if '_shm_on' in sync_repr:
+            self._shm_on(sync_repr.pop('_shm_on'))
+        super()._handle_meta(sync_repr, flags)
+
+    def _handle_meta_out(self, flags, sync_repr):
+        if self._shm_meta:
+            sync_repr.update(self._shm_meta)
+            self._shm_meta.clear()
+        return super()._handle_meta_out(flags, sync_repr)
+
+    def _write_frame(self, frame):
+        ring = self._shm_out
+        if ring is None:
+            self.transport.write(frame)
+            if self._shm_switch is not None:
+                self._shm_out, self._shm_switch = self._shm_switch, None
+        elif self._shm_backlog or not ring.write(frame):
+            self._shm_backlog.append(frame)
+            # Ask the peer to wake us when it frees space, then
+            # check again in case it already has.
+            ring.writer_waiting = True
+            self._shm_flush()
+            if self._shm_backlog and not self.waiter:
+                self._shm_paused = True
+                self.pause_writing()
+        elif ring.reader_waiting:
+            ring.reader_waiting = False
+            self._wakeup_peer()
+
+    def _wakeup_peer(self):
+        self.transport.write(struct.pack(_msg_header, 0, _MSG_FLAG_WAKEUP))
+
+    def _shm_flush(self):
+        ring = self._shm_out
+        backlog = self._shm_backlog
+        written = False
+        while backlog and ring.write(backlog[0]):
+            backlog.popleft()
+            written = True
+        if written and ring.reader_waiting:
+            ring.reader_waiting = False
+            self._wakeup_peer()
+        if not backlog:
+            ring.writer_waiting = False
+            if self._shm_paused:
+                self._shm_paused = False
+                if self.waiter: self.resume_writing()
+
+    async def _shm_wakeup(self):
+        "Called by the reader for each message on the socket once shared memory is set up"
+        if self._shm_backlog: self._shm_flush()
+        ring = self._shm_in
+        while ring is not None and self.shm is not None:
+            data = ring.read()
+            if not data:
+                # Have the peer wake us, unless it wrote meanwhile
+                ring.reader_waiting = True
+                data = ring.read()
+                if not data: return
+                ring.reader_waiting = False
+            if ring.writer_waiting:
+                ring.writer_waiting = False
+                self._wakeup_peer()
+            offset = 0
+            while offset < len(data) and self.shm is not None:
+                jslen, flags = struct.unpack_from(_msg_header, data, offset)
+                offset += _msg_header_size
+                await self._receive_frame(data[offset:offset+jslen], flags)
+                offset += jslen
+
+    def _shm_close(self):
+        shm, self.shm = self.shm, None
+        self._shm_in = self._shm_out = self._shm_switch = None
+        self._shm_backlog.clear()
+        shm.unlink()
+        shm.close()
+
     @property
     def credentials(self):
         if self.transport is None: return
@@ -401,7 +1039,12 @@ class UnixProtocol(SyncProtocol):
 
     @property
     def dest_hash(self):
-        return DestHash.from_unix_dest_info(*self.credentials)
+        try: return self._dest_hash
+        except AttributeError: pass
+        credentials = self.credentials
+        if credentials is None: return None
+        self._dest_hash = DestHash.from_unix_dest_info(*credentials)
+        return self._dest_hash
 
     @property
     def confirm_outgoing_dest_hash(self):
@@ -0,0 +1,128 @@
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+import collections, itertools, logging, uuid
+from .dirty import DirtyMember, DirtyQueue
+
+logger = logging.getLogger('entanglement')
+
+class ResumableSession:
+
+    '''State a :class:`SyncManager` keeps for a destination across
+    connections so that after a brief disconnect the peer can pick up
+    where it left off.
+
+    Each side numbers the data messages it sends within a session.
+    When a connection is made, each side sends a hello with its
+    session id and how many messages it has sent, along with the
+    peer's session id and how many of the peer's messages it
+    received.  If the peer still knows our session and the messages
+    it missed are in :attr:`frames`, they are replayed and the
+    session is resumed.  Objects synchronized while disconnected are
+    held in :attr:`pending`.  If *pending* overflows or the
+    destination stays disconnected for the manager's *resume_window*,
+    the session is restarted under a new id and the peer falls back
+    to a full resynchronization.
+    '''
+
+    def __init__(self, manager, dest):
+        self.manager = manager
+        self.dest = dest
+        self.size = manager.replay_buffer_size
+        #: The protocol currently carrying the session, if connected
+        self.protocol = None
+        #: The peer's session id and how many of its data messages we have received
+        self.peer_id = None
+        self.received = 0
+        self.frames = collections.deque(maxlen = self.size)
+        self.pending = DirtyQueue()
+        self._expire_handle = None
+        self._restart()
+
+    def _restart(self):
+        #: Our session id; a new id tells the peer nothing can be replayed
+        self.id = uuid.uuid4().hex
+        #: Data messages sent in this session; *frames* holds the most
+        #recent of them as (sync_repr, response_for).
+        self.sent = 0
+        self.frames.clear()
+        self.pending = DirtyQueue()
+
+    def hello(self):
+        return {'session': self.id, 'sent': self.sent,
+                'peer': self.peer_id, 'received': self.received}
+
+    @property
+    def peer_resumes(self):
+        "True if the peer has sent a hello before and so may resume"
+        return self.peer_id is not None
+
+    def peer_hello(self, hello):
+        """Handle the peer's hello.  Returns the frames the peer missed
+        in the order they were sent, or None if the session cannot be
+        resumed.
+        """
+        self.peer_id = hello.get('session')
+        # The peer's next data message is numbered from here
+        self.received = int(hello.get('sent', 0))
+        if hello.get('peer') != self.id: return None
+        missing = self.sent - int(hello.get('received', -1))
+        if not 0 <= missing <= len(self.frames): return None
+        return list(itertools.islice(self.frames, len(self.frames)-missing, None))
+
+    def record(self, sync_repr, response_for):
+        "Record a data message sent to the peer"
+        self.frames.append((sync_repr, response_for))
+        self.sent += 1
+
+    def _synchronize_object(self, obj, operation, attributes, response_for, priority):
+        "Called by :meth:`SyncManager.synchronize` in place of the protocol while disconnected"
+        if self.protocol is not None:
+            return self.protocol._synchronize_object(
+                obj, operation = operation, attributes = attributes,
+                response_for = response_for, priority = priority)
+        self.pending.add_or_replace(DirtyMember(obj, operation, attributes, response_for, priority))
+        if len(self.pending) > self.size:
+            logger.info("Too many objects queued for {}; it will need to resynchronize".format(self.dest))
+            self.expire()
+
+    def attach(self, protocol):
+        "*protocol* now carries the session; queue anything pending on it"
+        self.cancel_expire()
+        self.protocol = protocol
+        pending, self.pending = self.pending, DirtyQueue()
+        for elt in pending:
+            protocol.dirty.add_or_replace(elt)
+
+    def detach(self, protocol):
+        "*protocol* has lost its connection; keep what it had not sent"
+        if self.protocol is not protocol: return
+        self.protocol = None
+        queues = [protocol.current_dirty]
+        if protocol.dirty is not protocol.current_dirty: queues.append(protocol.dirty)
+        for queue in queues:
+            for elt in queue:
+                self.pending.add_or_replace(elt)
+        manager = self.manager
+        if len(self.pending) > self.size or not manager.resume_window:
+            return self.expire()
+        manager._resumable[self.dest.dest_hash] = self
+        self._expire_handle = manager.loop.call_later(manager.resume_window, self.expire)
+
+    def expire(self):
+        "Give up on resuming; the next connection starts a new session"
+        self.cancel_expire()
+        self._restart()
+        resumable = self.manager._resumable
+        if resumable.get(self.dest.dest_hash) is self:
+            del resumable[self.dest.dest_hash]
+
+    def cancel_expire(self):
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
@@ -0,0 +1,152 @@
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''Shared memory rings carrying frames between two processes on the
+same host.  A :class:`ShmSegment` is a file in shared memory holding
+two :class:`ShmRing`, one for each direction.  The unix socket the
+segment was negotiated over still carries wakeups, so that a reader
+with nothing to do can wait in the event loop.
+'''
+
+import mmap, os, os.path, stat, struct, tempfile, threading
+
+shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+_prefix = 'entanglement-'
+
+# head: bytes ever written; tail: bytes ever read; then flags set by
+# the reader when it waits for data and by the writer when it waits
+# for space.  The header is padded to a cache line.
+_ring_header_size = 64
+_HEAD, _TAIL, _READER_WAITING, _WRITER_WAITING = 0, 8, 16, 20
+
+_fence_lock = threading.Lock()
+
+def _fence():
+    # Acquiring a lock is a full memory barrier, ordering our stores
+    # to the ring before loads of the other side's flags.
+    with _fence_lock: pass
+
+class ShmRing:
+
+    '''A single producer, single consumer byte ring within *mm*
+    starting at *offset*.  Writers add whole frames so readers never
+    see part of one.
+    '''
+
+    def __init__(self, mm, offset, size):
+        self.mm = mm
+        self.offset = offset
+        self.data = offset+_ring_header_size
+        self.size = size
+
+    def _get(self, field, fmt = '=Q'):
+        return struct.unpack_from(fmt, self.mm, self.offset+field)[0]
+
+    def _set(self, field, value, fmt = '=Q'):
+        struct.pack_into(fmt, self.mm, self.offset+field, value)
+
+    def write(self, frame):
+        "Add *frame*; returns False if there is not enough space"
+        head = self._get(_HEAD)
+        length = len(frame)
+        if self.size-(head-self._get(_TAIL)) < length: return False
+        start = head%self.size
+        first = min(length, self.size-start)
+        self.mm[self.data+start:self.data+start+first] = frame[:first]
+        if first < length:
+            self.mm[self.data:self.data+length-first] = frame[first:]
+        _fence()
+        self._set(_HEAD, head+length)
+        _fence()
+        return True
+
+    def read(self):
+        "Return everything written and not yet read, possibly empty"
+        tail = self._get(_TAIL)
+        length = self._get(_HEAD)-tail
+        if not length: return b''
+        _fence()
+        start = tail%self.size
+        first = min(length, self.size-start)
+        data = self.mm[self.data+start:self.data+start+first]
+        if first < length:
+            data += self.mm[self.data:self.data+length-first]
+        self._set(_TAIL, tail+length)
+        _fence()
+        return data
+
+    @property
+    def reader_waiting(self):
+        return bool(self._get(_READER_WAITING, '=I'))
+
+    @reader_waiting.setter
+    def reader_waiting(self, value):
+        self._set(_READER_WAITING, int(value), '=I')
+        _fence()
+
+    @property
+    def writer_waiting(self):
+        return bool(self._get(_WRITER_WAITING, '=I'))
+
+    @writer_waiting.setter
+    def writer_waiting(self, value):
+        self._set(_WRITER_WAITING, int(value), '=I')
+        _fence()
+
+class ShmSegment:
+
+    '''Two rings of *size* bytes in a shared memory file.  The
+    creating side writes to ``rings[0]``; the side that attaches by
+    *path* writes to ``rings[1]``.  The file is created readable only
+    by our user, which is what limits the segment to peers running as
+    the same user.
+    '''
+
+    def __init__(self, size, path = None, uid = None):
+        self.size = size
+        if path is None:
+            fd, self.path = tempfile.mkstemp(prefix = _prefix, dir = shm_dir)
+            try: os.ftruncate(fd, self.length)
+            except: os.close(fd); os.unlink(self.path); raise
+        else:
+            fd = self._open(path, uid)
+            self.path = None # Only the creator unlinks
+        try: self.mm = mmap.mmap(fd, self.length)
+        finally: os.close(fd)
+        self.rings = [ShmRing(self.mm, i*(_ring_header_size+size), size) for i in (0, 1)]
+
+    @property
+    def length(self):
+        return 2*(_ring_header_size+self.size)
+
+    def _open(self, path, uid):
+        "Open a segment named by the peer, checking it is one of ours that the peer created"
+        if os.path.dirname(path) != (shm_dir or tempfile.gettempdir()) \
+           or not os.path.basename(path).startswith(_prefix):
+            raise ValueError("{} is not a shared memory segment".format(path))
+        fd = os.open(path, os.O_RDWR|os.O_NOFOLLOW)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_size != self.length \
+               or (uid is not None and st.st_uid != uid):
+                raise ValueError("{} is not a valid shared memory segment".format(path))
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def unlink(self):
+        "Remove the file once both sides have it mapped or it is no longer needed"
+        if self.path is None: return
+        try: os.unlink(self.path)
+        except FileNotFoundError: pass
+        self.path = None
+
+    def close(self):
+        self.rings = []
+        self.mm.close()
@@ -0,0 +1,33 @@
+# Copyright (C) 2026, Hadron Industries, Inc.
+# Entanglement is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+"""Destination last connected
+
+Revision ID: a3f1c2d4e5b6
+Revises: dc7778ec1ccc
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import entanglement
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c2d4e5b6'
+down_revision = 'dc7778ec1ccc'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('sync_destinations', sa.Column('last_connected', sa.Float(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('sync_destinations', naming_convention = entanglement.sql.base.migration_naming_convention) as s_d:
+        s_d.drop_column('last_connected')
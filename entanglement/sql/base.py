@@ -10,7 +10,7 @@
 import contextlib, datetime, json, sqlalchemy, uuid, warnings
 from datetime import timezone
 
-from sqlalchemy import Column, Table, String, Integer, DateTime, ForeignKey, inspect, TEXT, Index, select
+from sqlalchemy import Column, Table, String, Integer, Float, DateTime, ForeignKey, inspect, TEXT, Index, select
 from sqlalchemy.orm import load_only
 import sqlalchemy.exc
 import sqlalchemy.orm, sqlalchemy.ext.declarative
@@ -287,6 +287,15 @@ def sync_session_maker(*args, **kwargs):
     "Like sql.orm.sessionmaker for SqlSyncSessions"
     return sqlalchemy.orm.sessionmaker(class_ = SqlSyncSession, *args, **kwargs)
 
+def _sync_loaded(target, *args):
+    # Loading, refreshing or expiring sets attributes without
+    # assignment, as does fetching server generated values on flush
+    target.sync_changed()
+
+for _event in ('load', 'refresh', 'refresh_flush', 'expire'):
+    sqlalchemy.event.listen(interface.SyncEncodeCacheMixin, _event, _sync_loaded, propagate = True)
+del _event
+
 class SqlSyncMeta(interface.SynchronizableMeta, sqlalchemy.ext.declarative.DeclarativeMeta):
 
     def __new__(cls, name, bases, ns):
@@ -320,7 +329,13 @@ class SqlSyncRegistry(interface.SyncRegistry):
     def __init__(self, *args,
                  sessionmaker = None,
                  bind = None,
+                 batch_size = None,
+                 batch_interval = 0.05,
                  **kwargs):
+        '''
+        :param batch_size: If set, consecutive incoming messages from a connection share one session and are committed together once *batch_size* messages are pending or *batch_interval* seconds after the first.  If the group commit fails, the batch is received again in halves so that only the failing message is lost.  Objects are flooded only once their group is committed, so a batch that is rolled back has not been propagated; messages needing a response are committed on their own for the same reason.
+
+        '''
         super().__init__(*args, **kwargs)
         self.register_operation('sync', operations.sync_operation)
         self.register_operation( 'delete', operations.delete_operation)
@@ -330,6 +345,10 @@ class SqlSyncRegistry(interface.SyncRegistry):
             sessionmaker = sync_session_maker()
         if bind is not None: sessionmaker.configure(bind = bind)
         self.sessionmaker = sessionmaker
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._batches = {} # protocol: _ReceiveBatch
+        self._unbatched = False
 
     @classmethod
     def create_bookkeeping(self, bind):
@@ -353,15 +372,118 @@ class SqlSyncRegistry(interface.SyncRegistry):
     def sync_context(self, **info):
         "Return a context used to receive an incoming object.  This context follows the context manager protocol.  The context will have an attribute 'session' that is an SqlSyncSession into which an object can be constructed"
 
+        protocol = info.get('protocol')
+        if self.batch_size and protocol is not None and not self._unbatched \
+           and info.get('response_for') is None:
+            yield from self._batch_context(protocol, info['manager'])
+            return
         session = self.sessionmaker(expire_on_commit = False)
-        class Context: pass
-        ctx = Context()
+        ctx = _ReceiveContext()
         ctx.session = session
         try: yield ctx
         finally:
             session.close()
             session.expunge_all()
 
+    def _batch_context(self, protocol, manager):
+        batch = self._batches.get(protocol)
+        if batch is None:
+            batch = _ReceiveBatch(self.sessionmaker(expire_on_commit = False),
+                                  manager, protocol)
+            batch.timer = manager.loop.call_later(self.batch_interval,
+                                                  self.commit_batch, protocol)
+            self._batches[protocol] = batch
+        ctx = _ReceiveContext()
+        ctx.session = batch.session
+        ctx.batch = batch
+        try: yield ctx
+        except BaseException:
+            batch.discard_pending()
+            raise
+
+    def _receive_commit(self, context, obj, operation):
+        "Commit an incoming object, or if receiving in batches, flush it and commit the batch when full."
+        batch = getattr(context, 'batch', None)
+        if batch is None:
+            context.session.commit()
+            return
+        # The full state including the owner, so the object can be
+        # received again if the batch fails.
+        with context.session.no_autoflush:
+            msg = obj.to_sync()
+        msg['_sync_type'] = obj.sync_type
+        msg['_sync_operation'] = str(operation)
+        try: context.session.flush()
+        except Exception:
+            # This message is the one that failed; receive the rest
+            # of the batch again without it.
+            if self._batches.get(batch.protocol) is batch:
+                del self._batches[batch.protocol]
+            batch.committed = False
+            batch.close(rollback = True)
+            self._receive_again(batch.manager, batch.protocol, batch.entries)
+            raise
+        batch.entries.append(msg)
+        batch.floods.append(None)
+        # The operation hands its flood to the context once the
+        #incoming handler returns; see _ReceiveContext.hold_flood.
+        context.held = batch, len(batch.entries)-1
+        if len(batch.entries) >= self.batch_size:
+            self.commit_batch(batch.protocol)
+
+    def commit_batch(self, protocol):
+        "Commit the pending batch of incoming messages from *protocol* if any"
+        batch = self._batches.pop(protocol, None)
+        if batch is None: return
+        try:
+            batch.session.commit()
+        except Exception:
+            logger.exception("Committing {} received objects failed; retrying in smaller batches".format(len(batch.entries)))
+            batch.committed = False
+            batch.close(rollback = True)
+            self._receive_again(batch.manager, batch.protocol, batch.entries)
+            return
+        batch.committed = True
+        batch.close()
+        for flood in batch.floods:
+            if flood is None: continue
+            try: flood()
+            except Exception:
+                logger.exception("Error flooding a received object")
+
+    def commit_batches(self):
+        "Commit all pending batches of incoming messages"
+        for protocol in list(self._batches.keys()):
+            self.commit_batch(protocol)
+
+    def _receive_again(self, manager, protocol, entries):
+        # Bisect: commit each half as its own batch.  A single
+        # message is received without batching so that its failure is
+        # reported as it would be without batching.  Nothing in the
+        # failed batch was flooded, so each object is flooded once,
+        # when the part holding it commits.  This may run from a timer
+        # or while receiving an unrelated message, so errors are
+        # reported for the entry that caused them.
+        if not entries: return
+        if len(entries) == 1:
+            self._unbatched = True
+            try: self._receive_entry(manager, protocol, entries[0])
+            finally: self._unbatched = False
+            return
+        half = len(entries)//2
+        for part in (entries[:half], entries[half:]):
+            for msg in part:
+                self._receive_entry(manager, protocol, msg)
+            try: self.commit_batch(protocol)
+            except Exception:
+                logger.exception("Error committing {} received objects".format(len(part)))
+
+    @staticmethod
+    def _receive_entry(manager, protocol, msg):
+        try: manager._sync_receive(dict(msg), protocol, None)
+        except Exception as e:
+            protocol._receive_failed(e, msg, None)
+
     def incoming_delete( self, obj, context, manager, sender, **info):
         session = context.session
         ins = inspect(obj)
@@ -376,7 +498,7 @@ class SqlSyncRegistry(interface.SyncRegistry):
                              sync_type = obj.sync_type,
                              primary_key = json.dumps(obj.to_sync(attributes = obj.sync_primary_keys)))
             session.add(sd)
-        session.commit()
+        self._receive_commit(context, obj, info['operation'])
 
     def after_flood_delete(self, obj, manager, **info):
         if obj.sync_is_local:
@@ -387,7 +509,7 @@ class SqlSyncRegistry(interface.SyncRegistry):
         if obj.sync_is_local:
             if operation == 'forward' and obj in context.session.new: raise interface.SyncNotFound()
             try:
-                context.session.commit()
+                self._receive_commit(context, obj, operation)
                 obj.sync_owner
             except sqlalchemy.exc.StatementError as e:
                 raise SqlSyncError("Failed to update {}".format(obj.sync_type)) from e
@@ -404,9 +526,57 @@ class SqlSyncRegistry(interface.SyncRegistry):
         session = context.session
         assert not object.sync_is_local
         assert object in session
-        session.commit()
+        self._receive_commit(context, object, info['operation'])
         object.sync_owner
 
+class _ReceiveContext:
+
+    "The context for receiving into an SqlSyncRegistry; *session* is the session to construct into."
+
+    #: The batch and entry of the object last committed through this
+    #context while receiving in batches, or None
+    held = None
+
+    def hold_flood(self, flood):
+        "Keep *flood* until the batch holding the received object commits; return False if it should run now"
+        held, self.held = self.held, None
+        if held is None: return False
+        batch, entry = held
+        if batch.committed is None:
+            batch.floods[entry] = flood
+            return True
+        # If the batch failed, the object is received again and
+        #flooded then.
+        return not batch.committed
+
+
+class _ReceiveBatch:
+
+    "Incoming messages from one connection sharing a session until committed together."
+
+    def __init__(self, session, manager, protocol):
+        self.session = session
+        self.manager = manager
+        self.protocol = protocol
+        self.entries = [] # Flushed messages that can be received again
+        self.floods = [] # For each entry, its flood once committed or None
+        #: True once committed, False once rolled back
+        self.committed = None
+        self.timer = None
+
+    def discard_pending(self):
+        "Drop unflushed changes from a message that failed before it was flushed"
+        session = self.session
+        for o in list(session.new): session.expunge(o)
+        for o in list(session.deleted): session.expunge(o)
+        for o in list(session.dirty): session.expire(o)
+
+    def close(self, rollback = False):
+        if self.timer: self.timer.cancel()
+        if rollback: self.session.rollback()
+        self.session.close()
+        self.session.expunge_all()
+
 
 _internal_base = sqlalchemy.orm.declarative_base()
 
@@ -426,6 +596,10 @@ class  SqlSyncDestination(_internal_base, network.SyncDestination):
 
     bw_per_sec = Column(Integer, default = 10000000,
                         nullable = False)
+    #: Kept so that connection attempts at startup favor the
+    #destinations most recently reachable
+    last_connected = Column(Float, default = 0, server_default = '0',
+                            nullable = False)
     type = Column(String, nullable = False)
 
     __mapper_args__ = {
@@ -31,6 +31,10 @@ class _SqlMetaRegistry(SyncRegistry):
         self.register_operation('delete', operations.delete_operation)
 
     def sync_context(self, manager, **info):
+        # Owners, IHave and YouHave refer to what has been committed,
+        # so objects received in batches must be committed first.
+        for r in manager.registries:
+            if getattr(r, '_batches', None): r.commit_batches()
         class context:
 
             def __enter__(self, *args):
@@ -126,21 +130,27 @@ class _SqlMetaRegistry(SyncRegistry):
                                         attributes_to_sync = (set(d.sync_primary_keys) | {'sync_serial'}))
                     max_serial = max(max_serial, d.sync_serial)
 
-            for c, r in classes_in_registries(manager.registries):
-                try:
-                    if c is base.SyncOwner or issubclass(c, base.SyncOwner): continue
-                    if self.yield_between_classes: await asyncio.sleep(0)
-                    if not session.is_active: session.rollback()
-                    poly = with_polymorphic(c, '*')
-                    to_sync = session.query(poly).outerjoin(base.SyncOwner).filter(c.sync_serial > obj.serial, owner_condition).all()
-                except:
-                    logger.exception("Failed finding objects to send {} from  {}".format(sender, c.__name__))
-                    raise
-                for o in to_sync:
-                    max_serial = max(o.sync_serial, max_serial)
-                    manager.synchronize(o,
-                                        destinations = [sender])
-            await sender.protocol.sync_drain()
+            # Objects are queued class by class, so the protocol can
+            # send them in columnar batches
+            protocol = sender.protocol
+            protocol._batching += 1
+            try:
+                for c, r in classes_in_registries(manager.registries):
+                    try:
+                        if c is base.SyncOwner or issubclass(c, base.SyncOwner): continue
+                        if self.yield_between_classes: await asyncio.sleep(0)
+                        if not session.is_active: session.rollback()
+                        poly = with_polymorphic(c, '*')
+                        to_sync = session.query(poly).outerjoin(base.SyncOwner).filter(c.sync_serial > obj.serial, owner_condition).all()
+                    except:
+                        logger.exception("Failed finding objects to send {} from  {}".format(sender, c.__name__))
+                        raise
+                    for o in to_sync:
+                        max_serial = max(o.sync_serial, max_serial)
+                        manager.synchronize(o,
+                                            destinations = [sender])
+                await sender.protocol.sync_drain()
+            finally: protocol._batching -= 1
             sender.received_i_have.add(owner.id)
             if not owner.sync_is_local:
                 max_serial = owner.incoming_serial
@@ -133,7 +133,10 @@ class TransitionTrackerMixin (interface.Synchronizable):
 
     def same_transition(self, msg, **info):
         sender = info.get('sender', None)
-        return (str(self.transition_id) == msg.get('transition_id', None) )  \
+        # Compare decoded; the peer may send a compact encoding
+        transition_id = msg.get('transition_id', None)
+        return transition_id is not None \
+               and (self.transition_id == sql.encoders.uuid_decoder(transition_id))  \
                and (self._transition_destination == sender)
 
     def _broken_transition(self, manager):
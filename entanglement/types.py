@@ -5,15 +5,28 @@
 # WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
-import base64, datetime, iso8601, uuid
+import binascii, contextvars, datetime, iso8601, uuid
 from datetime import timezone
 
+#: Compact encodings this version can send; a peer that offers one
+#may be sent it.  Decoders accept every form regardless.
+#
+#* ``uuid-hex``: UUIDs as 32 hex digits without hyphens
+#* ``columnar``: objects of one class sent together with a column per property
+supported_codecs = frozenset({'uuid-hex', 'columnar'})
+
+#: The compact encodings agreed with the peer an object is being
+#encoded for.  Protocols set this around :meth:`to_sync`; encoders
+#that have a compact form check it.
+wire_codecs = contextvars.ContextVar('wire_codecs', default = frozenset())
+
 def binary_encoder(val):
-    return str(base64.b64encode(val), 'utf-8')
+    # JSON cannot carry bytes, so binary is always base64
+    return binascii.b2a_base64(val, newline = False).decode('ascii')
 
 
 def  binary_decoder( val):
-    return base64.b64decode(val)
+    return binascii.a2b_base64(val)
 
 
 def datetime_encoder(dt):
@@ -23,7 +36,19 @@ def datetime_encoder(dt):
 
 
 def datetime_decoder(value):
-    return iso8601.parse_date(value)
+    # fromisoformat reads what datetime_encoder writes far faster than
+    # iso8601; other forms fall back to iso8601.  Like iso8601, times
+    # without a zone are UTC.
+    try: dt = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError): return iso8601.parse_date(value)
+    if dt.tzinfo is None: dt = dt.replace(tzinfo = timezone.utc)
+    return dt
+
+def datetime_column_encoder(values):
+    utc = timezone.utc
+    return [None if dt is None else
+            (dt.astimezone(utc) if getattr(dt, 'tzinfo', None) else dt).isoformat()
+            for dt in values]
 
 def enum_encoder(value):
     return value.name
@@ -44,11 +69,44 @@ def register_type(typ, encoder, decoder):
     
 
 def uuid_encoder(val):
-    if val is not None: return str(val)
+    if val is None: return None
+    if 'uuid-hex' in wire_codecs.get(): return val.hex
+    return str(val)
 
-def uuid_decoder( val):
-    if val: return uuid.UUID(val)
+_new_uuid = object.__new__
+_set_uuid = object.__setattr__
+_unknown_safety = uuid.SafeUUID.unknown
 
+def uuid_decoder( val):
+    if not val: return None
+    hex = val.replace('-', '') if len(val) == 36 else val
+    if len(hex) == 32 and hex.isalnum():
+        # What uuid.UUID does for these forms, without its argument handling
+        u = _new_uuid(uuid.UUID)
+        _set_uuid(u, 'int', int(hex, 16))
+        _set_uuid(u, 'is_safe', _unknown_safety)
+        return u
+    return uuid.UUID(val)
+
+def uuid_column_encoder(values):
+    if 'uuid-hex' in wire_codecs.get(): return [None if v is None else v.hex for v in values]
+    return [None if v is None else str(v) for v in values]
+
+#: Functions encoding a list of values at once, by the encoder whose
+#results they match
+column_encoders = {}
+
+def register_column_encoder(encoder, column_encoder):
+    column_encoders[encoder] = column_encoder
+
+def encode_column(encoder, values):
+    "Encode each of *values* as *encoder* does, leaving None alone"
+    column_encoder = column_encoders.get(encoder)
+    if column_encoder is not None: return column_encoder(values)
+    return [None if v is None else encoder(v) for v in values]
+
+register_column_encoder(uuid_encoder, uuid_column_encoder)
+register_column_encoder(datetime_encoder, datetime_column_encoder)
 register_type(uuid.UUID, uuid_encoder, uuid_decoder)
 register_type(datetime.datetime, datetime_encoder, datetime_decoder)
 
@@ -63,5 +121,9 @@ __all__ = [
     'datetime_encoder',
     'datetime_decoder',
     'uuid_encoder',
-    'uuid_decoder'
+    'uuid_decoder',
+    'supported_codecs',
+    'wire_codecs',
+    'register_column_encoder',
+    'encode_column',
     ]
@@ -8,7 +8,7 @@
 # LICENSE for details.
 
 
-import base64, contextlib, functools, hashlib, logging, re, uuid
+import base64, builtins, contextlib, functools, hashlib, logging, re, uuid
 try:
     from OpenSSL import crypto as _crypto
 except ImportError:
@@ -23,19 +23,36 @@ except ImportError:
 class DestHash(bytes):
     "represents a hash of a value that uniquely identifies a destination.  The most common DestHash is a CertHash (hash of a DER-encoded X.509 certificate)."
 
-    def __new__(self, hash):
+    #: Instances are interned so that hashes compare by identity and
+    #strings are parsed once; the table is cleared when it grows past
+    #this many entries.
+    intern_limit = 65536
+
+    def __new__(cls, hash):
         "Construct from a RFC 6920 URI containing a base64-encoded SHA256 checksum"
+        if type(hash) is cls: return hash
+        if isinstance(hash, bytes) and type(hash) is not bytes:
+            hash = bytes(hash)
+        try: return _interned[cls, hash]
+        except KeyError: pass
+        except TypeError: hash = bytes(hash) # bytearray or memoryview
+        key = hash
         if isinstance(hash, str):
             m = re.match( r'(?:ni://[^/]*/sha-256;)?([-a-zA-Z0-9_=]+)', hash)
             if not m: raise ValueError('unable to parse hash string', hash)
-            return bytes.__new__(self, base64.urlsafe_b64decode(m.group(1)))
-        return bytes.__new__(self, hash)
-
-    def __init__(self, *args):
-        if len(self) != 32:
-            raise ValueError("A SHa256 checksum is exactly 32 bytes")
-
-        
+            hash = base64.urlsafe_b64decode(m.group(1))
+        self = _interned.get((cls, hash))
+        if self is None:
+            if len(hash) != 32:
+                raise ValueError("A SHa256 checksum is exactly 32 bytes")
+            self = bytes.__new__(cls, hash)
+            # Equal to the hash of the string form so that strings
+            # find DestHash keys
+            self._hash = builtins.hash(str(self))
+            if len(_interned) >= cls.intern_limit: _interned.clear()
+            _interned[cls, hash] = self
+        if key is not hash: _interned[cls, key] = self
+        return self
 
     def __str__(self):
         return "ni:///sha-256;" + str(base64.urlsafe_b64encode(self), 'utf-8')
@@ -46,18 +63,17 @@ class DestHash(bytes):
     def sync_encode_value(self): return str(self)
 
     def __eq__(self, other):
-        res = super().__eq__(other)
-        if res == True: return True
+        if other is self: return True
         if isinstance(other, str):
-            try:
-                return self.__eq__(DestHash(other))
-            except: return res
+            try: other = DestHash(other)
+            except ValueError: return False
+        return bytes.__eq__(self, other)
 
     def __ne__(self, other):
         return not (self == other)
     
 
-    def __hash__(self): return hash(str(self))
+    def __hash__(self): return self._hash
 
     @classmethod
     def from_string(cls, s):
@@ -74,6 +90,8 @@ class DestHash(bytes):
             uid = uid)
         return cls.from_string(s)
     
+_interned = {} # (class, bytes or string): DestHash
+
 class CertHash(DestHash):
     
     @classmethod
@@ -9,7 +9,7 @@
 from .bandwidth import BwLimitMonitor
 from .protocol import SyncProtocolBase, logger, protocol_logger
 from .network import SyncDestination
-import json
+import functools, json
 
 import tornado.websocket
 
@@ -76,9 +76,21 @@ class SyncWsHandler(tornado.websocket.WebSocketHandler):
 
 class SyncWsProtocol(SyncProtocolBase):
 
+    '''Carries a connection over a web socket.  Messages are
+    limited to the destination's *bw_per_sec*, and writing pauses
+    while more than the manager's *write_buffer_high* characters are
+    with Tornado waiting to be written to the socket, resuming once a
+    quarter of that remains.  While paused, objects wait in the dirty
+    queue where later changes replace earlier ones.
+    '''
+
     def __init__(self, manager, dest):
         super().__init__(manager, dest = dest, incoming = True)
-        self.bwprotocol = BwLimitMonitor(loop = self.loop, chars_per_sec = 10000, bw_quantum=0.1)
+        self.bwprotocol = BwLimitMonitor(loop = self.loop, chars_per_sec = dest.bw_per_sec)
+        self.bwprotocol.protocol = self
+        #: Characters given to Tornado that are not yet written to the socket
+        self.unflushed = 0
+        self._ws_paused = False
         if dest not in manager.destinations:
             manager.add_destination(dest)
         self.ws_handler = None
@@ -95,6 +107,7 @@ class SyncWsProtocol(SyncProtocolBase):
 
     def connection_lost(self, exc):
         self.ws_handler = None
+        self.bwprotocol.close()
         super().connection_lost(exc)
 
     def close(self):
@@ -108,7 +121,22 @@ class SyncWsProtocol(SyncProtocolBase):
         protocol_logger.debug("#{c}: Sending `{js}' to {d} (flags {f})".format(
             js = js, d = self.dest,
             c = self._out_counter, f = flags))
-        self.ws_handler.write_message(js)
+        written = self.ws_handler.write_message(js)
+        self.unflushed += len(js)
+        written.add_done_callback(functools.partial(self._flushed, len(js)))
+        if self.unflushed > self._manager.write_buffer_high and not self._ws_paused:
+            self._ws_paused = True
+            self.bwprotocol.pause_writing()
+        self.bwprotocol.bw_used(len(js))
+
+    def _flushed(self, size, future):
+        # A write fails only if the socket closed, which on_close handles
+        if not future.cancelled(): future.exception()
+        self.unflushed -= size
+        if self._manager is None: return
+        if self._ws_paused and self.unflushed <= self._manager.write_buffer_high/4:
+            self._ws_paused = False
+            self.bwprotocol.resume_writing()
 
     @property
     def dest_hash(self):
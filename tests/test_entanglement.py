@@ -11,10 +11,10 @@ import ssl, asyncio, asyncio.log, json, os, pytest, unittest, uuid, warnings
 from unittest import mock
 
 
-from entanglement import bandwidth, protocol, SyncManager
-from entanglement.interface import Synchronizable, sync_property, SyncRegistry, SyncError
+from entanglement import bandwidth, operations, protocol, SyncManager
+from entanglement.interface import Synchronizable, sync_property, no_sync_property, SyncRegistry, SyncError, SyncBadEncodingError, SyncEncodeCacheMixin, SyncLazyDecodeMixin
 from entanglement.network import  SyncServer, SyncDestination
-from entanglement.util import certhash_from_file, DestHash, SqlDestHash, entanglement_logs_disabled
+from entanglement.util import certhash_from_file, CertHash, DestHash, SqlDestHash, entanglement_logs_disabled
 
 from .utils import settle_loop, test_port
 
@@ -112,7 +112,7 @@ def loop():
 
 @pytest.fixture
 def bwtest_protocol(loop):
-    protocol = bandwidth.BwLimitProtocol(loop = loop,
+    protocol = bandwidth.QuantumBwLimitProtocol(loop = loop,
                                         upper_protocol = mock.MagicMock(),
                                         chars_per_sec = 10000,
                                         bw_quantum = 0.1)
@@ -162,7 +162,139 @@ def testTransportPause(loop, bwtest_protocol):
     assert  upper.resume_writing.call_count ==  0
     loop.run_until_complete(asyncio.sleep(0.1))
     assert upper.resume_writing.call_count ==  1
-        
+
+def test_token_bucket(loop):
+    "The token bucket allows a burst, then resumes exactly when the debt is repaid, not while the transport is paused"
+    upper = mock.MagicMock()
+    protocol = bandwidth.BwLimitProtocol(loop = loop, upper_protocol = upper,
+                                         chars_per_sec = 10000, burst = 1000)
+    protocol.bw_used(1000)
+    assert protocol._paused is False
+    protocol.bw_used(500)
+    assert upper.pause_writing.call_count == 1
+    loop.run_until_complete(asyncio.sleep(0.03))
+    assert upper.resume_writing.call_count == 0
+    loop.run_until_complete(asyncio.sleep(0.04))
+    assert upper.resume_writing.call_count == 1
+    protocol.pause_writing()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert upper.resume_writing.call_count == 1
+    protocol.resume_writing()
+    assert upper.resume_writing.call_count == 2
+
+class PausableWriter:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiter = None
+
+    def pause_writing(self):
+        self.waiter = self.loop.create_future()
+
+    def resume_writing(self):
+        self.waiter.set_result(None)
+        self.waiter = None
+
+def bw_write_times(loop, monitor_class):
+    "Write 100 characters whenever allowed for a second at 10000 characters per second; return the times of each write"
+    monitor = monitor_class(loop = loop, chars_per_sec = 10000, bw_quantum = 0.1)
+    writer = monitor.protocol = PausableWriter(loop)
+    times = []
+    async def write():
+        end = loop.time()+1
+        while loop.time() < end:
+            if writer.waiter: await writer.waiter
+            times.append(loop.time())
+            monitor.bw_used(100)
+            await asyncio.sleep(0)
+    loop.run_until_complete(write())
+    return times
+
+def test_token_bucket_smoothness(loop):
+    "The token bucket sends at an even pace where quantum accounting stops and starts, at a similar rate"
+    quantum = bw_write_times(loop, bandwidth.QuantumBwLimitMonitor)
+    bucket = bw_write_times(loop, bandwidth.BwLimitMonitor)
+    longest_gap = lambda times: max(b-a for a, b in zip(times, times[1:]))
+    assert abs(len(bucket)-len(quantum)) < 0.25*len(quantum)
+    assert longest_gap(quantum) > 0.06
+    assert longest_gap(bucket) < 0.03
+
+async def write_while_allowed(loop, monitor, seconds):
+    "Write 100 characters to *monitor* whenever it is not paused for *seconds*"
+    writer = monitor.protocol = PausableWriter(loop)
+    end = loop.time()+seconds
+    while loop.time() < end:
+        if writer.waiter: await writer.waiter
+        monitor.bw_used(100)
+        await asyncio.sleep(0)
+
+def test_bandwidth_budget(loop):
+    "Connections share a budget's rate in proportion to the weights at each level of the tree"
+    root = bandwidth.BandwidthBudget('root', 20000, loop = loop)
+    heavy = root.child('heavy', weight = 3)
+    light = root.child('light')
+    dests = [heavy.child('a'), heavy.child('b'), light.child('c')]
+    monitors = []
+    for d in dests:
+        monitors.append(bandwidth.BwLimitMonitor(loop = loop, chars_per_sec = 10**9))
+        monitors[-1].budget = d
+    async def write_all():
+        await asyncio.gather(*(write_while_allowed(loop, m, 2) for m in monitors))
+    loop.run_until_complete(write_all())
+    assert 0.8*40000 < root.chars < 1.2*40000
+    assert 2.4 < heavy.chars/light.chars < 3.6
+    assert 0.8 < dests[0].chars/dests[1].chars < 1.25
+    counters = root.counters()
+    assert [c['name'] for c in counters['children']] == ['heavy', 'light']
+    assert counters['children'][0]['children'][1]['chars'] == dests[1].chars
+    assert counters['pauses'] > 0 and counters['rate'] > 0
+
+class SimulatedLink:
+
+    "Carries *capacity* characters per second; the rest queues as in a socket's write buffer"
+
+    def __init__(self, loop, capacity):
+        self.loop = loop
+        self.capacity = capacity
+        self.buffered = 0
+        self._stamp = loop.time()
+        self._handle = loop.call_later(0.005, self._drain)
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def _drain(self):
+        now = self.loop.time()
+        self.buffered = max(0, self.buffered-self.capacity*(now-self._stamp))
+        self._stamp = now
+        self._handle = self.loop.call_later(0.005, self._drain)
+
+def test_adaptive_rate(loop):
+    "The adaptive controller converges near the link's capacity without building a queue, well under its ceiling"
+    link = SimulatedLink(loop, 200000)
+    monitor = bandwidth.BwLimitMonitor(loop = loop, chars_per_sec = 10**7)
+    controller = bandwidth.AdaptiveRateController(monitor, link, ceiling = 10**7)
+    writer = monitor.protocol = PausableWriter(loop)
+    async def write():
+        end = loop.time()+2
+        while loop.time() < end:
+            if writer.waiter: await writer.waiter
+            link.buffered += 1000
+            monitor.bw_used(1000)
+            await asyncio.sleep(0)
+    loop.run_until_complete(write())
+    assert 100000 < monitor.chars_per_sec < 300000
+    assert link.buffered/link.capacity < 0.25
+    assert monitor.chars > 200000
+    # Idling longer than the capacity window keeps the last estimate,
+    # so a burst that queues backs off to it rather than to min_rate
+    loop.run_until_complete(asyncio.sleep(1.5))
+    assert 100000 < controller.capacity < 300000
+    link.buffered += 50000
+    loop.run_until_complete(asyncio.sleep(0.15))
+    controller.stop()
+    link._handle.cancel()
+    assert 50000 < monitor.chars_per_sec < 300000
         
             
     
@@ -191,7 +323,8 @@ class TestBandwidth(unittest.TestCase):
             nonlocal pause_called
             pause_called = True
         protocol.protocol.pause_writing = pause_writing_replacement
-        transport.write(b"f" * 20)
+        # Writes are charged through the transport the upper protocol sees
+        protocol.transport.write(b"f" * 20)
         self.assertTrue(pause_called)
         
     def testResume(self):
@@ -207,7 +340,7 @@ class TestBandwidth(unittest.TestCase):
             resume_called = True
         protocol.protocol.pause_writing = pause_writing_replacement
         protocol.protocol.resume_writing = resume_writing_replacement
-        transport.write(b"f" * 20)
+        protocol.transport.write(b"f" * 20)
         self.assertTrue(pause_called)
         self.assertFalse(resume_called)
         self.fixture.loop.run_until_complete(asyncio.sleep(0.15))
@@ -386,6 +519,19 @@ def test_desthash_equality():
     assert d1s == d1
     assert (d1s != d1) == False
     assert (d1 != d1s) == False
+
+def test_desthash_interned():
+    d1 = DestHash(b'o'*32)
+    assert DestHash(bytearray(b'o'*32)) is d1
+    assert DestHash(str(d1)) is d1
+    assert DestHash(d1) is d1
+    assert {d1: 1}[str(d1)] == 1
+    assert d1 != DestHash(b'p'*32)
+    assert d1 != 'not a hash'
+    cert_hash = CertHash(d1)
+    assert type(cert_hash) is CertHash and cert_hash == d1
+    with pytest.raises(ValueError):
+        DestHash(b'short')
     
 
 @pytest.fixture(scope = 'module')
@@ -424,3 +570,347 @@ def test_entanglement_type():
     assert sp.encoderfn == uuid_encoder
     assert sp.decoderfn == uuid_decoder
     
+
+def test_generated_encoder():
+    "Generated encoders give what the general loop gives, for subsets too, and are replaced when properties change"
+    class Wrapped:
+        def sync_encode_value(self): return 'wrapped'
+    class Encoded(Synchronizable):
+        id:uuid.UUID = sync_property()
+        plain = sync_property()
+        wrapped = sync_property()
+        missing = sync_property()
+        scaled = sync_property(encoder = lambda v: v*2)
+    obj = Encoded()
+    obj.id = uuid.uuid4()
+    obj.plain = [1]
+    obj.wrapped = Wrapped()
+    obj.scaled = None
+    assert obj.to_sync() == obj._sync_encode_properties() == {
+        'id': str(obj.id), 'plain': [1], 'wrapped': 'wrapped', 'scaled': None}
+    obj.scaled = 3
+    assert obj.to_sync(attributes = ['scaled']) == {'scaled': 6}
+    assert Encoded._sync_encoder(['scaled', 'unknown']) is Encoded._sync_encoder({'scaled'})
+    encoder = Encoded._sync_encoder()
+    Encoded._sync_meta['scaled'].encoderfn = lambda v: v*3
+    Encoded._sync_invalidate()
+    assert obj.to_sync()['scaled'] == 9
+    assert Encoded._sync_encoder() is not encoder
+    encoder = Encoded._sync_encoder()
+    del Encoded._sync_properties_cache
+    assert Encoded._sync_encoder() is not encoder
+    obj.scaled = 'not a number'
+    Encoded._sync_meta['scaled'].encoderfn = lambda v: v+1
+    Encoded._sync_invalidate()
+    with pytest.raises(ValueError, match = 'scaled') as info:
+        obj.to_sync()
+    assert isinstance(info.value.__cause__, TypeError)
+    # Each property is read once even when encoding fails
+    reads = []
+    class Counted(Synchronizable):
+        @sync_property
+        @property
+        def value(self):
+            reads.append(1)
+            raise RuntimeError('lazy load failed')
+    with pytest.raises(ValueError, match = 'value'):
+        Counted().to_sync()
+    assert len(reads) == 1
+
+def test_encode_cache():
+    "Encodings are reused until an assignment or sync_changed; property-backed values are always fresh"
+    encoded = []
+    class Cached(SyncEncodeCacheMixin):
+        def __init__(self):
+            self.clock = 0
+        counted = sync_property(encoder = lambda v: encoded.append(v) or v)
+        local = no_sync_property(None)
+        @sync_property
+        @property
+        def ticks(self): return clock[0]
+    clock = [0]
+    obj = Cached()
+    obj.counted = [1]
+    first = obj.to_sync()
+    first['_sync_type'] = 'Cached' # The protocol adds to what it gets
+    assert obj.to_sync() == {'counted': [1], 'ticks': 0}
+    assert encoded == [[1]]
+    clock[0] = 1
+    assert obj.to_sync()['ticks'] == 1 and len(encoded) == 1
+    assert obj.to_sync(attributes = ['ticks']) == {'ticks': 1}
+    obj.local = 'changed'
+    obj.to_sync()
+    assert len(encoded) == 2
+    obj.counted.append(2)
+    obj.sync_changed()
+    assert obj.to_sync()['counted'] == [1, 2]
+    assert obj.to_sync_json(attributes = ['counted']) == '{"counted": [1, 2]}'
+    assert len(encoded) == 4
+
+def test_sync_slots():
+    "sync_slots puts declared and inherited sync properties in __slots__, keeping class defaults"
+    class Base(Synchronizable):
+        __slots__ = ()
+        inherited = sync_property()
+    class Slotted(SyncEncodeCacheMixin, Base):
+        sync_slots = True
+        own = sync_property()
+    class Derived(Slotted):
+        more = sync_property()
+    assert set(Slotted.__slots__) == {'own', 'inherited', '_sync_owner', 'sync_version', '_sync_encoded'}
+    assert Derived.__slots__ == ('more',)
+    obj = Derived()
+    assert not hasattr(obj, '__dict__')
+    assert obj.sync_version == 0
+    obj.own = 1
+    obj.inherited = 2
+    assert obj.to_sync() == {'own': 1, 'inherited': 2}
+    assert obj.sync_version == 2
+    assert Derived.sync_version == 0
+
+def test_lazy_decode():
+    "Lazily decoded values are decoded on access and otherwise resent as received"
+    from entanglement.types import wire_codecs
+    decoded = []
+    def decode(v):
+        decoded.append(v)
+        return uuid.UUID(v)
+    class Lazy(SyncLazyDecodeMixin):
+        sync_slots = True
+        ident = sync_property(encoder = lambda v: v.hex, decoder = decode)
+        when = sync_property(decoder = decode)
+        key = sync_property(constructor = True)
+        def __init__(self, key = None): self.key = key
+    class Protocol:
+        codecs = frozenset({'uuid-hex'})
+    assert Lazy._sync_lazy() == ({'ident', 'when'}, {'ident', 'when'})
+    u = uuid.uuid4()
+    obj = Lazy.sync_receive({'key': 1, 'ident': u.hex, 'when': str(u)}, protocol = Protocol)
+    assert obj.key == 1 and decoded == []
+    assert obj.to_sync(attributes = ['ident', 'key']) == {'key': 1, 'ident': u.hex}
+    # Not sent as received where the sender's codecs were not agreed
+    assert obj.to_sync(attributes = ['when']) == {'when': u} and decoded == [u.hex, str(u)]
+    assert obj.ident == u and obj.when == u and len(decoded) == 2
+    token = wire_codecs.set(Protocol.codecs)
+    try:
+        obj.sync_receive_constructed({'ident': 'bad'}, protocol = Protocol)
+        assert obj.to_sync() == {'key': 1, 'ident': 'bad', 'when': u}
+        with pytest.raises(SyncBadEncodingError): obj.ident
+        obj.ident = u
+        assert obj.to_sync()['ident'] == u.hex
+    finally: wire_codecs.reset(token)
+    with pytest.raises(AttributeError): obj.missing
+
+def test_decoder_plan():
+    "Constructor plans and decoder tables decode as properties say and keep the error behavior"
+    class Constructed(Synchronizable):
+        def __init__(self, first, second = None, *, named = None):
+            self.args = (first, second, named)
+        first = sync_property(constructor = 1, decoder = int)
+        second = sync_property(constructor = 2)
+        named:uuid.UUID = sync_property(constructor = True)
+        other:uuid.UUID = sync_property()
+    named, other = uuid.uuid4(), uuid.uuid4()
+    msg = {'first': '1', 'second': None, 'named': str(named), 'other': str(other), '_extra': 1}
+    obj = Constructed.sync_receive(msg)
+    assert obj.args == (1, None, named)
+    assert obj.other == other
+    assert Constructed._sync_decoders() == Constructed._sync_decoders()
+    with pytest.raises(SyncBadEncodingError):
+        Constructed.sync_receive({'first': 'one'})
+    with pytest.raises(SyncBadEncodingError, match = 'unknown'):
+        obj.sync_receive_constructed({'unknown': 1})
+    with pytest.raises(SyncBadEncodingError, match = 'other'):
+        obj.sync_receive_constructed({'other': 'not a uuid'})
+
+def test_receive_plan():
+    "Receive plans are cached per class and operation and replaced when the registry changes"
+    class PlanRegistry(SyncRegistry):
+        def sync_receive(self, obj, **info):
+            received.append(obj)
+    plan_reg = PlanRegistry()
+    class Planned(Synchronizable):
+        sync_registry = plan_reg
+        sync_primary_keys = ('id',)
+        id = sync_property()
+    class Sender:
+        dest_hash = None
+        def should_listen(self, msg, cls, **info): return True
+    class Protocol:
+        dest = Sender()
+    received = []
+    manager = SyncManager(None, test_port, registries = [plan_reg])
+    try:
+        manager._sync_receive({'_sync_type': 'Planned', 'id': 1}, Protocol(), None)
+        plan = manager._receive_plans[('Planned', 'sync')]
+        assert plan.uses_context is False
+        manager._sync_receive({'_sync_type': 'Planned', 'id': 2}, Protocol(), None)
+        assert manager._receive_plans[('Planned', 'sync')] is plan
+        assert [o.id for o in received] == [1, 2]
+        del plan_reg.registry['Planned']
+        class Planned(Planned):
+            sync_registry = plan_reg
+        manager._sync_receive({'_sync_type': 'Planned', 'id': 3}, Protocol(), None)
+        assert manager._receive_plans[('Planned', 'sync')] is not plan
+        assert type(received[-1]) is Planned
+    finally: manager.close()
+
+def test_manager_bw_settings():
+    "The manager-wide bandwidth limit can be given to the constructor and changed later"
+    manager = SyncManager(None, test_port, bw_per_sec = 5000, bw_burst = 100)
+    try:
+        assert manager.bandwidth.chars_per_sec == manager.bw_per_sec == 5000
+        assert manager.bandwidth.burst == manager.bw_burst == 100
+        manager.bw_per_sec = 2000
+        manager.bw_burst = None
+        assert manager.bandwidth.chars_per_sec == 2000
+        assert manager.bandwidth.burst == 200
+    finally: manager.close()
+
+def test_coroutine_incoming():
+    "Coroutine incoming handlers run concurrently, in order per object, bound the reader and stop with the connection"
+    class AsyncRegistry(SyncRegistry):
+        async def incoming_sync(self, obj, **info):
+            started.append((obj.id, obj.pos))
+            await gates[obj.id]
+            finished.append((obj.id, obj.pos))
+    async_reg = AsyncRegistry()
+    async_reg.register_operation('sync', operations.sync_operation)
+    async_reg.register_operation('touch', operations.MethodOperation(
+        'touch', lambda obj, **info: finished.append((obj.id, 'touch'))))
+    class AsyncSyncable(Synchronizable):
+        sync_registry = async_reg
+        sync_primary_keys = ('id',)
+        id = sync_property()
+        pos = sync_property()
+    class Sender:
+        dest_hash = None
+        def should_listen(self, msg, cls, **info): return True
+    class Protocol(protocol.SyncProtocolBase):
+        # No transport to close
+        def close(self): pass
+    started = []
+    finished = []
+    manager = SyncManager(None, test_port, registries = [async_reg])
+    manager.max_incoming_tasks = 4
+    loop = manager.loop
+    gates = {i: loop.create_future() for i in range(3)}
+    p = Protocol(manager, dest = Sender())
+    try:
+        for id, pos in ((0, 1), (1, 1), (0, 2)):
+            manager._sync_receive({'_sync_type': 'AsyncSyncable', 'id': id, 'pos': pos}, p, None)
+        # A synchronous handler for 0 waits too
+        manager._sync_receive({'_sync_type': 'AsyncSyncable', '_sync_operation': 'touch', 'id': 0}, p, None)
+        settle_loop(loop)
+        # The second update to 0 waits for the first
+        assert started == [(0, 1), (1, 1)]
+        assert finished == []
+        assert p._incoming_full()
+        waiter = loop.create_task(p._wait_incoming_capacity())
+        gates[1].set_result(None)
+        settle_loop(loop)
+        assert waiter.done()
+        assert finished == [(1, 1)]
+        gates[0].set_result(None)
+        settle_loop(loop)
+        assert finished == [(1, 1), (0, 1), (0, 2), (0, 'touch')]
+        assert not p._incoming_tasks and not p._incoming_by_key
+        for pos in (1, 2):
+            manager._sync_receive({'_sync_type': 'AsyncSyncable', 'id': 2, 'pos': pos}, p, None)
+        settle_loop(loop)
+        p.connection_lost(None)
+        settle_loop(loop)
+        assert started[-1] == (2, 1)
+        assert finished[-1] == (0, 'touch')
+        assert not p._incoming_tasks
+    finally:
+        manager.close()
+
+def test_tls_session_resumed(layout):
+    "Reconnecting resumes the previous TLS session and still checks the peer"
+    manager = layout.client.manager
+    def ssl_object():
+        protocol, = manager.connections
+        return protocol.transport.get_extra_info('ssl_object')
+    assert not ssl_object().session_reused
+    layout.client.to_server.connect_at = 0
+    manager.connections[0].close()
+    assert layout.client.to_server.dest_hash in manager._tls_sessions
+    layout.wait_connecting()
+    assert ssl_object().session_reused
+    assert manager.connections[0].dest_hash == layout.client.to_server.dest_hash
+
+def test_fast_codecs(layout):
+    "Fast decoders accept every form, and compact encodings are only sent when negotiated"
+    from entanglement.types import uuid_encoder, uuid_decoder, datetime_encoder, datetime_decoder, binary_encoder, binary_decoder, wire_codecs
+    import datetime, iso8601
+    u = uuid.uuid4()
+    assert uuid_encoder(u) == str(u)
+    for form in (str(u), u.hex, u.urn, '{'+str(u)+'}'):
+        assert uuid_decoder(form) == u
+    with pytest.raises(ValueError): uuid_decoder('x'*32)
+    token = wire_codecs.set(frozenset({'uuid-hex'}))
+    try: assert uuid_encoder(u) == u.hex
+    finally: wire_codecs.reset(token)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for form in (datetime_encoder(now), '2020-01-02', '2020-01-02T03:04:05Z',
+                 '2020-01-02T03:04:05.123456+05:00', '20200102T030405Z', '2020-01-02 03:04'):
+        assert datetime_decoder(form) == iso8601.parse_date(form)
+    assert datetime_decoder(datetime_encoder(now)) == now
+    assert binary_decoder(binary_encoder(b'\0\xffdata')) == b'\0\xffdata'
+    # uuid-hex changes what application hooks see, so is not offered by default
+    for protocol in layout.client.manager.connections+layout.server.manager.connections:
+        assert protocol.codecs == {'columnar'}
+
+def test_keepalive(layout):
+    "Pings measure round trip time and a silent peer is disconnected so it can reconnect"
+    manager = layout.client.manager
+    dest = layout.client.to_server
+    protocol, = manager.connections
+    assert not protocol._peer_pongs
+    protocol._send_ping()
+    settle_loop(layout.loop)
+    assert protocol.srtt is not None and dest.srtt == protocol.srtt
+    # Nothing more arrives from the server
+    protocol._last_received -= manager.keepalive_timeout+1
+    dest.connect_at = 0
+    assert not protocol._keepalive_check()
+    assert protocol.is_closed()
+    layout.wait_connecting()
+    new_protocol, = manager.connections
+    assert new_protocol is not protocol
+
+def test_connection_scheduler():
+    "Connection attempts beyond the limit wait, most recently connected first"
+    from entanglement.network import ConnectionScheduler
+    class Dest:
+        def __init__(self, last_connected):
+            self.last_connected = last_connected
+    loop = asyncio.new_event_loop()
+    scheduler = ConnectionScheduler(1)
+    order = []
+    release = loop.create_future()
+    async def connect(name, dest, hold = None):
+        async with scheduler.slot(dest):
+            order.append(name)
+            if hold: await hold
+    try:
+        first = loop.create_task(connect('first', Dest(0), release))
+        settle_loop(loop)
+        never = loop.create_task(connect('never', Dest(0)))
+        old = loop.create_task(connect('old', Dest(100)))
+        canceled = loop.create_task(connect('canceled', Dest(300)))
+        recent = loop.create_task(connect('recent', Dest(200)))
+        settle_loop(loop)
+        canceled.cancel()
+        settle_loop(loop)
+        metrics = scheduler.metrics()
+        assert metrics['in_progress'] == 1
+        assert metrics['waiting'] == metrics['pending'] == 3
+        release.set_result(None)
+        settle_loop(loop)
+        assert order == ['first', 'recent', 'old', 'never']
+        assert scheduler.in_progress == 0 and scheduler.waiting == 0
+        assert scheduler.attempts == 4
+    finally:
+        loop.close()
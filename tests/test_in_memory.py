@@ -10,6 +10,7 @@ import asyncio, dataclasses, pytest, uuid
 from entanglement import *
 from entanglement.memory import *
 from entanglement.filter import *
+from entanglement.interface import SyncNotConnected
 from .utils import settle_loop
 from . import conftest
 
@@ -32,6 +33,24 @@ class B(A):
 
     value: int = sync_property()
 
+class Slotted(StoreInSyncStoreMixin):
+    sync_registry = registry
+    sync_slots = True
+    sync_primary_keys = ('id',)
+
+    id = sync_property()
+    value = sync_property()
+
+class Device(StoreInSyncStoreMixin):
+    sync_registry = registry
+    sync_primary_keys = ('id',)
+    sync_indexes = ('room', '_sync_owner')
+    sync_sorted_indexes = ('value',)
+
+    id = sync_property()
+    room = sync_property()
+    value = sync_property()
+
 class OurFilteredSyncDestination(FilteredSyncDestination):
     filter_should_listen_returns_true = True
     
@@ -41,6 +60,11 @@ def filter_layout(registries, requested_layout):
     rl['destination_class'] = OurFilteredSyncDestination
     yield from conftest.layout_fn(registries=registries, requested_layout=rl)
     
+@pytest.fixture()
+def positional_layout(registries, requested_layout, monkeypatch):
+    monkeypatch.setattr(SyncManager, 'positional_encoding', True)
+    yield from conftest.layout_fn(registries=registries, requested_layout=requested_layout)
+
 @pytest.fixture(scope='module')
 def registries():
     return [registry]
@@ -62,6 +86,204 @@ def test_send_object(layout, loop):
     assert a_client.sync_owner.id == owner.id
     
     
+def test_slotted_objects(layout, loop):
+    "Objects of classes with sync_slots have no __dict__ and synchronize through stores like any other"
+    registry_server = layout.server.registries[0]
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    layout.server.manager.synchronize(owner)
+    s = Slotted()
+    assert not hasattr(s, '__dict__')
+    assert s.sync_owner is Synchronizable.sync_owner
+    s.id = 1
+    s.value = 'slotted'
+    s._sync_owner = owner.id
+    registry_server.add_to_store(s)
+    layout.server.manager.synchronize(s)
+    settle_loop(loop)
+    received = layout.client.registries[0].store_for_class(Slotted)[1]
+    assert received.value == 'slotted'
+    assert received.sync_owner.id == owner.id
+    with pytest.raises(AttributeError):
+        received.unexpected = True
+
+def test_positional_encoding(positional_layout, loop):
+    "Classes whose schemas match are sent by position, others by name"
+    layout = positional_layout
+    registry_server = layout.server.registries[0]
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    layout.server.manager.synchronize(owner)
+    server_protocol, = layout.server.manager.connections
+    client_protocol, = layout.client.manager.connections
+    assert set(server_protocol.positional) == set(client_protocol.positional) >= {'Slotted', 'A', 'B'}
+    assert server_protocol.positional['Slotted'][0] == ('_sync_owner', 'id', 'value')
+    sent = []
+    send_json = server_protocol._send_json
+    def record(sync_rep, flags):
+        sent.append(dict(sync_rep))
+        send_json(sync_rep, flags)
+    server_protocol._send_json = record
+    s = Slotted()
+    s.id = 1
+    s.value = 'positional'
+    s._sync_owner = owner.id
+    registry_server.add_to_store(s)
+    layout.server.manager.synchronize(s)
+    settle_loop(loop)
+    assert sent[-1]['_pos'] == [str(owner.id), 1, 'positional'] and 'value' not in sent[-1]
+    store_client = layout.client.registries[0].store_for_class(Slotted)
+    assert store_client[1].value == 'positional'
+    layout.server.manager.synchronize(s, attributes_to_sync = ['id'])
+    settle_loop(loop)
+    assert sent[-1]['_pos'] == [str(owner.id), 1] and sent[-1]['_mask'] == 3
+    # A peer whose schemas differ makes both sides compare class by class
+    server_protocol._handle_schemas('0'*16)
+    fingerprints = {t: fingerprint for t, (names, fingerprint) in server_protocol._schemas.items()}
+    assert '_schemas' in sent[-1] and sent[-1]['_schemas'] == fingerprints
+    server_protocol._handle_schemas(dict(fingerprints, Slotted = '0'*16))
+    settle_loop(loop)
+    assert 'Slotted' not in server_protocol.positional and 'A' in server_protocol.positional
+    s.value = 'named'
+    layout.server.manager.synchronize(s)
+    settle_loop(loop)
+    assert sent[-1]['value'] == 'named' and '_pos' not in sent[-1]
+    assert store_client[1].value == 'named'
+
+def test_columnar_errors(layout, loop):
+    "An object that cannot be sent or received in a columnar batch does not lose the others"
+    registry_server = layout.server.registries[0]
+    manager = layout.server.manager
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    manager.synchronize(owner)
+    settle_loop(loop)
+    server_protocol, = manager.connections
+    client_protocol, = layout.client.manager.connections
+    assert 'columnar' in server_protocol.codecs
+    store_client = layout.client.registries[0].store_for_class(Slotted)
+    server_protocol._batching += 1
+    try:
+        for i in range(10, 15):
+            s = Slotted()
+            s.id = i
+            s.value = object() if i == 12 else 'batched'
+            s._sync_owner = owner.id
+            manager.synchronize(s)
+        drained = server_protocol.sync_drain()
+        settle_loop(loop)
+        assert drained.done()
+    finally: server_protocol._batching -= 1
+    assert sorted(k for k in store_client if k >= 10) == [10, 11, 13, 14]
+    assert server_protocol.task is None
+    # A row from an unknown owner is reported and the rest received
+    client_protocol._receive_columns({'_sync_type': 'Slotted', '_columns': {
+        '_sync_owner': [owner.id.hex, uuid.uuid4().hex, owner.id.hex],
+        'id': [20, 21, 22], 'value': ['a', 'b', 'c']}})
+    assert 20 in store_client and 21 not in store_client and 22 in store_client
+
+def test_store_indexes(layout, loop):
+    "Declared indexes follow objects as they are received, changed and deleted"
+    registry_server = layout.server.registries[0]
+    manager = layout.server.manager
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    manager.synchronize(owner)
+    devices = []
+    for i in range(6):
+        d = Device()
+        d.id = i
+        d.room = 'room {}'.format(i%2)
+        d.value = i*10
+        d._sync_owner = owner.id
+        registry_server.add_to_store(d)
+        manager.synchronize(d)
+        devices.append(d)
+    settle_loop(loop)
+    store_client = layout.client.registries[0].store_for_class(Device)
+    assert sorted(d.id for d in store_client.lookup('room', 'room 1')) == [1, 3, 5]
+    assert len(store_client.lookup('_sync_owner', owner.id)) == 6
+    assert [d.id for d in store_client.lookup_range('value', 15, 45)] == [2, 3, 4]
+    devices[1].room = 'room 0'
+    devices[1].value = 100
+    manager.synchronize(devices[1])
+    manager.synchronize(devices[3], operation = 'delete')
+    settle_loop(loop)
+    assert sorted(d.id for d in store_client.lookup('room', 'room 1')) == [5]
+    assert [d.id for d in store_client.lookup_range('value', 40)] == [4, 5, 1]
+    # Lookups without an index scan the store
+    assert [d.id for d in store_client.lookup_range('id', 4)] == [4, 5]
+    assert sorted(d.id for d in Filter(lambda o: True, store = store_client, where = {'room': 'room 0'}).all_objects()) == [0, 1, 2, 4]
+
+def test_store_query():
+    "Queries use the most selective index and give the same results as scanning"
+    indexed = SyncStore()
+    indexed.add_index('room')
+    indexed.add_index('value', sorted = True)
+    indexed.add_index('name', sorted = True)
+    plain = SyncStore()
+    for i in range(200):
+        d = Device()
+        d.id = i
+        d.room = i%10
+        d.value = i if i%7 else None
+        d.name = 'lab-{}'.format(i) if i%2 else 'office-{}'.format(i)
+        indexed.add(d)
+        plain.add(d)
+    queries = [
+        (Equal('room', 3),),
+        (Range('value', 50, 90),),
+        (Range('value', high = 20), Prefix('name', 'lab-')),
+        (Prefix('name', 'lab-1') & Equal('room', 3),),
+        (Equal('value', None),),
+        # Bounds that cannot be compared with the values
+        (Range('value', 'a'),),
+        (Prefix('value', '1'),),
+        (Equal('room', [3]),),
+        ]
+    for predicates in queries:
+        results = indexed.query(*predicates)
+        assert not isinstance(results, list)
+        assert sorted(d.id for d in results) == sorted(d.id for d in plain.query(*predicates))
+    assert [d.id for d in indexed.query(Range('value', 50, 60))] == [50, 51, 52, 53, 54, 55, 57, 58, 59]
+    assert sorted(d.id for d in indexed.query(Prefix('name', 'lab-1'), room = 3)) == [13, 103, 113, 123, 133, 143, 153, 163, 173, 183, 193]
+    # The room index gives 20 candidates, the value range 4
+    count, candidates, residual = (Equal('room', 3) & Range('value', 0, 5)).plan(indexed.indexes)
+    assert count == 4 and residual == And(Equal('room', 3))
+    assert (Equal('id', 3) & Prefix('room', 'x')).plan(indexed.indexes) is None
+
+def test_store_unindexable_values():
+    "Values an index cannot hold are kept aside, so adding and removing them leaves the store consistent"
+    indexed = SyncStore()
+    indexed.add_index('room')
+    indexed.add_index('value', sorted = True)
+    plain = SyncStore()
+    for i, room, value in ((0, 1, 5), (1, [1], 'apple'), (2, 2, 7), (3, 1, 'avocado')):
+        d = Device()
+        d.id = i
+        d.room = room
+        d.value = value
+        indexed.add(d)
+        plain.add(d)
+    assert list(indexed.indexes['room'].unindexed) == [1]
+    assert list(indexed.indexes['value'].unindexed) == [1, 3]
+    queries = [
+        (Equal('room', 1),),
+        (Range('value', 0, 10),),
+        (Range('value', 'a', 'b'),),
+        (Prefix('value', 'ap'),),
+        (Equal('room', [1]),),
+        ]
+    for predicates in queries:
+        assert sorted(d.id for d in indexed.query(*predicates)) == sorted(d.id for d in plain.query(*predicates))
+    del indexed[1]
+    del indexed[0]
+    assert sorted(indexed) == [2, 3]
+    assert not indexed.indexes['room'].unindexed
+    assert list(indexed.indexes['value'].unindexed) == [3]
+    assert [d.id for d in indexed.query(Range('value', 0, 10))] == [2]
+    assert [d.id for d in indexed.query(room = 1)] == [3]
+
 def test_filter(filter_layout, loop):
     layout = filter_layout
     registry_server = layout.server.registries[0]
@@ -87,3 +309,175 @@ def test_filter(filter_layout, loop):
     assert b1 not in b_client_store
     
     
+
+def test_urgent_latency_under_load(layout, loop):
+    "An urgent object is delivered promptly while a bandwidth-limited bulk transfer is in progress"
+    registry_server = layout.server.registries[0]
+    manager = layout.server.manager
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    manager.synchronize(owner)
+    settle_loop(loop)
+    # About 10 kB/s, so each bulk object pauses writing for most of a second
+    layout.server.to_client.bwprotocol.bw_per_quantum = 1000
+    bulk = []
+    for i in range(20):
+        b = B()
+        b.value = 'x'*8000
+        b._sync_owner = owner.id
+        registry_server.add_to_store(b)
+        manager.synchronize(b)
+        bulk.append(b)
+    loop.run_until_complete(asyncio.sleep(0.3))
+    urgent = B()
+    urgent.value = 'urgent'
+    urgent._sync_owner = owner.id
+    registry_server.add_to_store(urgent)
+    store_client = layout.client.registries[0].store_for_class(B)
+    async def received():
+        while urgent.id not in store_client: await asyncio.sleep(0.01)
+    start = loop.time()
+    manager.synchronize(urgent, priority = 1)
+    loop.run_until_complete(asyncio.wait_for(received(), 3))
+    latency = loop.time()-start
+    assert sum(1 for b in bulk if b.id in store_client) < len(bulk)
+    assert latency < 0.25
+
+def test_manager_bandwidth(layout, loop):
+    "A manager-wide budget limits what all connections send and counts it for each destination"
+    registry_server = layout.server.registries[0]
+    manager = layout.server.manager
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    manager.synchronize(owner)
+    settle_loop(loop)
+    manager.bw_per_sec = 10000
+    assert manager.bandwidth.chars_per_sec == 10000
+    bulk = []
+    for i in range(5):
+        b = B()
+        b.value = 'x'*8000
+        b._sync_owner = owner.id
+        registry_server.add_to_store(b)
+        manager.synchronize(b)
+        bulk.append(b)
+    loop.run_until_complete(asyncio.sleep(0.5))
+    store_client = layout.client.registries[0].store_for_class(B)
+    assert sum(1 for b in bulk if b.id in store_client) < len(bulk)
+    counters = manager.bandwidth.counters()
+    assert counters['pauses'] > 0
+    dest_counters, = counters['children']
+    assert dest_counters['name'] == layout.server.to_client.name
+    assert dest_counters['chars'] == counters['chars'] > 8000
+    # Lifting the limit releases what is waiting
+    manager.bw_per_sec = None
+    settle_loop(loop)
+    assert all(b.id in store_client for b in bulk)
+
+def test_session_resumed(filter_layout, loop):
+    "After a brief disconnect, messages lost in flight and objects synchronized meanwhile are delivered without a resync"
+    layout = filter_layout
+    registry_server = layout.server.registries[0]
+    manager = layout.server.manager
+    to_client = layout.server.to_client
+    to_client.add_filter(Filter(lambda o: True, store = registry_server.store_for_class(B)))
+    to_client.add_filter(SyncOwnerFilter(registry_server))
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    manager.synchronize(owner)
+    settle_loop(loop)
+    store_client = layout.client.registries[0].store_for_class(B)
+    def new_b(value):
+        b = B()
+        b.value = value
+        b._sync_owner = owner.id
+        registry_server.add_to_store(b)
+        manager.synchronize(b)
+        return b
+    def disconnect(expire = False):
+        # Lose whatever the server writes, then drop the connection
+        protocol = to_client.protocol
+        protocol._send_json = lambda sync_rep, flags: None
+        lost = new_b('lost')
+        settle_loop(loop)
+        assert lost.id not in store_client
+        protocol.close()
+        layout.client.to_server.connect_at = 0
+        disconnected = new_b('disconnected')
+        if expire: manager._sessions[to_client.dest_hash].expire()
+        loop.run_until_complete(asyncio.sleep(0.05))
+        return lost, disconnected
+    lost, disconnected = disconnect()
+    sent_initial = []
+    to_client.send_initial_objects = lambda manager: sent_initial.append(manager) or asyncio.sleep(0)
+    layout.wait_connecting(allow_empty = True)
+    assert to_client.session_resumed and layout.client.to_server.session_resumed
+    assert lost.id in store_client and disconnected.id in store_client
+    assert not sent_initial
+    # Once the session expires, reconnecting falls back to a resync
+    disconnect(expire = True)
+    layout.wait_connecting(allow_empty = True)
+    assert not to_client.session_resumed
+    assert sent_initial
+
+@pytest.mark.parametrize('timeout', [5, 0.2])
+def test_aclose(layout, loop, timeout):
+    "aclose sends queued objects until its deadline, says goodbye and reports what was flushed and abandoned"
+    registry_server = layout.server.registries[0]
+    manager = layout.server.manager
+    owner = SyncOwner()
+    registry_server.add_to_store(owner)
+    manager.synchronize(owner)
+    settle_loop(loop)
+    # About 20 kB/s, so the queue takes about half a second to send
+    layout.server.to_client.bwprotocol.bw_per_quantum = 2000
+    bulk = []
+    for i in range(10):
+        b = B()
+        b.value = 'x'*1000
+        b._sync_owner = owner.id
+        registry_server.add_to_store(b)
+        manager.synchronize(b)
+        bulk.append(b)
+    client_protocol = layout.client.to_server.protocol
+    results = loop.run_until_complete(manager.aclose(timeout = timeout))
+    settle_loop(loop)
+    store_client = layout.client.registries[0].store_for_class(B)
+    delivered = sum(1 for b in bulk if b.id in store_client)
+    result = results[layout.server.to_client]
+    # Some may have been sent before aclose was called
+    assert 0 < result['flushed']+result['abandoned'] <= len(bulk)
+    if timeout > 1:
+        assert result['abandoned'] == 0 and delivered == len(bulk)
+    else:
+        assert result['abandoned'] > 0 and delivered == len(bulk)-result['abandoned']
+    assert client_protocol.peer_goodbye
+    with pytest.raises(SyncNotConnected):
+        manager.synchronize(owner)
+
+def test_aclose_disconnect(layout, loop, monkeypatch):
+    "A peer that disconnects while aclose is draining is not reconnected, and no destinations are added"
+    registry_client = layout.client.registries[0]
+    manager = layout.client.manager
+    owner = SyncOwner()
+    registry_client.add_to_store(owner)
+    manager.synchronize(owner)
+    settle_loop(loop)
+    layout.client.to_server.bwprotocol.bw_per_quantum = 1000
+    for i in range(5):
+        b = B()
+        b.value = 'x'*8000
+        b._sync_owner = owner.id
+        registry_client.add_to_store(b)
+        manager.synchronize(b)
+    reconnects = []
+    monkeypatch.setattr(manager, '_create_connection', lambda dest: reconnects.append(dest) or asyncio.sleep(0))
+    closing = loop.create_task(manager.aclose(timeout = 1))
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert not closing.done()
+    # Reading is paused, so drop the connection from this end
+    layout.client.to_server.protocol.transport.abort()
+    loop.run_until_complete(closing)
+    assert not reconnects
+    with pytest.raises(SyncNotConnected):
+        manager.add_destination(SyncDestination(layout.server.to_client.dest_hash, 'late'))
@@ -11,8 +11,9 @@ import asyncio, datetime, gc, json, pytest, ssl, unittest, uuid, warnings
 from contextlib import contextmanager
 from unittest import mock
 
-from entanglement.interface import Synchronizable, sync_property, SyncRegistry
+from entanglement.interface import Synchronizable, sync_property, SyncRegistry, SyncEncodeCacheMixin
 from entanglement.network import  SyncServer,  SyncManager
+from entanglement.protocol import SyncProtocol
 from entanglement.util import certhash_from_file, DestHash, SqlDestHash, get_or_create, entanglement_logs_disabled
 from entanglement.sql.transition import SqlTransitionTrackerMixin, DirtyTransitionError
 from entanglement.transition import BrokenTransition
@@ -21,6 +22,7 @@ from sqlalchemy import create_engine, Column, Integer, inspect, String, ForeignK
 from sqlalchemy.orm import sessionmaker
 from entanglement.sql import SqlSynchronizable,  sync_session_maker, sql_sync_declarative_base, SqlSyncDestination, SqlSyncRegistry, sync_manager_destinations, SyncOwner
 import entanglement.sql as sql
+import sqlalchemy
 from .utils import *
 
 
@@ -52,6 +54,13 @@ class TableInherits(TableBase):
     info2 = Column(String(30))
     __mapper_args__ = {'polymorphic_identity': "inherits"}
 
+class CachedTable(SyncEncodeCacheMixin, Base):
+    __tablename__ = 'cached_table'
+    id = Column(Integer, primary_key = True)
+    value = Column(String(30))
+    generated = Column(String(30), server_default = 'by server')
+    __mapper_args__ = {'eager_defaults': True}
+
 class TransitionTable(Base, SqlTransitionTrackerMixin):
     __tablename__ = 'trans_table'
     id = Column(Integer, primary_key = True)
@@ -65,6 +74,23 @@ class AlternateSyncDestination(SqlSyncDestination):
 
     def new_method(self): pass
 
+def test_last_connected_migration():
+    "Databases from before last_connected was stored gain the column with every destination at 0"
+    from alembic import command, config
+    engine = create_engine('sqlite:///:memory:')
+    SqlSyncRegistry.create_bookkeeping(engine)
+    conf = config.Config()
+    conf.set_main_option('script_location', 'entanglement.sql:alembic')
+    conf.engine = engine
+    command.downgrade(conf, 'dc7778ec1ccc')
+    assert 'last_connected' not in [c['name'] for c in inspect(engine).get_columns('sync_destinations')]
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(
+            "insert into sync_destinations (dest_hash, name, bw_per_sec, type) values ('x', 'old', 1, 'SqlSyncDestination')"))
+    SqlSyncRegistry.create_bookkeeping(engine)
+    with engine.connect() as connection:
+        assert connection.execute(sqlalchemy.text("select last_connected from sync_destinations")).scalar() == 0
+
 manager_registry = SqlSyncRegistry()
 manager_registry.registry = Base.registry.registry
 
@@ -122,6 +148,13 @@ class TestSql(SqlFixture, unittest.TestCase):
                               {'dest_hash' : dest.dest_hash})
         self.assertEqual(dest.id, dest2.id)
 
+    def testLastConnectedStored(self):
+        "The time a destination last connected is stored so connection order survives a restart"
+        with self.e1.connect() as connection:
+            last_connected, = connection.execute(sqlalchemy.select(SqlSyncDestination.last_connected).where(
+                SqlSyncDestination.dest_hash == self.d2.dest_hash)).one()
+        assert last_connected == self.d2.last_connected > 0
+
     def testYouHave(self):
         "Test sending of you_have messages"
         with wait_for_call(self.loop, sql.internal.sql_meta_messages, 'handle_you_have'):
@@ -148,6 +181,34 @@ class TestSql(SqlFixture, unittest.TestCase):
         assert t2 is not None
         assert t2.ch == t1.ch
 
+    def testColumnarResync(self):
+        "Objects sent while resynchronizing go in columnar batches and are received one by one"
+        self.session.manager = None
+        self.manager.remove_destination(self.d1)
+        with entanglement_logs_disabled():
+            self.manager.loop.call_soon(self.manager.loop.stop)
+            self.manager.loop.run_forever()
+            session = self.session
+            objects = [Table1(ch = self.d2.dest_hash) for i in range(20)]
+            session.add_all(objects)
+            session.commit()
+        sent = []
+        send_json = SyncProtocol._send_json
+        def record(protocol, sync_rep, flags):
+            sent.append(sync_rep)
+            return send_json(protocol, sync_rep, flags)
+        with mock.patch.object(SyncProtocol, '_send_json', record):
+            with entanglement_logs_disabled():
+                self.d1.connect_at = 0
+                self.manager.run_until_complete(self.manager.add_destination(self.d1))
+            with wait_for_call(self.loop, sql.internal.sql_meta_messages, 'handle_you_have'):
+                pass
+        batches = [rep for rep in sent if rep.get('_sync_type') == 'Table1' and '_columns' in rep]
+        assert len(batches) == 1 and len(batches[0]['_columns']['id']) == 20
+        for t1 in objects:
+            t2 = self.server.session.get(Table1, t1.id)
+            assert t2 is not None and t2.ch == t1.ch
+
     def testJoinedTable(self):
         "Test Joined Table Inheritance"
         def to_sync_cb(self, attributes):
@@ -414,6 +475,41 @@ def test_transition_sync_dirty(sql_fixture, server_session):
             
         
 
+def test_encode_cache_sql(sql_fixture, server_session):
+    "Cached encodings of SQL objects are dropped when they are expired or refreshed from the database, including by a flush"
+    s = server_session
+    c = CachedTable(id = 1, value = 'first')
+    s.add(c)
+    s.commit()
+    assert c.to_sync()['value'] == 'first'
+    version = c.sync_version
+    assert c.to_sync()['value'] == 'first'
+    assert c.sync_version == version
+    s.execute(sqlalchemy.update(CachedTable).values(value = 'second'))
+    s.commit()
+    assert c.sync_version != version
+    assert c.to_sync()['value'] == 'second'
+    # Server generated values fetched by a flush replace what was
+    # encoded before it, as when a batch of received objects is flushed
+    c2 = CachedTable(id = 2, value = 'pending')
+    s.add(c2)
+    encoded = []
+    def encode_before(session, flush_context, instances):
+        encoded.append(c2.to_sync()['generated'])
+    def encode_after(target, flush_context, attrs):
+        encoded.append(target.to_sync()['generated'])
+    sqlalchemy.event.listen(s, 'before_flush', encode_before)
+    sqlalchemy.event.listen(CachedTable, 'refresh_flush', encode_after)
+    try: s.flush()
+    finally:
+        sqlalchemy.event.remove(s, 'before_flush', encode_before)
+        sqlalchemy.event.remove(CachedTable, 'refresh_flush', encode_after)
+    assert encoded == [None, 'by server']
+    s.commit()
+    
+            
+        
+
 #import logging
 #logging.basicConfig(level = 'ERROR')
 
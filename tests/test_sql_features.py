@@ -231,7 +231,95 @@ def test_no_force_resync_always(layout, monkeypatch):
     t1_client = layout.client.session.query(T1).filter_by(id = t1.id).one()
     assert t1_client == t1
 
-    
-    
+def test_batched_receive(layout, monkeypatch):
+    "Incoming objects are committed in groups and a failing object does not lose the rest of its batch"
+    registry, = [r for r in layout.server.manager.registries
+                 if isinstance(r, Base.registry.__class__)]
+    monkeypatch.setattr(registry, 'batch_size', 20)
+    monkeypatch.setattr(registry, 'batch_interval', 10)
+    commits = 0
+    orig_commit_batch = registry.commit_batch
+    def commit_batch(protocol):
+        nonlocal commits
+        if registry._batches.get(protocol): commits += 1
+        return orig_commit_batch(protocol)
+    monkeypatch.setattr(registry, 'commit_batch', commit_batch)
+    flooded = []
+    orig_flood = operations.sync_operation.flood
+    def flood(obj, manager, **info):
+        if manager is layout.server.manager:
+            # Only what has been committed is flooded
+            assert not registry._batches
+            flooded.append(obj.id)
+        return orig_flood(obj, manager = manager, **info)
+    monkeypatch.setattr(operations.sync_operation, 'flood', flood)
+    duplicate = uuid.uuid4()
+    # An object the server has that the client does not know about
+    # so the client's object conflicts only when the server flushes
+    with layout.server.engine.begin() as connection:
+        connection.execute(T1.__table__.insert().values(
+            id = 9999, x2 = duplicate, sync_serial = 0))
+    session = layout.client.session
+    objects = []
+    for i in range(9):
+        t1 = T1()
+        t1.x2 = uuid.uuid4()
+        session.add(t1)
+        objects.append(t1)
+    session.commit()
+    # Committed separately so it is sent after the rest of the batch,
+    # which then has to be received again without it.
+    conflicting = T1()
+    conflicting.x2 = duplicate
+    session.add(conflicting)
+    session.commit()
+    settle_loop(layout.loop)
+    registry.commit_batches()
+    assert not registry._batches
+    server_session = layout.server.session
+    server_session.expire_all()
+    for t1 in objects:
+        t1_server = server_session.get(T1, t1.id)
+        assert t1_server.x2 == t1.x2
+    assert server_session.get(T1, conflicting.id) is None
+    assert commits < len(objects)
+    # Received again after the failed commit but flooded once
+    assert sorted(flooded) == sorted(t1.id for t1 in objects)
+
+def test_batch_committed_on_connection_lost(layout, monkeypatch):
+    "A pending batch is committed when its connection is lost rather than by its timer"
+    registry, = [r for r in layout.server.manager.registries
+                 if isinstance(r, Base.registry.__class__)]
+    monkeypatch.setattr(registry, 'batch_size', 20)
+    monkeypatch.setattr(registry, 'batch_interval', 10)
+    protocol = layout.server.to_client.protocol
+    with registry.sync_context(protocol = protocol, manager = layout.server.manager) as context:
+        t1 = T1()
+        t1.x2 = uuid.uuid4()
+        context.session.add(t1)
+    batch = registry._batches[protocol]
+    layout.client.to_server.protocol.close()
+    settle_loop(layout.loop)
+    assert not registry._batches
+    assert batch.timer.cancelled()
+    assert layout.server.session.get(T1, t1.id).x2 == t1.x2
+
+def test_batch_received_again_errors(layout, monkeypatch):
+    "An entry failing while a batch is received again is reported and the rest are still received"
+    registry, = [r for r in layout.server.manager.registries
+                 if isinstance(r, Base.registry.__class__)]
+    manager = layout.server.manager
+    protocol = layout.server.to_client.protocol
+    received = []
+    def _sync_receive(msg, protocol, response_for):
+        if msg['n'] == 1: raise RuntimeError('bad entry')
+        received.append(msg['n'])
+    monkeypatch.setattr(manager, '_sync_receive', _sync_receive)
+    failed = []
+    monkeypatch.setattr(protocol, '_receive_failed', lambda e, msg, response_for: failed.append(msg['n']))
+    registry._receive_again(manager, protocol, [{'n': n} for n in range(4)])
+    assert received == [0, 2, 3]
+    assert failed == [1]
+
 logging.getLogger('entanglement.protocol').setLevel(10)
 logging.basicConfig(level = 10)
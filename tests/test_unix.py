@@ -56,4 +56,33 @@ def test_unix_connection(layout):
     layout.client.manager.synchronize(t)
     settle_loop(layout.loop)
     
+class Bulky(Syncable):
+
+    value = sync_property()
+
+def test_unix_shared_memory(layout):
+    "Unix connections to the same user carry messages in shared memory, waiting when the ring fills"
+    received = {'client': [], 'server': []}
+    for name in received:
+        getattr(layout, name).registries[0].sync_receive = \
+            lambda obj, received = received[name], **info: received.append(obj.id)
+    layout.client.manager.shm_ring_size = 1 # As small as allowed
+    connect_unix(layout)
+    client, = layout.client.manager.connections
+    server, = layout.server.manager.connections
+    assert client._shm_out is not None and server._shm_out is not None
+    assert client.shm.path is None # unlinked once both sides have it
+    for i in range(200):
+        b = Bulky()
+        b.id = i
+        b.value = 'x'*1000
+        layout.client.manager.synchronize(b)
+    t = Syncable()
+    t.id = 'reply'
+    layout.server.manager.synchronize(t)
+    settle_loop(layout.loop)
+    assert sorted(received['server']) == list(range(200))
+    assert received['client'] == ['reply']
+    assert client.waiter is None and not client._shm_backlog
+
 logging.getLogger('entanglement.protocol').setLevel(10)
@@ -19,10 +19,10 @@ import tornado.web, tornado.websocket, tornado.ioloop, tornado.testing, tornado.
 import entanglement.protocol
 from entanglement import SyncServer, SyncDestination, operations
 import entanglement.javascript_schema
-from entanglement.util import entanglement_logs_disabled
+from entanglement.util import entanglement_logs_disabled, DestHash
 from entanglement.sql import sql_sync_declarative_base, SqlSyncRegistry, SyncOwner, SqlSyncDestination
 from entanglement.sql.transition import SqlTransitionTrackerMixin
-from entanglement.websocket import SyncWsHandler
+from entanglement.websocket import SyncWsHandler, SyncWsProtocol
 from sqlalchemy import Column, String, Integer, ForeignKey
 from entanglement.util import GUID
 from tests.utils import *
@@ -270,6 +270,43 @@ class TestWebsockets(SqlFixture, unittest.TestCase):
         test_method_name = t[len(js_test_path)+3:-3]
         locals()[test_method_name] = javascriptTest(t, test_method_name)
 
+class HeldWsHandler:
+
+    "Holds the futures from write_message so a test decides when Tornado has written each message"
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.written = []
+
+    def write_message(self, message):
+        future = self.loop.create_future()
+        self.written.append(future)
+        return future
+
+    def close(self): pass
+
+def test_ws_backpressure(loop):
+    "Writing to a web socket pauses while Tornado holds too much unwritten and resumes as it drains"
+    manager = SyncServer(None, 0, loop = loop, registries = [])
+    manager.write_buffer_high = 10000
+    dest = SyncDestination(DestHash(os.urandom(32)), 'browser')
+    protocol = SyncWsProtocol(manager, dest)
+    handler = protocol.ws_handler = HeldWsHandler(loop)
+    assert protocol.bwprotocol.chars_per_sec == dest.bw_per_sec
+    for i in range(20):
+        if protocol.waiter: break
+        protocol._send_json({'value': 'x'*1000}, 0)
+    assert protocol.waiter is not None
+    assert 10000 < protocol.unflushed < 12000
+    for future in handler.written[:len(handler.written)//2]: future.set_result(None)
+    settle_loop(loop)
+    assert protocol.waiter is not None
+    for future in handler.written: future.done() or future.set_result(None)
+    settle_loop(loop)
+    assert protocol.waiter is None and protocol.unflushed == 0
+    protocol.close()
+    manager.close()
+
 def test_sync_registry(loop):
     future =  run_js_test("testSyncRegistry.js")
     loop.run_until_complete(future)